@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import sys, os, random, time
+import numpy as np
 sys.path.append('${GEM_PYTHON_PATH}')
 
 from gempython.utils.rate_calculator import rateConverter
@@ -9,6 +10,9 @@ from gempython.tools.amc_user_functions_uhal import *
 from gempython.tools.optohybrid_user_functions_uhal import *
 from gempython.tools.vfat_user_functions_uhal import *
 
+from registerUtils import channelRegisterPatterns, readChannelRegisters, writeChannelRegisters
+from trackingUtils import TrackingDataWriter, TrackingFIFOReader, ecDiscontinuities
+
 Passed = '\033[92m   > Passed... \033[0m'
 NotRun = '\033[90m   > NotRun... \033[0m'
 Failed = '\033[91m   > Failed... \033[0m'
@@ -18,12 +22,23 @@ def txtTitle(str):
     return
 
 class TEST_PARAMS:
-    def __init__(self,namc=100,noh=100,ni2c=100,ntrk=100,writeout=False):
+    def __init__(self,namc=100,noh=100,ni2c=100,ntrk=100,writeout=False,trktimeout=5.,
+                 rawfile="TrackingData",rawsize=0,ratetol=0.05,ratesteptime=0.5,ratesoaktime=10.,
+                 ratemin=100,ratemax=1000000,ratefile="TrackingRateScan.txt"):
         self.AMC_REG_TEST = namc
         self.OH_REG_TEST   = noh
         self.I2C_TEST      = ni2c
         self.TK_RD_TEST    = ntrk
         self.RATE_WRITE    = writeout
+        self.TK_TIMEOUT    = trktimeout
+        self.RAW_FILE      = rawfile
+        self.RAW_SIZE      = rawsize
+        self.RATE_TOL       = ratetol
+        self.RATE_STEP_TIME = ratesteptime
+        self.RATE_SOAK_TIME = ratesoaktime
+        self.RATE_MIN       = ratemin
+        self.RATE_MAX       = ratemax
+        self.RATE_FILE      = ratefile
 
         return
 
@@ -39,8 +54,14 @@ class GEMDAQTestSuite:
 
     allTests = ["A","B","C","D","E","F","G","H","I","J"]
 
-    def __init__(self,slot,gtx,shelf=1,tests="",test_params=TEST_PARAMS(),debug=False):
+    # Tests which use resources shared by all links (the AMC itself, or its
+    # readout bandwidth) and are serialized when running on several links
+    amcTests = ["A","C","I"]
+
+    def __init__(self,slot,gtx,shelf=1,tests="",test_params=TEST_PARAMS(),debug=False,lock=None):
         """
+        lock is an optional lock shared with suites running on other links,
+        held while running the tests in amcTests
         """
         self.slot   = slot
         self.shelf  = shelf
@@ -81,15 +102,22 @@ class GEMDAQTestSuite:
         self.test_params = test_params
 
         self.debug         = debug
+        self.lock          = lock
+        self.timing        = {}
 
         self.amc     = getAMCObject(self.slot,self.shelf)
         self.ohboard = getOHObject(self.slot,self.gtx,self.shelf)
 
+        self.trkReader = TrackingFIFOReader(self.amc,self.gtx,capacity=24*self.test_params.TK_RD_TEST)
+
         self.presentVFAT2sSingle = []
         self.presentVFAT2sFifo   = []
         self.chipIDs  = None
         self.vfatmask = 0xff000000
 
+        self.rateCurve      = []
+        self.maxReadoutRate = 0
+
         self.test = {}
         self.test["A"] = False
         self.test["B"] = False
@@ -322,28 +350,41 @@ class GEMDAQTestSuite:
     ####################################################
     def VFAT2ChannelRegisterTest(self):
         # self.test
-
-        for i in self.presentVFAT2sSingle:
-            validOperations = 0
-            for chan in range(128):
-                initialValue = (getChannelRegister(self.ohboard,self.gtx,i,chan)&0xff)
-                for j in range(0,self.test_params.I2C_TEST):
-                    writeData    = random.randint(0, 255)
-                    setChannelRegister(self.ohboard,self.gtx,i,chan,writeData)
-                    readData     = (getChannelRegister(self.ohboard,self.gtx,i,chan)&0xff)
-                    if (readData == writeData):
-                        validOperations += 1
-                        pass
-                    else:
-                        print "0x%02x not 0x%02x"%(readData,writeData)
+        # Every pattern is written to all channels of all present VFAT2s and
+        # read back in batched transactions, I2C_TEST random patterns follow
+        # the walking ones and checkerboards
+
+        vfats = list(self.presentVFAT2sSingle)
+        if len(vfats) == 0:
+            print
+            return
+
+        initialValues = readChannelRegisters(self.ohboard,self.gtx,vfats,self.debug)
+        nPatterns       = 0
+        validOperations = np.zeros(len(vfats), dtype=np.int64)
+        try:
+            for name, writeData in channelRegisterPatterns(len(vfats),self.test_params.I2C_TEST):
+                writeChannelRegisters(self.ohboard,self.gtx,vfats,writeData,self.debug)
+                readData = readChannelRegisters(self.ohboard,self.gtx,vfats,self.debug)
+                valid    = (readData == writeData)
+                validOperations += valid.sum(axis=1)
+                nPatterns += 1
+                if self.debug:
+                    for idx, chan in zip(*np.nonzero(~valid)):
+                        print "%s: #%d channel %d 0x%02x not 0x%02x"%(name,vfats[idx],chan,
+                                                                     readData[idx,chan],writeData[idx,chan])
                         pass
                     pass
-                writeVFAT(self.ohboard,self.gtx,i,chan,initialValue)
                 pass
-            if (validOperations == 128*self.test_params.I2C_TEST):
+        finally:
+            writeChannelRegisters(self.ohboard,self.gtx,vfats,initialValues,self.debug)
+            pass
+
+        for idx, i in enumerate(vfats):
+            if (validOperations[idx] == 128*nPatterns):
                 print Passed, "#%d"%(i)
             else:
-                print Failed, "#%d valid operations: %d, expected: %d"%(i, validOperations, 128*self.test_params.I2C_TEST)
+                print Failed, "#%d valid operations: %d, expected: %d"%(i, validOperations[idx], 128*nPatterns)
                 # self.test["F"] = False
                 pass
             pass
@@ -370,27 +411,13 @@ class GEMDAQTestSuite:
             writeVFAT(self.ohboard,self.gtx,i,"ContReg0",0x37)
             setVFATTrackingMask(self.ohboard,self.gtx, ~(0x1 << i))
             flushTrackingFIFO(self.amc,self.gtx)
-
-            nPackets = 0
-            timeOut = 0
-            ecs = []
+            self.trkReader.reset()
 
             sendL1A(self.ohboard,self.gtx,t1_interval,t1_n)
 
-            while ((readFIFODepth(self.amc,self.gtx)["Occupancy"]) != 7 * self.test_params.TK_RD_TEST):
-                timeOut += 1
-                if (timeOut == 10 * self.test_params.TK_RD_TEST):
-                    break
-                pass
-            while ((readFIFODepth(self.amc,self.gtx)["isEMPTY"]) != 1):
-                packets = readTrackingInfo(self.amc,self.gtx)
-                if (len(packets) == 0):
-                    print "read data packet length is 0"
-                    continue
-                ec = int((0x00000ff0 & packets[0]) >> 4)
-                nPackets += 1
-                ecs.append(ec)
-                pass
+            self.trkReader.waitForOccupancy(7 * self.test_params.TK_RD_TEST, self.test_params.TK_TIMEOUT)
+            nPackets = self.trkReader.drain(self.test_params.TK_TIMEOUT)
+            ecs = self.trkReader.eventCounters()
             writeVFAT(self.ohboard,self.gtx,i,"ContReg0",0x36)
 
             if (nPackets != self.test_params.TK_RD_TEST):
@@ -400,13 +427,9 @@ class GEMDAQTestSuite:
                     pass
             else:
                 followingECS = True
-                for j in range(0, self.test_params.TK_RD_TEST - 1):
-                    if (ecs[j + 1] == 0 and ecs[j] == 255):
-                        pass
-                    elif (ecs[j + 1] - ecs[j] != 1):
-                        followingECS = False
-                        print "\033[91m   > #%d previous %d, current %d \033[0m"%(i, ecs[j], ecs[j+1])
-                        pass
+                for j in ecDiscontinuities(ecs):
+                    followingECS = False
+                    print "\033[91m   > #%d previous %d, current %d \033[0m"%(i, ecs[j], ecs[j+1])
                     pass
                 if (followingECS):
                     print Passed, "#" + str(i)
@@ -450,43 +473,28 @@ class GEMDAQTestSuite:
             t1_interval =  400
             resetLocalT1(self.ohboard,self.gtx)
 
-            nPackets = 0
-            timeOut = 0
-            ecs = []
+            nVFATs = len(self.presentVFAT2sSingle)
+            self.trkReader.reset()
 
             sendL1A(self.ohboard,self.gtx,t1_interval,t1_n)
 
-            while ((readFIFODepth(self.amc,self.gtx)["Occupancy"]) != len(self.presentVFAT2sSingle) * self.test_params.TK_RD_TEST):
-                timeOut += 1
-                if (timeOut == 20 * self.test_params.TK_RD_TEST): break
-                pass
-            while ((readFIFODepth(self.amc,self.gtx)["isEMPTY"]) != 1):
-                packets = readTrackingInfo(self.amc,self.gtx)
-                ec = int((0x00000ff0 & packets[0]) >> 4)
-                nPackets += 1
-                ecs.append(ec)
-                pass
+            self.trkReader.waitForOccupancy(7 * nVFATs * self.test_params.TK_RD_TEST, 2 * self.test_params.TK_TIMEOUT)
+            nPackets = self.trkReader.drain(self.test_params.TK_TIMEOUT)
             broadcastWrite(self.ohboard,self.gtx,"ContReg0", 0x36)
 
-            if (nPackets != len(self.presentVFAT2sSingle) * self.test_params.TK_RD_TEST):
-                print Failed, "#%d received: %d, expected: %d"%(i,nPackets, len(self.presentVFAT2sSingle) * self.test_params.TK_RD_TEST)
+            if (nPackets != nVFATs * self.test_params.TK_RD_TEST):
+                print Failed, "received: %d, expected: %d"%(nPackets, nVFATs * self.test_params.TK_RD_TEST)
             else:
                 followingECS = True
-                for i in range(0, self.test_params.TK_RD_TEST - 1):
-                    for j in range(0, len(self.presentVFAT2sSingle) - 1):
-                        if (ecs[i * len(self.presentVFAT2sSingle) + j + 1] != ecs[i * len(self.presentVFAT2sSingle) + j]):
-                            print "\033[91m   > #%d saw %d, %d saw %d \033[0m"%(j+1, ecs[i * len(self.presentVFAT2sSingle) + j + 1],
-                                                                                j, ecs[i * len(self.presentVFAT2sSingle) + j])
-                            followingECS = False
-                            pass
-                        pass
-                    if (ecs[(i + 1) * len(self.presentVFAT2sSingle)]  == 0 and ecs[i * len(self.presentVFAT2sSingle)] == 255):
-                        pass
-                    elif (ecs[(i + 1) * len(self.presentVFAT2sSingle)] - ecs[i * len(self.presentVFAT2sSingle)] != 1):
-                        print "\033[91m   > #%d previous %d, current %d \033[0m"%(i, ecs[i * len(self.presentVFAT2sSingle)],
-                                                                                  ecs[(i+1) * len(self.presentVFAT2sSingle)])
-                        followingECS = False
-                        pass
+                # one row per L1A, one column per VFAT
+                ecs = self.trkReader.eventCounters().reshape(self.test_params.TK_RD_TEST, nVFATs)
+                for i, j in zip(*np.nonzero(ecs[:,1:] != ecs[:,:-1])):
+                    print "\033[91m   > #%d saw %d, %d saw %d \033[0m"%(j+1, ecs[i,j+1], j, ecs[i,j])
+                    followingECS = False
+                    pass
+                for i in ecDiscontinuities(ecs[:,0]):
+                    print "\033[91m   > #%d previous %d, current %d \033[0m"%(i, ecs[i,0], ecs[i+1,0])
+                    followingECS = False
                     pass
                 if (followingECS): print Passed
                 else:
@@ -506,76 +514,126 @@ class GEMDAQTestSuite:
         return
 
     ####################################################
-    def TrackingDataReadoutRateTest(self):
-        txtTitle("I. Testing the tracking data readout rate")
-        print "   Sending triggers at a given rate and looking at the maximum readout rate that can be achieved."
+    def readoutAtRate(self, rate, duration):
+        """
+        Sends L1As at rate (in Hz) for duration seconds while reading out the
+        tracking FIFO, returns True if the FIFO never filled up. Every call is
+        recorded in self.rateCurve as (rate, max occupancy, mean occupancy, passed).
+        """
+        isFull = False
 
-        broadcastWrite(self.ohboard,self.gtx,"ContReg0", 0x36)
+        t1_mode     =  0
+        t1_type     =  0
+        t1_n        =  0
+        t1_interval =  40000000 / rate
 
-        writeVFAT(self.ohboard,self.gtx,self.presentVFAT2sSingle[0],"ContReg0",0x37)
-        setVFATTrackingMask(self.ohboard,self.gtx, ~(0x1 << self.presentVFAT2sSingle[0]))
+        writer = None
+        if (self.test_params.RATE_WRITE):
+            writer = TrackingDataWriter("%s_%dHz.dat"%(self.test_params.RAW_FILE,rate),
+                                        self.gtx, ~(0x1 << self.presentVFAT2sSingle[0]) & 0xffffff,
+                                        t1_interval, preallocate=self.test_params.RAW_SIZE)
+            pass
 
-        f = open('out.log', 'w')
+        resetLocalT1(self.ohboard,self.gtx)
+        flushTrackingFIFO(self.amc,self.gtx)
+        self.trkReader.reset()
+        sendL1A(self.ohboard,self.gtx,t1_interval,t1_n)
+
+        deadline = time.time() + duration
+        while (time.time() < deadline):
+            data = self.trkReader.poll()
+            if (writer is not None and len(data) > 0):
+                writer.write(data)
+                pass
+            if ((readFIFODepth(self.amc,self.gtx)["isFULL"]) == 1):
+                isFull = True
+                break
+            pass
 
-        values = [
-                  100, 200, 300, 400, 500, 600, 700, 800, 900,
-                  1000, 2000, 3000, 4000, 5000, 6000, 7000, 8000, 9000,
-                  10000, 20000, 30000, 40000, 50000, 60000, 70000, 80000, 90000,
-                  100000, 125000, 150000, 175000, 200000
-                ]
+        resetLocalT1(self.ohboard,self.gtx)
+        if (writer is not None):
+            writer.close()
+            pass
 
-        previous = 0
+        self.rateCurve.append((rate, self.trkReader.maxOccupancy, self.trkReader.meanOccupancy(), not isFull))
+        if self.debug:
+            if (isFull):
+                print "   FIFO full at %4d %sHz"%(rateConverter(rate))
+            else:
+                print "   Readout succeeded at %4d %sHz"%(rateConverter(rate))
+                pass
+            print "   FIFO occupancy max %d, mean %.1f"%(self.trkReader.maxOccupancy, self.trkReader.meanOccupancy())
+            print "   FIFO reads sustained %4d %sHz"%(rateConverter(int(self.trkReader.readoutRate())))
+            pass
 
-        for i in values:
-            isFull = False
+        time.sleep(0.01)
 
-            t1_mode     =  0
-            t1_type     =  0
-            t1_n        =  0
-            t1_interval =  40000000 / i
+        return not isFull
 
-            resetLocalT1(self.ohboard,self.gtx)
-            flushTrackingFIFO(self.amc,self.gtx)
-            sendL1A(self.ohboard,self.gtx,t1_interval,t1_n)
+    ####################################################
+    def TrackingDataReadoutRateTest(self):
+        txtTitle("I. Testing the tracking data readout rate")
+        print "   Sending triggers at increasing rates and looking at the maximum readout rate that can be achieved."
 
-            if (self.test_params.RATE_WRITE):
-                for j in range(0, 1000):
-                    depth = readFIFODepth(self.amc,self.gtx)["Occupancy"]
-                    if (depth > 0):
-                        data = readTrackingInfo(self.amc,self.gtx,1*depth/7)
-                        for d in data:
-                            f.write(str(d))
-                            pass
-                        pass
-                    if ((readFIFODepth(self.amc,self.gtx)["isFULL"]) == 1):
-                        isFull = True
-                        break
+        broadcastWrite(self.ohboard,self.gtx,"ContReg0", 0x36)
+
+        writeVFAT(self.ohboard,self.gtx,self.presentVFAT2sSingle[0],"ContReg0",0x37)
+        setVFATTrackingMask(self.ohboard,self.gtx, ~(0x1 << self.presentVFAT2sSingle[0]))
+
+        self.rateCurve = []
+        stepTime = self.test_params.RATE_STEP_TIME
+
+        # Coarse exponential ramp until the FIFO fills up
+        passing = 0
+        failing = None
+        rate    = self.test_params.RATE_MIN
+        while (rate <= self.test_params.RATE_MAX):
+            if (self.readoutAtRate(rate,stepTime)):
+                passing = rate
+                rate   *= 2
             else:
-                for j in range(0, 1000):
-                    depth = readFIFODepth(self.amc,self.gtx)["Occupancy"]
-                    data = readTrackingInfo(self.amc,self.gtx,1*depth/7)
-                    if ((readFIFODepth(self.amc,self.gtx)["isFULL"]) == 1):
-                        isFull = True
-                        break
+                failing = rate
+                break
+            pass
+
+        if (failing is None):
+            print "   Readout kept up up to the maximum tested rate %4d %sHz"%(rateConverter(passing))
+        elif (passing == 0):
+            print "   Readout failed already at the minimum tested rate %4d %sHz"%(rateConverter(failing))
+        else:
+            # Bisect between the last passing and the first failing rate
+            while ((failing - passing) > self.test_params.RATE_TOL * passing):
+                rate = (passing + failing) / 2
+                if (self.readoutAtRate(rate,stepTime)):
+                    passing = rate
+                else:
+                    failing = rate
                     pass
                 pass
+            pass
 
-            if (isFull):
-                print "   Maximum readout rate %4d %sHz"%(rateConverter(previous))
-                break
-
-            previous = i
-            if self.debug:
-                print "   Readout succeeded at %4d %sHz"%(rateConverter(previous))
+        # Sustained soak at the bracketed rate, backing off if it does not hold
+        while (passing > 0 and not self.readoutAtRate(passing,self.test_params.RATE_SOAK_TIME)):
+            passing = int(passing * (1. - self.test_params.RATE_TOL))
+            if (passing < self.test_params.RATE_MIN):
+                passing = 0
                 pass
+            pass
 
-            time.sleep(0.01)
+        print "   Maximum readout rate %4d %sHz"%(rateConverter(passing))
 
-        f.close()
+        if (self.test_params.RATE_FILE):
+            outF = open(self.test_params.RATE_FILE,'w')
+            outF.write('rate/I:maxOccupancy/I:meanOccupancy/D:passed/I\n')
+            for rate, maxOcc, meanOcc, passed in self.rateCurve:
+                outF.write('%i\t%i\t%f\t%i\n'%(rate, maxOcc, meanOcc, passed))
+                pass
+            outF.close()
+            pass
 
-        resetLocalT1(self.ohboard,self.gtx)
         writeVFAT(self.ohboard,self.gtx,self.presentVFAT2sSingle[0],"ContReg0",0x36)
 
+        self.maxReadoutRate = passing
         self.test["I"] = True
 
         setVFATTrackingMask(self.ohboard,self.gtx,self.vfatmask)
@@ -616,38 +674,57 @@ class GEMDAQTestSuite:
         return
 
     ####################################################
+    def runTest(self,test,*methods):
+        """
+        Runs the methods making up test, holding the shared lock for tests
+        in amcTests, and records the time taken in self.timing
+        """
+        if (self.lock is not None and test in self.amcTests):
+            self.lock.acquire()
+            pass
+        start = time.time()
+        try:
+            for method in methods:
+                method()
+                pass
+        finally:
+            self.timing[test] = time.time() - start
+            if (self.lock is not None and test in self.amcTests):
+                self.lock.release()
+                pass
+            pass
+        return
+
     def runSelectedTests(self):
         if ("A" in self.tests):
-            self.AMCPresenceTest()
+            self.runTest("A",self.AMCPresenceTest)
             pass
         if ("B" in self.tests):
-            self.OptoHybridPresenceTest()
+            self.runTest("B",self.OptoHybridPresenceTest)
             pass
         if ("C" in self.tests):
-            self.AMCRegisterTest()
+            self.runTest("C",self.AMCRegisterTest)
             pass
         if ("D" in self.tests):
-            self.OptoHybridRegisterTest()
-            self.OptoHybridT1ControllerTest()
+            self.runTest("D",self.OptoHybridRegisterTest,self.OptoHybridT1ControllerTest)
             pass
         if ("E" in self.tests):
-            self.VFAT2DetectionTest()
+            self.runTest("E",self.VFAT2DetectionTest)
             pass
         if ("F" in self.tests):
-            self.VFAT2I2CRegisterTest()
-            self.VFAT2ChannelRegisterTest()
+            self.runTest("F",self.VFAT2I2CRegisterTest,self.VFAT2ChannelRegisterTest)
             pass
         if ("G" in self.tests):
-            self.TrackingDataReadoutTest()
+            self.runTest("G",self.TrackingDataReadoutTest)
             pass
         if ("H" in self.tests):
-            self.SimultaneousTrackingDataReadoutTest()
+            self.runTest("H",self.SimultaneousTrackingDataReadoutTest)
             pass
         if ("I" in self.tests):
-            self.TrackingDataReadoutRateTest()
+            self.runTest("I",self.TrackingDataReadoutRateTest)
             pass
         if ("J" in self.tests):
-            self.OpticalLinkErrorTest()
+            self.runTest("J",self.OpticalLinkErrorTest)
             pass
         return
 
@@ -678,6 +755,121 @@ class GEMDAQTestSuite:
             pass
         return
 
+_amcLock = None
+
+def _initLinkWorker(lock):
+    global _amcLock
+    _amcLock = lock
+    return
+
+def linkTestParams(test_params, gtx):
+    """
+    Copy of test_params writing the raw tracking data and rate curve of link
+    gtx to files of their own, <rawfile>_OH<gtx>_<rate>Hz.dat and
+    <ratefile base>_OH<gtx><ext>
+    """
+    import copy
+    params = copy.copy(test_params)
+    params.RAW_FILE = "%s_OH%d"%(test_params.RAW_FILE,gtx)
+    if (test_params.RATE_FILE):
+        base, ext = os.path.splitext(test_params.RATE_FILE)
+        params.RATE_FILE = "%s_OH%d%s"%(base,gtx,ext)
+        pass
+    return params
+
+def runLinkTests(args):
+    """
+    Runs the selected tests of one link in a worker process, returns
+    (gtx, tests selected, test results, timing), a test stopping the
+    suite leaves the remaining tests marked as failed
+    """
+    slot, gtx, shelf, tests, test_params, debug = args
+    test_params = linkTestParams(test_params, gtx)
+    suite = None
+    try:
+        suite = GEMDAQTestSuite(slot=slot,
+                                gtx=gtx,
+                                shelf=shelf,
+                                tests=tests,
+                                test_params=test_params,
+                                debug=debug,
+                                lock=_amcLock)
+        suite.runSelectedTests()
+    except SystemExit:
+        print "Link %d: test suite stopped"%(gtx)
+    except Exception as e:
+        print "Link %d: caught exception %s"%(gtx,e)
+        pass
+    if suite is None:
+        return (gtx, [], {}, {})
+    return (gtx, suite.tests, suite.test, suite.timing)
+
+def runMultiLinkTests(slot,links,shelf=1,tests="",test_params=TEST_PARAMS(),debug=False):
+    """
+    Runs the selected tests on several links concurrently, one process per
+    link, serializing the tests in GEMDAQTestSuite.amcTests across links.
+    Each link writes its own raw data and rate files, see linkTestParams.
+    Returns the list of runLinkTests results ordered by link.
+    """
+    import signal
+    from multiprocessing import Lock, Pool
+
+    lock = Lock()
+    # from: https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python
+    original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pool = Pool(len(links), initializer=_initLinkWorker, initargs=(lock,))
+    signal.signal(signal.SIGINT, original_sigint_handler)
+    try:
+        # timeout must be properly set, otherwise tasks will crash
+        results = pool.map_async(runLinkTests,
+                                 [(slot, gtx, shelf, tests, test_params, debug) for gtx in links]).get(999999999)
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        print("Caught KeyboardInterrupt, terminating workers")
+        pool.terminate()
+        raise
+    return sorted(results)
+
+def reportMultiLink(results):
+    """
+    Prints the pass/fail matrix and the time taken by each test, one column per link
+    """
+    txtTitle("K. Results")
+
+    print "   Test " + "".join(["    OH%-2d"%(gtx) for gtx, tests, test, timing in results])
+    for letter in GEMDAQTestSuite.allTests:
+        row = "   %s    "%(letter)
+        for gtx, tests, test, timing in results:
+            if (letter not in tests):
+                row += "  NotRun"
+            elif (test.get(letter,False)):
+                row += "  \033[92mPassed\033[0m"
+            else:
+                row += "  \033[91mFailed\033[0m"
+                pass
+            pass
+        print row
+        pass
+
+    print
+    print "   Time taken per test [s]"
+    print "   Test " + "".join(["    OH%-2d"%(gtx) for gtx, tests, test, timing in results])
+    for letter in GEMDAQTestSuite.allTests + ["Total"]:
+        row = "   %-5s"%(letter)
+        for gtx, tests, test, timing in results:
+            if (letter == "Total"):
+                row += " %7.1f"%(sum(timing.values()))
+            elif (letter in timing):
+                row += " %7.1f"%(timing[letter])
+            else:
+                row += "       -"
+                pass
+            pass
+        print row
+        pass
+    return
+
 if __name__ == "__main__":
     from qcoptions import parser
 
@@ -691,6 +883,25 @@ if __name__ == "__main__":
                       help="Number of tracking data packets to readout (default is 1000)", metavar="ntrk", default=1000)
     parser.add_option("--writeout", action="store_true", dest="writeout",
                       help="Write the data to disk when testing the rate", metavar="writeout")
+    parser.add_option("--rawfile", type="string", dest="rawfile",
+                      help="Prefix of the raw tracking data files written with --writeout, one per rate, with _OH<link> added with --links (default is TrackingData)",
+                      metavar="rawfile", default="TrackingData")
+    parser.add_option("--rawsize", type="int", dest="rawsize",
+                      help="Number of words to preallocate in memory mapped raw data files (default is 0, use a buffered writer)",
+                      metavar="rawsize", default=0)
+    parser.add_option("--trkTimeout", type="float", dest="trkTimeout",
+                      help="Time in seconds to wait for tracking data (default is 5)", metavar="trkTimeout", default=5.)
+    parser.add_option("--rateTol", type="float", dest="rateTol",
+                      help="Relative precision of the maximum readout rate (default is 0.05)", metavar="rateTol", default=0.05)
+    parser.add_option("--rateStepTime", type="float", dest="rateStepTime",
+                      help="Time in seconds spent at each rate while searching (default is 0.5)", metavar="rateStepTime", default=0.5)
+    parser.add_option("--rateSoakTime", type="float", dest="rateSoakTime",
+                      help="Time in seconds the maximum rate must be sustained (default is 10)", metavar="rateSoakTime", default=10.)
+    parser.add_option("--rateFile", type="string", dest="rateFile",
+                      help="File to record the rate versus FIFO occupancy curve in, with _OH<link> added with --links (default is TrackingRateScan.txt)",
+                      metavar="rateFile", default="TrackingRateScan.txt")
+    parser.add_option("--links", type="string", dest="links", default=None,
+                      help="Comma separated list of links to test concurrently (default is the link given with -g)", metavar="links")
     parser.add_option("--tests", type="string", dest="tests",default="A,B,E,F",
                       help="Tests to run, default is all", metavar="tests")
     #parser.add_option("--doLatency", action="store_true", dest="doLatency",
@@ -706,14 +917,31 @@ if __name__ == "__main__":
                               noh=options.noh,
                               ni2c=options.ni2c,
                               ntrk=options.ntrk,
-                              writeout=options.writeout)
-
-    testSuite = GEMDAQTestSuite(slot=options.slot,
-                                gtx=options.gtx,
-                                shelf=options.shelf,
-                                tests=options.tests,
-                                test_params=test_params,
-                                debug=options.debug)
-
-    testSuite.runSelectedTests()
-    testSuite.report()
+                              writeout=options.writeout,
+                              trktimeout=options.trkTimeout,
+                              rawfile=options.rawfile,
+                              rawsize=options.rawsize,
+                              ratetol=options.rateTol,
+                              ratesteptime=options.rateStepTime,
+                              ratesoaktime=options.rateSoakTime,
+                              ratefile=options.rateFile)
+
+    if options.links:
+        results = runMultiLinkTests(slot=options.slot,
+                                    links=[int(link) for link in options.links.split(',')],
+                                    shelf=options.shelf,
+                                    tests=options.tests,
+                                    test_params=test_params,
+                                    debug=options.debug)
+        reportMultiLink(results)
+    else:
+        testSuite = GEMDAQTestSuite(slot=options.slot,
+                                    gtx=options.gtx,
+                                    shelf=options.shelf,
+                                    tests=options.tests,
+                                    test_params=test_params,
+                                    debug=options.debug)
+
+        testSuite.runSelectedTests()
+        testSuite.report()
+        pass
@@ -0,0 +1,226 @@
+#!/bin/env python
+"""
+Columnar HDF5/NPZ output of the scan scripts, an alternative to the ROOT
+trees of treeUtils which needs neither ROOT to read nor a loop over rows.
+
+Scan points filled as blocks are stored as arrays indexed by VFAT (and
+channel) with one entry per point, e.g. the S-curve hits as a
+24 x 128 x 255 array. Per-VFAT and per-channel constants are 24 and
+24 x 128 arrays, run constants are attributes and rows filled one at a
+time are appended to one dimensional columns. HDF5 needs h5py.
+"""
+
+import json
+import numpy as np
+
+from treeUtils import NCHAN, NVFAT, RecordBuffer, ScanTree
+
+FORMATS    = ["root", "hdf5", "npz"]
+EXTENSIONS = {"root":".root", "hdf5":".h5", "npz":".npz"}
+
+def outputName(filename, fmt):
+    """
+    filename with the extension of format fmt
+    """
+    import os
+    return os.path.splitext(filename)[0] + EXTENSIONS[fmt]
+
+def checkFormat(fmt):
+    """
+    Returns an error message if output format fmt can not be written here, None otherwise
+    """
+    if fmt not in FORMATS:
+        return "Invalid output format %s, must be one of %s"%(fmt, ",".join(FORMATS))
+    if fmt == "hdf5":
+        try:
+            import h5py
+        except ImportError:
+            return "h5py is needed to write HDF5 output"
+        pass
+    return None
+
+class ScanArrays:
+    """
+    Columnar counterpart of treeUtils.ScanTree with the same filling
+    interface. fillBlock() columns are stored at [vfatN] (or [vfatN][vfatCH]
+    when perChannel) of arrays with npoints entries per VFAT (channel),
+    initialised to -1 for points never filled.
+
+    axis is an optional (name, values) pair for the scanned column, which is
+    then stored once as the array values instead of for every VFAT (channel).
+    """
+    def __init__(self, filename, fmt, name, branches, runBranches=(), vfatBranches=(), channelBranches=(),
+                 npoints=None, perChannel=False, axis=None, compression=4):
+        self.filename = filename
+        self.fmt      = fmt
+        self.name     = name
+        self.order    = list(branches)
+        self.buffer   = RecordBuffer(self.order)
+        self.branches = dict((branch, self.buffer.field(branch)) for branch in self.order)
+        self.runBranches     = list(runBranches)
+        self.vfatBranches    = list(vfatBranches)
+        self.channelBranches = list(channelBranches)
+        sideBranches = set(runBranches) | set(vfatBranches) | set(channelBranches)
+        self.rowBranches = [branch for branch in self.order if branch not in sideBranches and
+                            branch not in ('vfatN','vfatCH')]
+        self.npoints    = npoints
+        self.blockShape = (NVFAT,NCHAN) if perChannel else (NVFAT,)
+        self.compression = compression
+
+        self.arrays  = {}
+        self.pending = {}
+        self.file    = None
+        if fmt == "hdf5":
+            import h5py
+            self.file = h5py.File(filename, 'w')
+            self.file.attrs['tree'] = name
+            pass
+        self.axis = None
+        if axis is not None:
+            self.axis = axis[0]
+            self._create(self.axis, (len(axis[1]),), 0)[:] = axis[1]
+            pass
+        for branch in self.vfatBranches:
+            self._create(branch, (NVFAT,), 0)
+            pass
+        for branch in self.channelBranches:
+            self._create(branch, (NVFAT,NCHAN), 0)
+            pass
+        return
+
+    def _create(self, name, shape, fill):
+        if self.file is not None:
+            chunks = (1,)*(len(shape)-1) + (shape[-1],)
+            self.arrays[name] = self.file.create_dataset(name, shape, dtype='i4', chunks=chunks,
+                                                         compression='gzip', compression_opts=self.compression,
+                                                         fillvalue=fill)
+        else:
+            self.arrays[name] = np.full(shape, fill, dtype='i4')
+            pass
+        return self.arrays[name]
+
+    def fill(self):
+        """
+        Appends the current row to the one dimensional columns
+        """
+        for branch in self.rowBranches + ['vfatN']:
+            self.pending.setdefault(branch, []).append(self.buffer[branch])
+            pass
+        return
+
+    def fillBlock(self, columns):
+        index = (self.buffer['vfatN'],)
+        if len(self.blockShape) > 1:
+            index += (self.buffer['vfatCH'],)
+            pass
+        for name, values in columns.items():
+            if name == self.axis: continue
+            if name not in self.arrays:
+                self._create(name, self.blockShape + (self.npoints,), -1)
+                pass
+            values = np.asarray(values)[:self.npoints]
+            self.arrays[name][index + (slice(0,len(values)),)] = values
+            pass
+        return
+
+    def fillVFAT(self):
+        vfat = self.buffer['vfatN']
+        for branch in self.vfatBranches:
+            self.arrays[branch][vfat] = self.buffer[branch]
+            pass
+        return
+
+    def fillChannel(self):
+        vfat, chan = self.buffer['vfatN'], self.buffer['vfatCH']
+        for branch in self.channelBranches:
+            self.arrays[branch][vfat,chan] = self.buffer[branch]
+            pass
+        return
+
+    def _flushRows(self):
+        for name, values in self.pending.items():
+            values = np.asarray(values, dtype='i4')
+            if self.file is not None:
+                if name not in self.arrays:
+                    self.arrays[name] = self.file.create_dataset(name, (0,), dtype='i4', maxshape=(None,),
+                                                                 chunks=(4096,), compression='gzip',
+                                                                 compression_opts=self.compression)
+                    pass
+                column = self.arrays[name]
+                column.resize((len(column)+len(values),))
+                column[-len(values):] = values
+            else:
+                self.arrays[name] = np.concatenate((self.arrays.get(name, np.zeros(0, dtype='i4')), values))
+                pass
+            pass
+        self.pending = {}
+        return
+
+    def attrs(self):
+        return dict((branch, int(self.buffer[branch])) for branch in self.runBranches)
+
+    def autoSave(self):
+        self._flushRows()
+        if self.file is not None:
+            self.file.attrs.update(self.attrs())
+            self.file.flush()
+            pass
+        return
+
+    def write(self):
+        self.close()
+        return
+
+    def close(self):
+        self._flushRows()
+        if self.file is not None:
+            self.file.attrs.update(self.attrs())
+            self.file.close()
+            self.file = None
+        elif self.fmt == "npz":
+            attrs = self.attrs()
+            attrs['tree'] = self.name
+            np.savez_compressed(self.filename, attrs=np.array(json.dumps(attrs)), **self.arrays)
+            pass
+        return
+
+def openScanOutput(filename, fmt, name, title, branches, runBranches=(), vfatBranches=(), channelBranches=(),
+                   compact=False, npoints=None, perChannel=False, axis=None):
+    """
+    ScanTree writing filename for format root, otherwise ScanArrays writing
+    filename with the extension of fmt
+    """
+    if fmt == "root":
+        return ScanTree(name, title, branches, runBranches, vfatBranches, channelBranches,
+                        compact=compact, filename=filename)
+    return ScanArrays(outputName(filename, fmt), fmt, name, branches, runBranches, vfatBranches, channelBranches,
+                      npoints=npoints, perChannel=perChannel, axis=axis)
+
+class ScanArrayData:
+    """
+    Read access to a file written by ScanArrays, data[name] is the array
+    name (an h5py dataset, sliced without reading the rest of the file, for
+    HDF5) and attrs holds the run constants
+    """
+    def __init__(self, filename):
+        if filename.endswith(EXTENSIONS["npz"]):
+            self.file  = np.load(filename)
+            self.attrs = json.loads(str(self.file['attrs']))
+            self.names = [name for name in self.file.files if name != 'attrs']
+        else:
+            import h5py
+            self.file  = h5py.File(filename, 'r')
+            self.attrs = dict(self.file.attrs)
+            self.names = list(self.file.keys())
+            pass
+        return
+
+    def __getitem__(self, name):
+        return self.file[name]
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def close(self):
+        self.file.close()
+        return
@@ -12,20 +12,27 @@ envCheck('CONFIG_PATH')
 envCheck('BUILD_HOME')
 
 def launchScurveScan(link,ztrim,cName,cType):
-  import ROOT as r
+  import numpy as np
+  from cubeUtils import openSCurveCube
+  from treeUtils import readScanTree
   buildPath = os.getenv('BUILD_HOME')
   dataPath = os.getenv('DATA_PATH')
   configPath = os.getenv('CONFIG_PATH')
-  trimFile = r.TFile( '%s/%s/trim/z%f/config/SCurveData_Trimmed.root'%(dataPath,cName,ztrim) )
-  trimRange = {}
+  trimFile = '%s/%s/trim/z%f/config/SCurveData_Trimmed.root'%(dataPath,cName,ztrim)
+  cube = openSCurveCube(trimFile)
+  if cube is not None:
+    vfatN, vfatCH = np.nonzero(cube.scanned())
+    trimDAC = np.array(cube.trimDAC[vfatN,vfatCH])
+    cube.close()
+  else:
+    trimData = readScanTree( trimFile, 'scurveTree', ['vfatN','vfatCH','vcal','trimDAC'] )
+    trimData = trimData[trimData['vcal'] == 10]
+    vfatN, vfatCH, trimDAC = trimData['vfatN'], trimData['vfatCH'], trimData['trimDAC']
   outTrimFile = open('%s/chConf%s.txt'%(configPath,cName),'w')
   outTrimFile.write('vfatN\I:vfatCH\I:trimDAC\I\n')
-  for event in trimFile.scurveTree :
-    if event.vcal == 10 :
-      outTrimFile.write('%i\t%i\t%i\n'%(int(event.vfatN),int(event.vfatCH),int(event.trimDAC)))
-      if event.vfatCH == 10 : trimRange[int(event.vfatN)] = int(event.trimRange)
+  for vfat, ch, trim in zip(vfatN, vfatCH, trimDAC):
+    outTrimFile.write('%i\t%i\t%i\n'%(int(vfat),int(ch),int(trim)))
   outTrimFile.close()
-  trimFile.Close()
   os.system( 'cp %s/%s/threshold/config/ThresholdScanData/ThresholdByVFAT.txt %s/vthConf%s.txt'%(dataPath,cName,configPath,cName) )
 
 ztrim = options.ztrim
@@ -0,0 +1,202 @@
+#!/bin/env python
+"""
+SQLite store of VFAT calibrations keyed by chip ID instead of by chamber
+and slot, so that a VFAT keeps its calibration when it is moved to another
+slot or link. Each trim adds one row per chip to trims, holding the
+trimRange and the per-channel trimDAC and mask as compact 128 byte arrays,
+and per-VFAT DAC values are added to dacs. Configuring a chamber reads the
+chip IDs of its slots and takes the latest calibration of each chip.
+
+The store is $DATA_PATH/calibrationStore.sqlite unless given otherwise.
+"""
+
+import json, os, sqlite3, time
+import numpy as np
+
+from maskUtils import MISSING_CHIPIDS
+
+STORE_NAME = "calibrationStore.sqlite"
+
+NVFAT = 24
+NCHAN = 128
+
+def storePath(dataPath=None):
+    """
+    Store file in dataPath (default $DATA_PATH), None if there is no data path
+    """
+    if dataPath is None:
+        dataPath = os.getenv('DATA_PATH')
+        pass
+    if not dataPath:
+        return None
+    return os.path.join(dataPath, STORE_NAME)
+
+class CalibrationStore:
+    """
+    SQLite store of the trims (one row per chip and trim) and per-VFAT DAC
+    values (one row per chip, DAC and measurement) of each VFAT chip ID
+    """
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS trims (
+                id INTEGER PRIMARY KEY,
+                chipID INTEGER,
+                time REAL,
+                ztrim REAL,
+                trimRange INTEGER,
+                trimVcal REAL,
+                trimDAC BLOB,
+                chanMask BLOB,
+                chamber TEXT,
+                link INTEGER,
+                vfat INTEGER,
+                source TEXT);
+            CREATE INDEX IF NOT EXISTS trimsByChip ON trims (chipID, ztrim, time);
+            CREATE TABLE IF NOT EXISTS dacs (
+                id INTEGER PRIMARY KEY,
+                chipID INTEGER,
+                time REAL,
+                name TEXT,
+                value INTEGER,
+                chamber TEXT,
+                link INTEGER,
+                vfat INTEGER,
+                source TEXT);
+            CREATE INDEX IF NOT EXISTS dacsByChip ON dacs (chipID, name, time);
+            """)
+        return
+
+    def addTrim(self, chipID, trimRange, trimDAC, chanMask, ztrim, trimVcal=None,
+                chamber=None, link=None, vfat=None, source=None, when=None):
+        """
+        Adds the trim of chip chipID, trimDAC and chanMask hold the 128
+        channel trimDACs and mask bits
+        """
+        trimDAC  = np.asarray(trimDAC, dtype=np.uint8).reshape(NCHAN)
+        chanMask = np.asarray(chanMask, dtype=np.uint8).reshape(NCHAN)
+        with self.db:
+            self.db.execute("""INSERT INTO trims (chipID, time, ztrim, trimRange, trimVcal, trimDAC, chanMask,
+                                                  chamber, link, vfat, source)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                            (int(chipID), when if when is not None else time.time(), float(ztrim),
+                             int(trimRange), None if trimVcal is None else float(trimVcal),
+                             sqlite3.Binary(trimDAC.tostring()), sqlite3.Binary(chanMask.tostring()),
+                             chamber, link, vfat, source))
+            pass
+        return
+
+    def addDAC(self, chipID, name, value, chamber=None, link=None, vfat=None, source=None, when=None):
+        """
+        Adds the value of the per-VFAT register name of chip chipID
+        """
+        with self.db:
+            self.db.execute("""INSERT INTO dacs (chipID, time, name, value, chamber, link, vfat, source)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                            (int(chipID), when if when is not None else time.time(), name, int(value),
+                             chamber, link, vfat, source))
+            pass
+        return
+
+    def addTrimConfig(self, chipIDs, config, chanMask, ztrim, vfatmask=0x0,
+                      chamber=None, link=None, source=None):
+        """
+        Adds the trimUtils.TrimConfig config of every VFAT not in vfatmask
+        with a chip ID in chipIDs (indexed by VFAT), with the VThreshold1 it
+        was trimmed at if known, chanMask holds the mask bits as [vfat][ch].
+        Returns the number of chips added.
+        """
+        when   = time.time()
+        nAdded = 0
+        for vfat in range(0,NVFAT):
+            if (vfatmask >> vfat) & 0x1 or chipIDs[vfat] in MISSING_CHIPIDS: continue
+            self.addTrim(chipIDs[vfat], config.tRange[vfat], config.trimDAC[vfat], chanMask[vfat], ztrim,
+                         trimVcal=config.trimVcal[vfat], chamber=chamber, link=link, vfat=vfat,
+                         source=source, when=when)
+            if config.vt1[vfat] >= 0:
+                self.addDAC(chipIDs[vfat], "VThreshold1", config.vt1[vfat], chamber=chamber, link=link,
+                            vfat=vfat, source=source, when=when)
+                pass
+            nAdded += 1
+            pass
+        return nAdded
+
+    def trim(self, chipID, ztrim=None):
+        """
+        Latest trim of chip chipID (at ztrim if given) as a dict of its
+        columns with trimDAC and chanMask as arrays, None if there is none
+        """
+        sql  = "SELECT * FROM trims WHERE chipID = ?"
+        args = [int(chipID)]
+        if ztrim is not None:
+            sql += " AND ABS(ztrim - ?) < 1e-6"
+            args.append(float(ztrim))
+            pass
+        row = self.db.execute(sql + " ORDER BY time DESC LIMIT 1", args).fetchone()
+        if row is None:
+            return None
+        trim = dict(row)
+        trim["trimDAC"]  = np.frombuffer(bytes(row["trimDAC"]), dtype=np.uint8).astype(int)
+        trim["chanMask"] = np.frombuffer(bytes(row["chanMask"]), dtype=np.uint8).astype(bool)
+        return trim
+
+    def dacs(self, chipID):
+        """
+        Latest value of each DAC stored for chip chipID, as a dict
+        """
+        rows = self.db.execute("""SELECT name, value FROM dacs WHERE chipID = ? ORDER BY time""", (int(chipID),))
+        return dict((row["name"], row["value"]) for row in rows)
+
+    def history(self, chipID=None):
+        """
+        Trims of chip chipID (of every chip if None), newest first, without
+        their channel arrays
+        """
+        sql  = "SELECT id, chipID, time, ztrim, trimRange, trimVcal, chamber, link, vfat, source FROM trims"
+        args = []
+        if chipID is not None:
+            sql += " WHERE chipID = ?"
+            args.append(int(chipID))
+            pass
+        return [dict(row) for row in self.db.execute(sql + " ORDER BY time DESC", args)]
+
+    def close(self):
+        self.db.close()
+        return
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] [chipID ...]")
+    parser.add_option("--store", type="string", dest="store", default=None,
+                      help="Store file (default is $DATA_PATH/%s)"%(STORE_NAME), metavar="store")
+
+    (options, args) = parser.parse_args()
+
+    store = options.store
+    if store is None:
+        store = storePath()
+        pass
+    if store is None:
+        print "No store given and DATA_PATH is not set"
+        exit(1)
+        pass
+    calStore = CalibrationStore(store)
+
+    chipIDs = [int(arg, 0) for arg in args] if len(args) > 0 else [None]
+    for chipID in chipIDs:
+        for trim in calStore.history(chipID):
+            print "0x%04x  %s  z %.1f  trimRange %d  %-12s link %-2s VFAT %-2s %s"%(trim["chipID"],
+                                                                                   time.strftime("%Y.%m.%d.%H.%M", time.localtime(trim["time"])),
+                                                                                   trim["ztrim"], trim["trimRange"], trim["chamber"],
+                                                                                   trim["link"], trim["vfat"], trim["source"])
+            pass
+        if chipID is not None:
+            dacs = calStore.dacs(chipID)
+            if len(dacs) > 0:
+                print "0x%04x  DACs %s"%(chipID, json.dumps(dacs, sort_keys=True))
+                pass
+            pass
+        pass
+    calStore.close()
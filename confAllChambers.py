@@ -3,7 +3,7 @@
 def launch(args):
   return launchArgs(*args)
 
-def launchArgs(shelf,link,slot,run,vt1,vt1bump,config,cName,ztrim):
+def launchArgs(shelf,link,slot,run,vt1,vt1bump,config,cName,ztrim,fromStore=False):
     import datetime,os,sys
     from subprocess import CalledProcessError
     from mapping.chamberInfo import chamber_config
@@ -18,7 +18,12 @@ def launchArgs(shelf,link,slot,run,vt1,vt1bump,config,cName,ztrim):
         cmd.append("--run")
         pass
 
-    if config:
+    if fromStore:
+        cmd.append("--fromStore")
+        cmd.append("--ztrim=%f"%(ztrim))
+        cmd.append("--vt1bump=%d"%(vt1bump))
+        pass
+    elif config:
         cmd.append("--vt1bump=%d"%(vt1bump))
         cmd.append("--vfatConfig=%s/configs/z%.1f/vfatConfig_%s.txt"%(dataPath,ztrim,cName))
         cmd.append("--chConfig=%s/configs/z%.1f/chConfig_%s.txt"%(dataPath,ztrim,cName))
@@ -52,6 +57,8 @@ if __name__ == '__main__':
 
     parser.add_option("--config", action="store_true", dest="config",
                       help="Set Configuration from simple txt files", metavar="config")
+    parser.add_option("--fromStore", action="store_true", dest="fromStore",
+                      help="Configure each VFAT from the calibration store by chip ID", metavar="fromStore")
     parser.add_option("--run", action="store_true", dest="run",
                       help="Set VFATs to run mode", metavar="run")
     parser.add_option("--series", action="store_true", dest="series",
@@ -76,6 +83,7 @@ if __name__ == '__main__':
                         [options.config    for x in range(len(chamber_config))],
                         [chamber_config[x] for x in chamber_config.keys()],
                         [options.ztrim     for x in range(len(chamber_config))],
+                        [options.fromStore for x in range(len(chamber_config))],
                   )
             )
         pass
@@ -83,7 +91,7 @@ if __name__ == '__main__':
         print "Configuring chambers in serial mode"
         for link in chamber_config.keys():
             chamber = chamber_config[link]
-            launchArgs(options.shelf,link,options.slot,options.run,options.vt1,options.vt1bump,options.config,chamber,options.ztrim)
+            launchArgs(options.shelf,link,options.slot,options.run,options.vt1,options.vt1bump,options.config,chamber,options.ztrim,options.fromStore)
             pass
         pass
     else:
@@ -103,6 +111,7 @@ if __name__ == '__main__':
                                                 [options.config    for x in range(len(chamber_config))],
                                                 [chamber_config[x] for x in chamber_config.keys()],
                                                 [options.ztrim     for x in range(len(chamber_config))],
+                                                [options.fromStore for x in range(len(chamber_config))],
                                                 )
                                  )
             # timeout must be properly set, otherwise tasks will crash
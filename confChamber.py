@@ -10,10 +10,14 @@ from gempython.tools.vfat_user_functions_uhal import *
 from mapping.chamberInfo import chamber_vfatDACSettings
 from qcoptions import parser
 
+parser.add_option("--calStore", type="string", dest="calStore", default=None,
+                  help="Calibration store used by --fromStore (default is $DATA_PATH/calibrationStore.sqlite)", metavar="calStore")
 parser.add_option("--chConfig", type="string", dest="chConfig", default=None,
                   help="Specify file containing channel settings from anaUltraSCurve", metavar="chConfig")
 parser.add_option("--filename", type="string", dest="filename", default=None,
                   help="Specify file containing settings information", metavar="filename")
+parser.add_option("--fromStore", action="store_true", dest="fromStore",
+                  help="Configure each VFAT with the latest calibration of its chip ID at ztrim from the calibration store", metavar="fromStore")
 parser.add_option("--run", action="store_true", dest="run",
                   help="Set VFATs to run mode", metavar="run")
 parser.add_option("--vfatConfig", type="string", dest="vfatConfig", default=None,
@@ -97,4 +101,35 @@ if options.vfatConfig:
         print '%s does not seem to exist'%options.filename
         print e
 
+if options.fromStore:
+    try:
+        from calibrationStore import CalibrationStore, storePath
+        from maskUtils import MISSING_CHIPIDS
+        from registerUtils import writeChannelRegisters
+        calStore = CalibrationStore(options.calStore if options.calStore else storePath())
+        print 'Configuring VFATs by chip ID from the calibration store'
+        chipIDs = getAllChipIDs(ohboard, options.gtx)
+        for vfat in range(0,24):
+            chipID = chipIDs[vfat]
+            if chipID in MISSING_CHIPIDS: continue
+            trim = calStore.trim(chipID, options.ztrim)
+            if trim is None:
+                print 'No calibration of chip 0x%04x (link %d VFAT%d) at z = %f'%(chipID,options.gtx,vfat,options.ztrim)
+                continue
+            print 'Configuring link %d VFAT%d with the trim of chip 0x%04x taken on %s link %s VFAT%s'%(options.gtx,vfat,chipID,
+                                                                                                    trim["chamber"],trim["link"],trim["vfat"])
+            writeVFAT(ohboard, options.gtx, vfat, "ContReg3", int(trim["trimRange"]),0)
+            writeChannelRegisters(ohboard, options.gtx, [vfat], (trim["trimDAC"] + 32*trim["chanMask"]).reshape(1,128))
+            for name, value in calStore.dacs(chipID).items():
+                if name == "VThreshold1":
+                    value += options.vt1bump
+                    pass
+                writeVFAT(ohboard, options.gtx, vfat, name, int(value),0)
+                pass
+            pass
+        calStore.close()
+    except Exception as e:
+        print 'Unable to configure from the calibration store'
+        print e
+
 print 'Chamber Configured'
@@ -0,0 +1,156 @@
+#!/bin/env python
+"""
+Fixed layout S-curve cube written next to the ROOT file of an S-curve
+scan, holding the hit counts as [vfat][ch][vcal] in a memory mapped file
+which is updated in place as each channel completes, so that any
+VFAT/channel slice can be read without ROOT or a loop over the tree.
+
+The file is a single record: a header with the scan parameters, the
+per-VFAT trimRange and vthr, the per-channel trimDAC and Nev (0 until the
+channel has been scanned) and the hits, -1 for points not read out.
+"""
+
+import os
+import numpy as np
+
+from treeUtils import NCHAN, NVFAT
+
+CUBE_MAGIC   = "GEMSCUBE"
+CUBE_VERSION = 1
+CUBE_SUFFIX  = ".cube"
+
+HEADER_DTYPE = np.dtype([('magic','S8'), ('version','<u4'), ('nvfat','<u4'), ('nchan','<u4'),
+                         ('npoints','<u4'), ('scanmin','<i4'), ('nevts','<i4'), ('link','<i4'),
+                         ('mask','<u4'), ('utime','<i8'), ('mspl','<i4'), ('latency','<i4'),
+                         ('pDel','<i4'), ('calPhase','<i4'), ('l1aTime','<i4')])
+
+def cubeDtype(npoints, nvfat=NVFAT, nchan=NCHAN):
+    """
+    Record type of a cube with npoints scan points per channel
+    """
+    return np.dtype([('header',HEADER_DTYPE),
+                     ('trimRange','<i4',(nvfat,)), ('vthr','<i4',(nvfat,)),
+                     ('trimDAC','<i4',(nvfat,nchan)), ('Nev','<i4',(nvfat,nchan)),
+                     ('hits','<i4',(nvfat,nchan,npoints))])
+
+def cubePath(filename):
+    """
+    Location of the cube of the S-curve file filename
+    """
+    return os.path.splitext(filename)[0] + CUBE_SUFFIX
+
+class SCurveCube:
+    """
+    Memory mapped S-curve cube, created by mode 'w+' (with npoints and the
+    header values in params) or opened read only ('r') or for update ('r+').
+
+    The fields of the record are available as attributes viewing the file
+    (header is a record of HEADER_DTYPE), e.g. cube.hits[vfat,ch]. Called
+    as cube(scCH, scanData) it stores channel scCH of an
+    scanUtils.SCurveScanData and flushes it, so that it can be passed as
+    the callback of scanUtils.scurveScan.
+    """
+    def __init__(self, filename, mode='r', npoints=None, mask=0x0, **params):
+        self.filename = filename
+        self.mask     = mask
+        if mode == 'w+':
+            self.array = np.memmap(filename, dtype=cubeDtype(npoints), mode='w+', shape=(1,))
+            header = self.array['header']
+            header['magic']   = CUBE_MAGIC
+            header['version'] = CUBE_VERSION
+            header['nvfat']   = NVFAT
+            header['nchan']   = NCHAN
+            header['npoints'] = npoints
+            header['mask']    = mask
+            for name, value in params.items():
+                header[name] = value
+                pass
+            self.array['hits'] = -1
+            self.array.flush()
+        else:
+            header = np.fromfile(filename, dtype=HEADER_DTYPE, count=1)
+            if len(header) == 0 or header[0]['magic'] != CUBE_MAGIC:
+                raise ValueError("%s is not an S-curve cube"%(filename))
+            if header[0]['version'] != CUBE_VERSION:
+                raise ValueError("%s has cube version %d, expected %d"%(filename, header[0]['version'], CUBE_VERSION))
+            header = header[0]
+            dtype  = cubeDtype(int(header['npoints']), int(header['nvfat']), int(header['nchan']))
+            self.array = np.memmap(filename, dtype=dtype, mode=mode, shape=(1,))
+            pass
+        self.header    = self.array['header'][0]
+        self.trimRange = self.array['trimRange'][0]
+        self.vthr      = self.array['vthr'][0]
+        self.trimDAC   = self.array['trimDAC'][0]
+        self.Nev       = self.array['Nev'][0]
+        self.hits      = self.array['hits'][0]
+        return
+
+    def vcal(self):
+        """
+        Scan values of the last axis of hits
+        """
+        return np.arange(self.header['npoints']) + self.header['scanmin']
+
+    def scanned(self):
+        """
+        [vfat][ch] mask of the channels stored so far
+        """
+        return self.Nev > 0
+
+    def __call__(self, scCH, scanData):
+        self.fillChannel(scCH, scanData)
+        return
+
+    def fillChannel(self, scCH, scanData):
+        from scanUtils import decodeUltraData
+        for vfat in range(0,NVFAT):
+            if (self.mask >> vfat) & 0x1: continue
+            vals, hits = decodeUltraData(scanData.words[vfat,scCH])
+            self.trimRange[vfat]    = scanData.trimRange[vfat]
+            self.vthr[vfat]         = scanData.vthr[vfat]
+            self.trimDAC[vfat,scCH] = scanData.trimDAC[vfat][scCH]
+            self.hits[vfat,scCH]    = np.where(hits >= 0, hits, -1)
+            self.Nev[vfat,scCH]     = scanData.nevts
+            pass
+        self.flush()
+        return
+
+    def flush(self):
+        if self.array.mode != 'r':
+            self.array.flush()
+            pass
+        return
+
+    def close(self):
+        self.flush()
+        if self.array.mode != 'r':
+            # Stamped after the ROOT file is closed, see openSCurveCube
+            os.utime(self.filename, None)
+            pass
+        del self.array, self.header, self.trimRange, self.vthr, self.trimDAC, self.Nev, self.hits
+        return
+
+def currentCubePath(filename):
+    """
+    Location of the cube of the S-curve file filename if it was written with
+    filename, None if there is none or it is older than filename
+    """
+    path = cubePath(filename)
+    if not os.path.isfile(path):
+        return None
+    if os.path.isfile(filename) and os.path.getmtime(path) < os.path.getmtime(filename):
+        return None
+    return path
+
+def openSCurveCube(filename):
+    """
+    Read only SCurveCube of the S-curve file filename, None if it has no cube
+    or if its cube is older than filename and so left over from an earlier scan
+    """
+    path = currentCubePath(filename)
+    if path is None:
+        if os.path.isfile(cubePath(filename)):
+            print "Ignoring %s, it is older than %s"%(cubePath(filename), filename)
+            pass
+        return None
+    return SCurveCube(path)
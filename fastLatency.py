@@ -6,10 +6,13 @@ By: Jared Sturdy  (sturdy@cern.ch)
 """
 
 import sys
-from array import array
 from gempython.tools.vfat_user_functions_uhal import *
 
-from qcoptions import parser
+from qcoptions import parser, addAutoMaskOptions, addCompactOption, addFormatOption
+addAutoMaskOptions(parser)
+addCompactOption(parser)
+addFormatOption(parser)
+from scanCatalog import ScanMetadata
 
 parser.add_option("--filename", type="string", dest="filename", default="LatencyData.root",
                   help="Specify Output Filename", metavar="filename")
@@ -30,35 +33,31 @@ if options.debug:
 else:
     uhal.setLogLevelTo( uhal.LogLevel.ERROR )
 
-from ROOT import TFile,TTree
-filename = options.filename
-myF = TFile(filename,'recreate')
-myT = TTree('latencyTree','Tree Holding CMS GEM Latency Data')
-
-Dly = array( 'i', [ -1 ] )
-myT.Branch( 'Dly', Dly, 'Dly/I' )
-vfatN = array( 'i', [ -1 ] )
-myT.Branch( 'vfatN', vfatN, 'vfatN/I' )
-vth = array( 'i', [ 0 ] )
-myT.Branch( 'vth', vth, 'vth/I' )
-vth1 = array( 'i', [ 0 ] )
-myT.Branch( 'vth1', vth1, 'vth1/I' )
-vth2 = array( 'i', [ 0 ] )
-myT.Branch( 'vth2', vth2, 'vth2/I' )
-mspl = array( 'i', [ -1 ] )
-myT.Branch( 'mspl', mspl, 'mspl/I' )
-link = array( 'i', [ -1 ] )
-myT.Branch( 'link', link, 'link/I' )
-link[0] = options.gtx
-utime = array( 'i', [ 0 ] )
-myT.Branch( 'utime', utime, 'utime/I' )
+from arrayUtils import checkFormat, openScanOutput, outputName
+from maskUtils import scanMask
+
+if checkFormat(options.format):
+    print checkFormat(options.format)
+    exit(1)
+
+filename = outputName(options.filename,options.format)
+outTree = openScanOutput(filename, options.format, 'latencyTree','Tree Holding CMS GEM Latency Data',
+                         ['Dly','vfatN','vth','vth1','vth2','mspl','link','utime'],
+                         runBranches=['link','utime'],
+                         vfatBranches=['vth','vth1','vth2','mspl'],
+                         compact=options.compact)
+outData = outTree.buffer
+outData.set(Dly=-1, vfatN=-1, mspl=-1, link=options.gtx)
 
 import time
-utime[0] = int(time.time())
+outData['utime'] = int(time.time())
 
 ohboard      = getOHObject(options.slot,options.gtx,options.shelf,options.debug)
 seenTriggers = 0
-mask         = 0
+mask         = scanMask(ohboard, options, mask=0)
+
+metadata = ScanMetadata(filename, "fastLatency.py", options, ohboard=ohboard, link=options.gtx, mask=mask)
+status   = "ok"
 
 try:
     print "Setting trigger source"
@@ -99,20 +98,17 @@ try:
                     sys.stdout.flush()
                     seenTriggers += 1
                     pass
-                Dly[0]   = dlyValue
-                vfatN[0] = vfat
-                mspl[0]  = msplvals[vfat]
-                vth1[0]  = vt1vals[vfat]
-                vth2[0]  = vt2vals[vfat]
-                vth[0]   = vthvals[vfat]
+                outData.set(Dly=dlyValue, vfatN=vfat, mspl=msplvals[vfat],
+                            vth1=vt1vals[vfat], vth2=vt2vals[vfat], vth=vthvals[vfat])
+                outTree.fillVFAT()
                 writeRegister(ohboard,"%s.VFAT%d_LAT_BX.RESET"%(baseNode,vfat),0x1)
-                myT.Fill()
+                outTree.fill()
                 pass
             if (seenTriggers%100 == 0):
                 print "Saw %d triggers"%(seenTriggers)
                 pass
             pass
-        myT.AutoSave("SaveSelf")
+        outTree.autoSave()
         sys.stdout.flush()
         if seenTriggers > options.nevts:
             print "Saw %d triggers, exiting"%(seenTriggers)
@@ -120,11 +116,11 @@ try:
             break
 
 except Exception as e:
-    myT.AutoSave("SaveSelf")
+    outTree.autoSave()
+    status = "failed"
     print "An exception occurred", e
     sys.stdout.flush()
 finally:
-    myF.cd()
-    myT.Write()
-    myF.Close()
+    outTree.close()
+    metadata.finish(status)
 
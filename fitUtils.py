@@ -0,0 +1,680 @@
+#!/bin/env python
+"""
+Utilities to fit S-curve data held in memory as numpy arrays
+
+The fit summary returned by fitSCurves has the same layout as the one
+returned by fitting.fitScanData, i.e. [mean, sigma, ped, chi2, ndf] with
+each entry indexed as [vfat][ch].
+"""
+
+import hashlib, os
+import numpy as np
+
+NVFAT   = 24
+NCHAN   = 128
+NPOINTS = 256
+
+SQRT2   = np.sqrt(2.)
+SQRT2PI = np.sqrt(2.*np.pi)
+
+def erf(x):
+    """
+    Vectorised error function (Abramowitz & Stegun 7.1.26, |error| < 1.5e-7)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    a = np.abs(x)
+    t = 1./(1. + 0.3275911*a)
+    poly = ((((1.061405429*t - 1.453152027)*t + 1.421413741)*t - 0.284496736)*t + 0.254829592)*t
+    return np.sign(x)*(1. - poly*np.exp(-a*a))
+
+def scurveModel(x, mean, sigma, nev):
+    """
+    Expected number of hits at scan point x for a channel with the given mean and sigma
+    """
+    return 0.5*nev*(1. + erf((x - mean)/(SQRT2*sigma)))
+
+def _broadcastInputs(x, hits, nev, valid):
+    """
+    Broadcasts the fit inputs to the shape of hits, nev is per scan point
+    if it has as many dimensions as hits and per curve otherwise
+    """
+    hits  = np.asarray(hits, dtype=np.float64)
+    x     = np.broadcast_to(np.asarray(x, dtype=np.float64), hits.shape)
+    nev   = np.asarray(nev, dtype=np.float64)
+    if nev.ndim < hits.ndim:
+        nev = np.broadcast_to(nev, hits.shape[:-1])[...,None]
+        pass
+    nev   = np.broadcast_to(nev, hits.shape)
+    if valid is None:
+        valid = hits >= 0
+        pass
+    valid = np.broadcast_to(np.asarray(valid, dtype=bool), hits.shape) & (nev > 0)
+    return x, hits, nev, valid
+
+def estimateSCurveParams(x, hits, nev, valid=None):
+    """
+    Moment estimates of the S-curve mean and sigma taken from the derivative
+    of the hit fraction along the last axis. Curves without a turn-on are
+    returned as nan.
+    """
+    x, hits, nev, valid = _broadcastInputs(x, hits, nev, valid)
+
+    frac = np.where(valid, np.clip(hits/np.maximum(nev,1.), 0., 1.), 0.)
+    dp   = np.diff(frac, axis=-1)
+    dp   = np.where(valid[...,1:] & valid[...,:-1], np.clip(dp, 0., None), 0.)
+    xmid = 0.5*(x[...,1:] + x[...,:-1])
+
+    norm = dp.sum(axis=-1)
+    hasTurnOn = norm > 0
+    norm = np.where(hasTurnOn, norm, 1.)
+    mean = (xmid*dp).sum(axis=-1)/norm
+    var  = (((xmid - mean[...,None])**2)*dp).sum(axis=-1)/norm
+    sigma = np.sqrt(np.maximum(var, 0.))
+
+    mean  = np.where(hasTurnOn, mean, np.nan)
+    sigma = np.where(hasTurnOn, sigma, np.nan)
+    return mean, sigma
+
+def _chi2(x, y, w, nev, mean, sigma):
+    res = y - scurveModel(x, mean[...,None], sigma[...,None], nev)
+    return (w*res*res).sum(axis=-1)
+
+def _weights(hits, nev, valid):
+    y  = np.where(valid, hits, 0.)
+    yc = np.clip(y, 0., nev)
+    return y, np.where(valid, 1./(yc*(nev - yc)/np.maximum(nev,1.) + 1.), 0.)
+
+def _pedestal(x, y, valid, mean, sigma):
+    below  = valid & (x < (mean - 3*sigma)[...,None])
+    nBelow = below.sum(axis=-1)
+    return np.where(nBelow > 0, np.where(below, y, 0.).sum(axis=-1)/np.maximum(nBelow,1), 0.)
+
+def estimateSCurves(x, hits, nev, valid=None):
+    """
+    The moment estimates of estimateSCurveParams in the layout of the fit
+    summary of fitSCurves, [mean, sigma, ped, chi2, ndf], with the chi2 of
+    the estimated curve. Takes a single pass over the data, for when the
+    thresholds are needed as the scan runs rather than to fit precision.
+    """
+    x, hits, nev, valid = _broadcastInputs(x, hits, nev, valid)
+    y, w    = _weights(hits, nev, valid)
+    nPoints = valid.sum(axis=-1)
+
+    mean, sigma = estimateSCurveParams(x, hits, nev, valid)
+    estOK = np.isfinite(mean) & np.isfinite(sigma) & (sigma > 0) & (nPoints > 2)
+    mean  = np.where(estOK, mean, 0.)
+    sigma = np.where(estOK, sigma, 1.)
+    chi2  = _chi2(x, y, w, np.where(estOK[...,None], nev, 0.), mean, sigma)
+    ped   = _pedestal(x, y, valid, mean, sigma)
+
+    sigma = np.where(estOK, sigma, 0.)
+    chi2  = np.where(estOK, chi2, 0.)
+    ped   = np.where(estOK, ped, 0.)
+    ndf   = np.where(estOK, nPoints - 2, 0)
+    return [mean, sigma, ped, chi2, ndf]
+
+def fitSCurves(x, hits, nev, seed=None, valid=None, maxIter=50, tol=1e-3):
+    """
+    Fits every curve along the last axis of hits simultaneously with a
+    damped Gauss-Newton (Levenberg-Marquardt) minimisation of the binomial chi2
+
+    x     - scan values, broadcastable to hits
+    hits  - number of hits at each scan point, negative entries are ignored
+    nev   - number of triggers sent per scan point, broadcastable to hits.shape[:-1],
+            or to hits.shape if it differs from point to point
+    seed  - optional (mean, sigma) pair used as the starting point wherever it is finite
+            and agrees with the moment estimates of estimateSCurveParams (mean within
+            2 sigma, sigma within a factor 2), otherwise the moment estimates are used
+    valid - optional mask of the scan points to use
+
+    Returns [mean, sigma, ped, chi2, ndf], channels which could not be fit have ndf = 0
+    """
+    x, hits, nev, valid = _broadcastInputs(x, hits, nev, valid)
+    shape = hits.shape[:-1]
+
+    y, w    = _weights(hits, nev, valid)
+    nPoints = valid.sum(axis=-1)
+
+    mean, sigma = estimateSCurveParams(x, hits, nev, valid)
+    # only curves going from no hits to hits can be fit, whatever the seed
+    turnOn = (np.isfinite(mean) & (valid & (hits > 0)).any(axis=-1) &
+              (valid & (hits < nev)).any(axis=-1))
+    if seed is not None:
+        seedMean  = np.broadcast_to(np.asarray(seed[0], dtype=np.float64), shape)
+        seedSigma = np.broadcast_to(np.asarray(seed[1], dtype=np.float64), shape)
+        with np.errstate(invalid='ignore'):
+            useSeed = (np.isfinite(seedMean) & np.isfinite(seedSigma) & (seedSigma > 0) & turnOn &
+                       (np.abs(seedMean - mean) <= 2.*sigma) & (seedSigma >= 0.5*sigma) & (seedSigma <= 2.*sigma))
+            pass
+        mean  = np.where(useSeed, seedMean, mean)
+        sigma = np.where(useSeed, seedSigma, sigma)
+        pass
+
+    fitOK = turnOn & np.isfinite(mean) & np.isfinite(sigma) & (nPoints > 2)
+    mean  = np.where(fitOK, mean, 0.)
+    sigma = np.where(fitOK, np.maximum(sigma, 0.1), 1.)
+    nev   = np.where(fitOK[...,None], nev, 0.)
+    chi2  = _chi2(x, y, w, nev, mean, sigma)
+    lam   = np.full(shape, 1e-3)
+    active = fitOK.copy()
+
+    for it in range(maxIter):
+        if not active.any():
+            break
+        z    = (x - mean[...,None])/sigma[...,None]
+        gaus = nev/(SQRT2PI*sigma[...,None])*np.exp(-0.5*z*z)
+        res  = y - scurveModel(x, mean[...,None], sigma[...,None], nev)
+
+        # Jacobian of the model is (-gaus, -gaus*z)
+        a11 = (w*gaus*gaus).sum(axis=-1)*(1. + lam)
+        a22 = (w*gaus*gaus*z*z).sum(axis=-1)*(1. + lam)
+        a12 = (w*gaus*gaus*z).sum(axis=-1)
+        b1  = -(w*gaus*res).sum(axis=-1)
+        b2  = -(w*gaus*z*res).sum(axis=-1)
+        det = a11*a22 - a12*a12
+        det = np.where(np.abs(det) > 0, det, np.inf)
+        dMean  = (a22*b1 - a12*b2)/det
+        dSigma = (a11*b2 - a12*b1)/det
+
+        newMean  = mean + dMean
+        newSigma = np.maximum(sigma + dSigma, 0.05)
+        newChi2  = _chi2(x, y, w, nev, newMean, newSigma)
+
+        better = active & (newChi2 <= chi2)
+        mean  = np.where(better, newMean, mean)
+        sigma = np.where(better, newSigma, sigma)
+        chi2  = np.where(better, newChi2, chi2)
+        lam   = np.where(better, lam*0.1, lam*10.)
+
+        # a rejected step only raises lam, the next step is not a sign of convergence
+        converged = better & (np.abs(dMean) < tol) & (np.abs(dSigma) < tol)
+        active &= ~converged & (lam < 1e10)
+        pass
+
+    ped = _pedestal(x, y, valid, mean, sigma)
+
+    mean  = np.where(fitOK, mean, 0.)
+    sigma = np.where(fitOK, sigma, 0.)
+    chi2  = np.where(fitOK, chi2, 0.)
+    ndf   = np.where(fitOK, nPoints - 2, 0)
+    return [mean, sigma, ped, chi2, ndf]
+
+def summarizeVFATs(fitSummary, channels=None):
+    """
+    Per-VFAT estimates from the channels (default all) of fitSummary which
+    were fit: (nFit, mean, meanErr, sigma, sigmaErr) indexed by VFAT, the
+    errors being the standard error of the spread over the channels, nan
+    for VFATs with no channel fit (or one, for the errors)
+    """
+    mean  = np.asarray(fitSummary[0], dtype=np.float64)
+    sigma = np.asarray(fitSummary[1], dtype=np.float64)
+    fit   = np.asarray(fitSummary[4]) > 0
+    if channels is not None:
+        sel = np.zeros(fit.shape[-1], dtype=bool)
+        sel[list(channels)] = True
+        fit = fit & sel
+        pass
+    nFit = fit.sum(axis=-1)
+    n    = np.maximum(nFit, 1).astype(np.float64)
+    def meanAndErr(values):
+        avg = np.where(fit, values, 0.).sum(axis=-1)/n
+        var = np.where(fit, (values - avg[...,None])**2, 0.).sum(axis=-1)/np.maximum(n - 1, 1)
+        avg = np.where(nFit > 0, avg, np.nan)
+        err = np.where(nFit > 1, np.sqrt(var/n), np.nan)
+        return avg, err
+    meanAvg, meanErr   = meanAndErr(mean)
+    sigmaAvg, sigmaErr = meanAndErr(sigma)
+    return nFit, meanAvg, meanErr, sigmaAvg, sigmaErr
+
+def _splitVFAT(arr, v, ndim):
+    if arr is None:
+        return None
+    arr = np.asarray(arr)
+    if arr.ndim >= ndim:
+        return arr[v]
+    return arr
+
+def _fitVFAT(args):
+    x, hits, nev, seed, valid = args
+    return fitSCurves(x, hits, nev, seed=seed, valid=valid)
+
+class _FitResult:
+    """
+    Result of a fit run in this process, with the interface of multiprocessing's AsyncResult
+    """
+    def __init__(self, result):
+        self.result = result
+        return
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        return self.result
+
+class SCurveFitPool:
+    """
+    Pool of worker processes fitting S-curves one VFAT per task, meant to be
+    created once and reused for every scan of a trimming run (or of several
+    chambers). With nproc = 1 the fits are run serially in this process.
+    """
+    def __init__(self, nproc=None):
+        from multiprocessing import cpu_count
+        if nproc is None or nproc < 1:
+            nproc = cpu_count()
+            pass
+        self.nproc = nproc
+        self.pool  = None
+        if nproc > 1:
+            import signal
+            from multiprocessing import Pool
+            # from: https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python
+            original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.pool = Pool(nproc)
+            signal.signal(signal.SIGINT, original_sigint_handler)
+            pass
+        return
+
+    def tasks(self, x, hits, nev, seed=None, valid=None):
+        """
+        Splits the fit inputs into one (x, hits, nev, seed, valid) task per VFAT
+        """
+        hits = np.asarray(hits, dtype=np.float64)
+        tasks = []
+        for vfat in range(hits.shape[0]):
+            vfatSeed = None
+            if seed is not None:
+                vfatSeed = (_splitVFAT(seed[0], vfat, hits.ndim-1),
+                            _splitVFAT(seed[1], vfat, hits.ndim-1))
+                pass
+            tasks.append((_splitVFAT(x, vfat, hits.ndim),
+                          hits[vfat],
+                          _splitVFAT(nev, vfat, hits.ndim-1),
+                          vfatSeed,
+                          _splitVFAT(valid, vfat, hits.ndim)))
+            pass
+        return tasks
+
+    def fit(self, x, hits, nev, seed=None, valid=None):
+        """
+        Same as fitSCurves, with the first axis of hits (the VFAT) spread over the pool
+        """
+        tasks = self.tasks(x, hits, nev, seed, valid)
+        if self.pool is None:
+            results = map(_fitVFAT, tasks)
+        else:
+            # timeout must be properly set, otherwise KeyboardInterrupt is not delivered
+            results = self.pool.map_async(_fitVFAT, tasks).get(999999999)
+            pass
+        return [np.array([result[i] for result in results]) for i in range(5)]
+
+    def submit(self, x, hits, nev, seed=None, valid=None):
+        """
+        Starts fitSCurves on the given inputs without waiting for the result,
+        returns an object with ready() and get() like multiprocessing's AsyncResult
+        """
+        task = (x, hits, nev, seed, valid)
+        if self.pool is None:
+            return _FitResult(_fitVFAT(task))
+        return self.pool.apply_async(_fitVFAT, (task,))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            pass
+        return
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            pass
+        return
+
+class PipelinedSCurveFit:
+    """
+    Fits the S-curves of a running scan VFAT by VFAT: passed as the callback
+    of scanUtils.scurveScan it submits, every chunk channels read out, one fit
+    per VFAT of these channels to an SCurveFitPool. onVFAT(vfat, summary) is
+    called for each VFAT as soon as all of its channels are fit, from the
+    callback while the scan is still running if the fits are done by then,
+    and from finish() for the VFATs left once the scan is over.
+    channels is the list of channels scanned, if not chMin to chMax.
+    """
+    def __init__(self, fitter, mask=0x0, chMin=0, chMax=NCHAN-1, seed=None, channels=None,
+                 onVFAT=None, chunk=16):
+        self.fitter    = fitter
+        self.seed      = seed
+        self.onVFAT    = onVFAT
+        self.chunk     = chunk
+        self.vfats     = [vfat for vfat in range(NVFAT) if not (mask >> vfat) & 0x1]
+        self.nChannels = chMax - chMin + 1
+        if channels is not None:
+            self.nChannels = len(set(channels))
+            pass
+        self.summary   = [np.zeros((NVFAT,NCHAN)) for i in range(5)]
+        self.nFit      = np.zeros(NVFAT, dtype=int)
+        self.nRead     = 0
+        self.unfit     = []
+        self.scanData  = None
+        self.pending   = []
+        self.returned  = set()
+        return
+
+    def __call__(self, scCH, scanData):
+        self.submitChannel(scCH, scanData)
+        return
+
+    def submitChannel(self, scCH, scanData):
+        self.scanData = scanData
+        self.unfit.append(scCH)
+        self.nRead += 1
+        if len(self.unfit) >= self.chunk or self.nRead >= self.nChannels:
+            self.submitChunk()
+            pass
+        self.collect()
+        self.handOut()
+        return
+
+    def submitChunk(self):
+        """
+        Submits one fit per VFAT of the channels read out since the last chunk
+        """
+        if len(self.unfit) == 0:
+            return
+        chs = np.array(self.unfit)
+        self.unfit = []
+        x, hits, nev, valid = self.scanData.fitInputs(chs)
+        for vfat in self.vfats:
+            vfatSeed = None
+            if self.seed is not None:
+                vfatSeed = (np.asarray(self.seed[0])[vfat,chs], np.asarray(self.seed[1])[vfat,chs])
+                pass
+            self.pending.append((vfat, chs, self.fitter.submit(x, hits[vfat], nev[vfat], vfatSeed, valid[vfat])))
+            pass
+        return
+
+    def collect(self, block=False):
+        """
+        Stores the results of the finished fits, if block is True waits for
+        the oldest pending fit first
+        """
+        stillPending = []
+        for vfat, chs, result in self.pending:
+            if result.ready() or (block and len(stillPending) == 0):
+                vfatSummary = result.get(999999999)
+                for i in range(5):
+                    self.summary[i][vfat,chs] = vfatSummary[i]
+                    pass
+                self.nFit[vfat] += len(chs)
+            else:
+                stillPending.append((vfat, chs, result))
+                pass
+            pass
+        self.pending = stillPending
+        return
+
+    def handOut(self):
+        """
+        Calls onVFAT for each VFAT whose channels are all fit, once
+        """
+        for vfat in self.vfats:
+            if vfat in self.returned or self.nFit[vfat] < self.nChannels: continue
+            self.returned.add(vfat)
+            if self.onVFAT is not None:
+                self.onVFAT(vfat, self.summary)
+                pass
+            pass
+        return
+
+    def finish(self):
+        """
+        Waits on the pending fits, handing out each VFAT as soon as it is
+        fit, until every VFAT has been handed out. Returns the summary.
+        """
+        self.submitChunk()
+        while len(self.returned) < len(self.vfats):
+            self.collect()
+            self.handOut()
+            if len(self.returned) < len(self.vfats):
+                if len(self.pending) == 0:
+                    raise RuntimeError("Only %d of %d channels were fit"%(self.nFit[self.vfats].min(), self.nChannels))
+                self.collect(block=True)
+                pass
+            pass
+        return self.summary
+
+class SCurveEstimates:
+    """
+    Estimates the S-curves of a running scan channel by channel with
+    estimateSCurves: passed as the callback of scanUtils.scurveScan it fills
+    summary, in the layout of the fit summary, as each channel is read out
+    """
+    def __init__(self, mask=0x0):
+        self.mask    = mask
+        self.summary = [np.zeros((NVFAT,NCHAN)) for i in range(5)]
+        self.summary[4] = np.zeros((NVFAT,NCHAN), dtype=int)
+        return
+
+    def __call__(self, scCH, scanData):
+        self.fillChannel(scCH, scanData)
+        return
+
+    def fillChannel(self, scCH, scanData):
+        x, hits, nev, valid = scanData.fitInputs(scCH)
+        chSummary = estimateSCurves(x, hits, nev, valid)
+        for i in range(5):
+            self.summary[i][:,scCH] = chSummary[i]
+            pass
+        for vfat in range(0,NVFAT):
+            if (self.mask >> vfat) & 0x1:
+                self.summary[4][vfat,scCH] = 0
+                pass
+            pass
+        return
+
+    def fillScan(self, scanData):
+        """
+        Estimates every channel scanned in scanData at once
+        """
+        x, hits, nev, valid = scanData.fitInputs()
+        self.summary = estimateSCurves(x, hits, nev, valid)
+        for vfat in range(0,NVFAT):
+            if (self.mask >> vfat) & 0x1 or not scanData.scanned[vfat].any():
+                self.summary[4][vfat] = 0
+                pass
+            pass
+        return
+
+def loadSCurveFile(filename, npoints=NPOINTS):
+    """
+    Reads the scurveTree of filename into (vcal, hits, nev) arrays, hits is
+    indexed as [vfat][ch][vcal] and is -1 for points not present in the file,
+    nev is [vfat][ch], or [vfat][ch][vcal] for an adaptive scan.
+    HDF5 and NPZ files written with --format are read as arrays directly, as
+    is the cube written next to filename with --cube if there is one.
+    """
+    if os.path.splitext(filename)[1] in ['.h5','.npz']:
+        return loadSCurveArrays(filename, npoints)
+    from cubeUtils import openSCurveCube
+    cube = openSCurveCube(filename)
+    if cube is not None:
+        return loadSCurveCube(cube, npoints)
+    from treeUtils import readScanTree
+    data   = readScanTree(filename, 'scurveTree', ['vfatN','vfatCH','vcal','Nhits','Nev'])
+    vfatN  = data['vfatN']
+    vfatCH = data['vfatCH']
+    vcal   = data['vcal']
+    nhits  = data['Nhits']
+    nevts  = data['Nev']
+
+    hits = -np.ones((NVFAT,NCHAN,npoints))
+    nev  = np.zeros((NVFAT,NCHAN))
+    sel  = (vcal >= 0) & (vcal < npoints) & (nhits >= 0)
+    hits[vfatN[sel],vfatCH[sel],vcal[sel]] = nhits[sel]
+    nev[vfatN,vfatCH] = nevts
+    if (nev[vfatN,vfatCH] != nevts).any():
+        # Nev differs from point to point in adaptive scans
+        nev = np.zeros((NVFAT,NCHAN,npoints))
+        nev[vfatN[sel],vfatCH[sel],vcal[sel]] = nevts[sel]
+        pass
+    return np.arange(npoints), hits, nev
+
+def loadSCurveArrays(filename, npoints=NPOINTS):
+    """
+    loadSCurveFile for the [vfat][ch][vcal] Nhits array of an HDF5 or NPZ file
+    """
+    from arrayUtils import ScanArrayData
+    data = ScanArrayData(filename)
+    vcal = np.asarray(data['vcal'][:])
+    cube = np.asarray(data['Nhits'][:])
+    nevs = np.asarray(data['Nev'][:]) if 'Nev' in data else None
+    data.close()
+
+    hits = -np.ones((NVFAT,NCHAN,npoints))
+    sel  = (vcal >= 0) & (vcal < npoints)
+    hits[:,:,vcal[sel]] = np.where(cube[:,:,sel] >= 0, cube[:,:,sel], -1)
+    if nevs is not None:
+        # Nev of each point of an adaptive scan
+        nev = np.zeros((NVFAT,NCHAN,npoints))
+        nev[:,:,vcal[sel]] = np.maximum(nevs[:,:,sel], 0)
+    else:
+        nev = np.where((cube != -1).any(axis=-1), data.attrs.get('Nev',0), 0)
+        pass
+    return np.arange(npoints), hits, nev
+
+def loadSCurveCube(cube, npoints=NPOINTS):
+    """
+    loadSCurveFile for a cubeUtils.SCurveCube
+    """
+    vcal = cube.vcal()
+    sel  = (vcal >= 0) & (vcal < npoints)
+    hits = -np.ones((NVFAT,NCHAN,npoints))
+    hits[:,:,vcal[sel]] = cube.hits[:,:,sel]
+    nev  = np.array(cube.Nev, dtype=float)
+    cube.close()
+    return np.arange(npoints), hits, nev
+
+def fileHash(filename, blocksize=1<<20):
+    """
+    sha1 of the contents of filename
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as inF:
+        for block in iter(lambda: inF.read(blocksize), b''):
+            sha.update(block)
+            pass
+        pass
+    return sha.hexdigest()
+
+def fitCacheKey(filename, seed=None):
+    """
+    sha1 of a fit of filename: of the data loadSCurveFile reads for it (the
+    file itself or its cube) and of the (mean, sigma) seed of the fit
+    """
+    source = filename
+    if os.path.splitext(filename)[1] not in ['.h5','.npz']:
+        from cubeUtils import currentCubePath
+        source = currentCubePath(filename) or filename
+        pass
+    sha = hashlib.sha1()
+    sha.update(os.path.splitext(source)[1])
+    sha.update(fileHash(source))
+    if seed is not None:
+        for values in seed:
+            sha.update(np.ascontiguousarray(values, dtype=float).tostring())
+            pass
+        pass
+    return sha.hexdigest()
+
+def fitCachePath(filename, seed=None):
+    """
+    Location of the cached fit results for the current contents of filename
+    fit with seed
+    """
+    dirName, baseName = os.path.split(os.path.abspath(filename))
+    return '%s/.fitCache/%s.%s.npz'%(dirName, baseName, fitCacheKey(filename, seed))
+
+def loadFitCache(filename, seed=None):
+    """
+    Returns the cached fit summary for filename fit with seed, or None if
+    the file has not been fit so since it was last written
+    """
+    cacheFile = fitCachePath(filename, seed)
+    if not os.path.isfile(cacheFile):
+        return None
+    cached = np.load(cacheFile)
+    return [cached['mean'], cached['sigma'], cached['ped'], cached['chi2'], cached['ndf']]
+
+def storeFitCache(filename, fitSummary, seed=None):
+    """
+    Caches fitSummary against the current contents of filename and seed
+    """
+    cacheFile = fitCachePath(filename, seed)
+    if not os.path.isdir(os.path.dirname(cacheFile)):
+        os.makedirs(os.path.dirname(cacheFile))
+        pass
+    mean, sigma, ped, chi2, ndf = fitSummary
+    np.savez(cacheFile, mean=mean, sigma=sigma, ped=ped, chi2=chi2, ndf=ndf)
+    return
+
+def estimatesPath(filename):
+    """
+    File next to the scan data filename holding its S-curve estimates
+    """
+    return '%s_estimates.npz'%(os.path.splitext(filename)[0])
+
+def storeEstimates(filename, summary):
+    """
+    Writes the [vfat][ch] estimates summary of the scan data filename
+    """
+    mean, sigma, ped, chi2, ndf = summary
+    np.savez(estimatesPath(filename), mean=mean, sigma=sigma, ped=ped, chi2=chi2, ndf=ndf)
+    return
+
+def loadEstimates(filename):
+    """
+    The estimates summary stored for the scan data filename, None if there is none
+    """
+    if not os.path.isfile(estimatesPath(filename)):
+        return None
+    stored = np.load(estimatesPath(filename))
+    return [stored['mean'], stored['sigma'], stored['ped'], stored['chi2'], stored['ndf']]
+
+def fitSCurveFile(filename, seed=None, useCache=True, fitter=None):
+    """
+    Drop-in replacement for fitting.fitScanData which reuses cached results
+    when filename has already been fit with seed, fitter is an optional SCurveFitPool
+    """
+    if useCache:
+        fitSummary = loadFitCache(filename, seed)
+        if fitSummary is not None:
+            return fitSummary
+        pass
+    vcal, hits, nev = loadSCurveFile(filename)
+    if fitter is not None:
+        fitSummary = fitter.fit(vcal, hits, nev, seed=seed)
+    else:
+        fitSummary = fitSCurves(vcal, hits, nev, seed=seed)
+        pass
+    if useCache:
+        storeFitCache(filename, fitSummary, seed)
+        pass
+    return fitSummary
+
+if __name__ == '__main__':
+    import sys
+    fitter = SCurveFitPool()
+    for filename in sys.argv[1:]:
+        fitSummary = fitSCurveFile(filename, fitter=fitter)
+        print filename
+        for vfat in range(0,NVFAT):
+            good = fitSummary[4][vfat] > 0
+            if not good.any(): continue
+            print "  VFAT%02d: mean %6.2f sigma %5.2f (%d channels)"%(vfat,
+                                                                    fitSummary[0][vfat][good].mean(),
+                                                                    fitSummary[1][vfat][good].mean(),
+                                                                    good.sum())
+            pass
+        pass
+    fitter.close()
@@ -0,0 +1,56 @@
+#!/bin/env python
+"""
+Shows the occupancy and turn-on maps of a running ultraScurve.py or
+ultraThreshold.py scan taken with --monitor, updated as each block of
+results is published
+"""
+
+if __name__ == '__main__':
+    import sys, time
+    from optparse import OptionParser
+    from monitorUtils import LiveMonitor, ScanSubscriber, monitorPath
+
+    parser = OptionParser(usage="%prog [options] [socket]")
+    parser.add_option("--shelf", type="int", dest="shelf", default=1,
+                      help="uTCA shelf of the scanned link", metavar="shelf")
+    parser.add_option("-s", "--slot", type="int", dest="slot", default=2,
+                      help="Slot of the AMC of the scanned link", metavar="slot")
+    parser.add_option("-g", "--gtx", type="int", dest="gtx", default=0,
+                      help="Link being scanned", metavar="gtx")
+    parser.add_option("--interval", type="float", dest="interval", default=1.0,
+                      help="Minimum time in seconds between refreshes of the maps", metavar="interval")
+    parser.add_option("--wait", type="float", dest="wait", default=60.,
+                      help="Time in seconds to wait for the scan to start publishing", metavar="wait")
+
+    (options, args) = parser.parse_args()
+
+    path = args[0] if len(args) > 0 else monitorPath(options.shelf, options.slot, options.gtx)
+
+    subscriber = None
+    deadline   = time.time() + options.wait
+    while subscriber is None:
+        try:
+            subscriber = ScanSubscriber(path)
+        except Exception as e:
+            if time.time() > deadline:
+                print "Could not connect to %s: %s"%(path, e)
+                exit(1)
+                pass
+            time.sleep(0.5)
+            pass
+        pass
+
+    monitor     = LiveMonitor()
+    lastRefresh = 0
+    for msgType, payload in subscriber:
+        monitor.update(msgType, payload)
+        if time.time() - lastRefresh > options.interval or monitor.status is not None:
+            sys.stdout.write("\033[2J\033[H" + monitor.report() + "\n")
+            sys.stdout.flush()
+            lastRefresh = time.time()
+            pass
+        pass
+    subscriber.close()
+    if monitor.status is None:
+        print "Scan stopped publishing before it finished"
+        pass
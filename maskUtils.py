@@ -0,0 +1,85 @@
+#!/bin/env python
+"""
+VFAT mask derived from the chips present on a link: the chip IDs of all
+VFATs are read at once with getAllChipIDs and every slot answering with no
+chip ID is masked. The result is cached per link for a short time, so that
+the scans launched one after the other by run_scans.py probe the link once.
+"""
+
+import json, os, time
+
+NVFAT = 24
+
+# Chip IDs read back from an empty or unresponsive slot
+MISSING_CHIPIDS = [0x0000, 0xdead]
+
+def maskCachePath(shelf, slot, link):
+    """
+    Cache of the detected mask of a link
+    """
+    return "/tmp/gemVFATMask_shelf%02d_slot%02d_oh%d.json"%(shelf, slot, link)
+
+def chipIDMask(chipIDs):
+    """
+    Mask of the slots of chipIDs (a dict or list indexed by VFAT) with no chip
+    """
+    mask = 0x0
+    for vfat in range(0,NVFAT):
+        if chipIDs[vfat] in MISSING_CHIPIDS:
+            mask |= (0x1 << vfat)
+            pass
+        pass
+    return mask
+
+def detectChipIDs(ohboard, shelf, slot, link, ttl=60, debug=False):
+    """
+    Chip IDs of the VFATs of link as a list indexed by VFAT, read with
+    getAllChipIDs unless they were read less than ttl seconds ago
+    """
+    from gempython.tools.vfat_user_functions_uhal import getAllChipIDs
+    cache = maskCachePath(shelf, slot, link)
+    if ttl > 0 and os.path.isfile(cache):
+        try:
+            with open(cache) as inF:
+                cached = json.load(inF)
+            if time.time() - cached["time"] < ttl:
+                return cached["chipIDs"]
+        except (IOError, ValueError, KeyError) as e:
+            if debug:
+                print "Ignoring the mask cache %s: %s"%(cache, e)
+                pass
+            pass
+        pass
+    chipIDs = getAllChipIDs(ohboard, link, debug=debug)
+    chipIDs = [int(chipIDs[vfat]) for vfat in range(0,NVFAT)]
+    try:
+        # replaced atomically, several links may be probed at the same time
+        with open(cache+".tmp%d"%(os.getpid()),'w') as outF:
+            json.dump({"time":time.time(), "chipIDs":chipIDs, "mask":chipIDMask(chipIDs)}, outF)
+            pass
+        os.rename(cache+".tmp%d"%(os.getpid()), cache)
+    except (IOError, OSError) as e:
+        print "Unable to cache the detected VFATs in %s: %s"%(cache, e)
+        pass
+    return chipIDs
+
+def scanMask(ohboard, options, link=None, mask=None):
+    """
+    VFAT mask of a scan: mask (default options.vfatmask) with, if
+    options.autoMask is set, the slots with no chip on link (default
+    options.gtx) masked as well
+    """
+    if link is None:
+        link = options.gtx
+        pass
+    if mask is None:
+        mask = options.vfatmask
+        pass
+    if not options.autoMask:
+        return mask
+    missing = chipIDMask(detectChipIDs(ohboard, options.shelf, options.slot, link,
+                                       ttl=options.autoMaskTTL, debug=options.debug))
+    if missing & ~mask:
+        print "Masking the VFATs with no chip ID on link %d: 0x%06x"%(link, missing & ~mask)
+        pass
+    return mask | missing
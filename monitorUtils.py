@@ -0,0 +1,258 @@
+#!/bin/env python
+"""
+Live monitoring tap of the scan scripts: the decoded results of each
+channel or VFAT block are published on a local Unix domain socket as they
+complete, and read back by liveMonitor.py.
+
+Every message is a frame of FRAME_HEADER (magic, version, message type,
+payload length) followed by the payload:
+  MSG_START  JSON object with the scan parameters
+  MSG_BLOCK  BLOCK_HEADER (vfat, channel or -1, first scan value, npoints)
+             followed by npoints int32 hit counts, -1 for points not read out
+  MSG_END    JSON object with the status of the scan
+
+Publishing never blocks the scan, subscribers are accepted between blocks
+and a subscriber which can not take a frame is dropped.
+"""
+
+import errno, json, os, select, socket, struct
+import numpy as np
+
+FRAME_MAGIC   = "GEMM"
+FRAME_VERSION = 1
+FRAME_HEADER  = struct.Struct("<4sBBHI")
+BLOCK_HEADER  = struct.Struct("<hhiI")
+
+MSG_START = 0
+MSG_BLOCK = 1
+MSG_END   = 2
+
+def monitorPath(shelf, slot, link):
+    """
+    Default socket path of the scans of a link
+    """
+    return "/tmp/gemMonitor_shelf%02d_slot%02d_oh%d.sock"%(shelf, slot, link)
+
+def packFrame(msgType, payload):
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, msgType, 0, len(payload)) + payload
+
+def packBlock(vfat, ch, scanmin, hits):
+    hits = np.where(np.asarray(hits) >= 0, hits, -1).astype('<i4')
+    return packFrame(MSG_BLOCK, BLOCK_HEADER.pack(vfat, ch, scanmin, len(hits)) + hits.tostring())
+
+def unpackBlock(payload):
+    """
+    Returns (vfat, ch, scanmin, hits) of a MSG_BLOCK payload
+    """
+    vfat, ch, scanmin, npoints = BLOCK_HEADER.unpack_from(payload)
+    hits = np.frombuffer(payload, dtype='<i4', count=npoints, offset=BLOCK_HEADER.size)
+    return vfat, ch, scanmin, hits
+
+class ScanPublisher:
+    """
+    Publishes scan results on the Unix domain socket path, replacing any
+    stale socket left there. Called as publisher(scCH, scanData) it
+    publishes channel scCH of an scanUtils.SCurveScanData for every VFAT
+    not in mask, so that it can be passed as the callback of
+    scanUtils.scurveScan.
+    """
+    def __init__(self, path, mask=0x0, **params):
+        self.path = path
+        self.mask = mask
+        self.subscribers = []
+        if os.path.exists(path):
+            os.unlink(path)
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(8)
+        self.server.setblocking(False)
+        params['mask'] = mask
+        self.startFrame = packFrame(MSG_START, json.dumps(params))
+        return
+
+    def _accept(self):
+        while select.select([self.server], [], [], 0)[0]:
+            try:
+                conn, addr = self.server.accept()
+            except socket.error:
+                break
+            conn.setblocking(False)
+            self.subscribers.append(conn)
+            self._send(conn, self.startFrame)
+            pass
+        return
+
+    def _send(self, conn, frame):
+        try:
+            sent = conn.send(frame)
+            if sent == len(frame):
+                return True
+        except socket.error as e:
+            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK, errno.EPIPE, errno.ECONNRESET]:
+                raise
+            pass
+        # A partial frame would corrupt the stream, drop the subscriber
+        conn.close()
+        if conn in self.subscribers:
+            self.subscribers.remove(conn)
+            pass
+        return False
+
+    def publish(self, frame):
+        self._accept()
+        for conn in list(self.subscribers):
+            self._send(conn, frame)
+            pass
+        return
+
+    def publishBlock(self, vfat, ch, scanmin, hits):
+        """
+        Publishes the hits of VFAT vfat (channel ch, -1 for all channels)
+        at the scan values starting from scanmin
+        """
+        self.publish(packBlock(vfat, ch, scanmin, hits))
+        return
+
+    def __call__(self, scCH, scanData):
+        from scanUtils import decodeUltraData
+        for vfat in range(0,24):
+            if (self.mask >> vfat) & 0x1: continue
+            vals, hits = decodeUltraData(scanData.words[vfat,scCH])
+            if scanData.nev is not None:
+                # points of an adaptive scan are scaled to nevts triggers
+                nev  = scanData.nev[vfat,scCH]
+                hits = np.where((hits >= 0) & (nev > 0), np.rint(hits*float(scanData.nevts)/np.maximum(nev,1)), hits)
+                pass
+            self.publishBlock(vfat, scCH, scanData.scanmin, hits)
+            pass
+        return
+
+    def close(self, status="ok"):
+        self.publish(packFrame(MSG_END, json.dumps({"status":status})))
+        for conn in self.subscribers:
+            conn.close()
+            pass
+        self.subscribers = []
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+            pass
+        return
+
+class ScanSubscriber:
+    """
+    Connection to a ScanPublisher, iterating over it yields the
+    (msgType, payload) of each frame received until the publisher closes
+    """
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        return
+
+    def _read(self, size):
+        data = ""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+            pass
+        return data
+
+    def __iter__(self):
+        while True:
+            header = self._read(FRAME_HEADER.size)
+            if header is None:
+                return
+            magic, version, msgType, reserved, length = FRAME_HEADER.unpack(header)
+            if magic != FRAME_MAGIC or version != FRAME_VERSION:
+                raise ValueError("Unexpected frame %r version %d"%(magic, version))
+            payload = self._read(length)
+            if payload is None:
+                return
+            yield msgType, payload
+            pass
+        return
+
+    def close(self):
+        self.sock.close()
+        return
+
+class LiveMonitor:
+    """
+    Occupancy and turn-on maps accumulated from the frames of a scan.
+    occupancy[vfat][ch] is the fraction of triggers with a hit over the scan
+    points, turnOn[vfat][ch] the first scan value at which the hits cross half
+    of Nev (-1 if they do not), blocks with ch -1 fill every channel of the VFAT.
+    """
+    def __init__(self):
+        self.params    = {}
+        self.status    = None
+        self.occupancy = -np.ones((24,128))
+        self.turnOn    = -np.ones((24,128))
+        self.done      = np.zeros((24,128), dtype=bool)
+        self.nBlocks   = 0
+        return
+
+    def update(self, msgType, payload):
+        if msgType == MSG_START:
+            self.__init__()
+            self.params = json.loads(payload)
+        elif msgType == MSG_END:
+            self.status = json.loads(payload)["status"]
+        elif msgType == MSG_BLOCK:
+            vfat, ch, scanmin, hits = unpackBlock(payload)
+            chans = slice(None) if ch < 0 else ch
+            valid = hits >= 0
+            nev   = float(self.params.get("nevts", 0))
+            if valid.any() and nev > 0:
+                self.occupancy[vfat,chans] = hits[valid].sum() / (nev*valid.sum())
+                above = hits[valid] >= nev/2.
+                cross = np.flatnonzero(above != above[0])
+                self.turnOn[vfat,chans] = scanmin + np.flatnonzero(valid)[cross[0]] if len(cross) else -1
+                pass
+            self.done[vfat,chans] = True
+            self.nBlocks += 1
+            pass
+        return
+
+    def deadVFATs(self):
+        """
+        VFATs with completed blocks and no hits at all
+        """
+        return [vfat for vfat in range(24) if self.done[vfat].any() and
+                not (self.occupancy[vfat][self.done[vfat]] > 0).any()]
+
+    def report(self, width=32):
+        """
+        Text maps of occupancy and turn-on, width columns of channels per VFAT
+        """
+        shades = " .:-=+*#%@"
+        group  = 128 // width
+        lines  = ["%s link %s, %d blocks%s"%(self.params.get("tool","scan"), self.params.get("link","?"),
+                                              self.nBlocks, ", %s"%(self.status) if self.status else "")]
+        lines.append("VFAT  %-*s  %-*s  mean turn-on"%(width, "occupancy", width, "turn-on (scanmin..scanmax)"))
+        scanmin = self.params.get("scanmin", 0)
+        scanmax = self.params.get("scanmax", 255)
+        for vfat in range(24):
+            if not self.done[vfat].any(): continue
+            occ = self.occupancy[vfat].reshape(width, group)
+            ton = self.turnOn[vfat].reshape(width, group)
+            occMap = "".join(shades[int(min(max(v,0),1)*(len(shades)-1))] if v >= 0 else "?" for v in occ.max(axis=1))
+            tonMap = ""
+            for row in ton:
+                if not (row >= 0).any():
+                    tonMap += "?"
+                    continue
+                frac = float(row[row >= 0].mean()-scanmin)/max(scanmax-scanmin,1)
+                tonMap += shades[int(min(max(frac,0),1)*(len(shades)-1))]
+                pass
+            sel = ton >= 0
+            lines.append("%4d  %s  %s  %s"%(vfat, occMap, tonMap, "%6.1f"%(ton[sel].mean()) if sel.any() else "   n/a"))
+            pass
+        dead = self.deadVFATs()
+        if len(dead) > 0:
+            lines.append("WARNING no hits from VFATs %s"%(",".join(str(vfat) for vfat in dead)))
+            pass
+        return "\n".join(lines)
@@ -12,3 +12,60 @@ parser.add_option("--vfatmask", type="int", dest="vfatmask",
                   help="VFATs to be masked in scan & analysis applications (e.g. 0xFFFFF masks all VFATs)", metavar="vfatmask", default=0x0)
 parser.add_option("--ztrim", type="float", dest="ztrim", default=4.0,
                   help="Specify the p value of the trim", metavar="ztrim")
+
+def addAdaptiveOptions(parser):
+    """
+    --adaptive and its --confidence and --plateauTol, for the ULTRA scans
+    taken by scanUtils.adaptiveUltraScan
+    """
+    parser.add_option("--adaptive", action="store_true", dest="adaptive",
+                      help="Take the ULTRA scans in short passes, stopping the points found on a plateau and storing Nev for every point", metavar="adaptive")
+    parser.add_option("--confidence", type="float", dest="confidence", default=0.99,
+                      help="Confidence at which --adaptive decides that a point is on a plateau (default is 0.99)", metavar="confidence")
+    parser.add_option("--plateauTol", type="float", dest="plateauTol", default=0.02,
+                      help="Distance of the hit fraction from 0 or 1 below which --adaptive counts a point as on a plateau (default is 0.02)", metavar="plateauTol")
+    return
+
+def addAutoMaskOptions(parser, ttl=True):
+    """
+    --autoMask, read by maskUtils.scanMask, and unless ttl is False --autoMaskTTL
+    """
+    parser.add_option("--autoMask", action="store_true", dest="autoMask",
+                      help="Also mask the VFATs which do not answer with a chip ID when the scan starts", metavar="autoMask")
+    if ttl:
+        parser.add_option("--autoMaskTTL", type="int", dest="autoMaskTTL", default=60,
+                          help="Seconds for which the VFATs found by --autoMask are reused by the following scans of the link (default is 60)", metavar="autoMaskTTL")
+        pass
+    return
+
+def addCompactOption(parser):
+    """
+    --compact, for the scans writing through arrayUtils.openScanOutput
+    """
+    parser.add_option("--compact", action="store_true", dest="compact",
+                      help="Store run, per-VFAT and per-channel constants once in side trees instead of in every row of the output tree", metavar="compact")
+    return
+
+def addCubeOption(parser):
+    """
+    --cube, for the S-curve scans writing through scanUtils.SCurveTree
+    """
+    parser.add_option("--cube", action="store_true", dest="cube",
+                      help="Also write S-curve hits to a memory mapped [vfat][ch][vcal] cube next to the output file", metavar="cube")
+    return
+
+def addFormatOption(parser):
+    """
+    --format, for the scans writing through arrayUtils.openScanOutput
+    """
+    parser.add_option("--format", type="choice", dest="format", default="root", choices=["root","hdf5","npz"],
+                      help="Output format of the scan data: root, hdf5 or npz (default is root)", metavar="format")
+    return
+
+def addMonitorOption(parser):
+    """
+    --monitor, for the scans publishing through monitorUtils
+    """
+    parser.add_option("--monitor", action="store_true", dest="monitor",
+                      help="Publish the decoded results on a local socket as the scan runs, to be shown by liveMonitor.py", metavar="monitor")
+    return
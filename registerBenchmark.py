@@ -0,0 +1,270 @@
+#!/bin/env python
+"""
+Microbenchmarks of the register access primitives used by the scan scripts:
+single register reads, batched reads, VFAT I2C writes, broadcast versus
+per-VFAT writes and retrieval of ULTRA scan results. Timing percentiles are
+printed and saved as JSON so that runs can be compared with --compare.
+"""
+
+import json, socket, sys, time
+import numpy as np
+
+from gempython.tools.optohybrid_user_functions_uhal import *
+from gempython.tools.vfat_user_functions_uhal import *
+
+from registerUtils import batchRead, channelRegisterNodes
+
+class EmulatedValue:
+    def __init__(self, value):
+        self.val = value
+        return
+
+    def value(self):
+        return self.val
+
+class EmulatedNode:
+    def __init__(self, device, path):
+        self.device = device
+        self.path   = path
+        return
+
+    def read(self):
+        self.device.queued += 1
+        return EmulatedValue(self.device.regs.get(self.path,0))
+
+    def write(self, value):
+        self.device.queued += 1
+        self.device.regs[self.path] = value
+        return
+
+    def readBlock(self, nWords):
+        self.device.queued += nWords
+        return EmulatedValue([self.device.regs.get(self.path,0)]*nWords)
+
+    def writeBlock(self, values):
+        self.device.queued += len(values)
+        if len(values) > 0:
+            self.device.regs[self.path] = values[-1]
+            pass
+        return
+
+class EmulatedDevice:
+    """
+    Stand-in for a uhal HwInterface which keeps registers in memory, each
+    dispatch costs latency seconds plus wordTime seconds per queued word
+    """
+    def __init__(self, latency=100e-6, wordTime=1e-6):
+        self.latency  = latency
+        self.wordTime = wordTime
+        self.regs     = {}
+        self.queued   = 0
+        return
+
+    def getNode(self, path):
+        return EmulatedNode(self, path)
+
+    def dispatch(self):
+        time.sleep(self.latency + self.queued*self.wordTime)
+        self.queued = 0
+        return
+
+def timeCalls(func, niter):
+    """
+    Wall-clock time in seconds of each of niter calls of func
+    """
+    times = np.zeros(niter)
+    for i in range(niter):
+        start = time.time()
+        func()
+        times[i] = time.time() - start
+        pass
+    return times
+
+def summarize(times, opsPerCall=1, unit="op"):
+    """
+    Summary statistics of the call times, rate is opsPerCall over the median time
+    """
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return {"n":len(times),
+            "mean":float(np.mean(times)),
+            "min":float(np.min(times)),
+            "p50":float(p50),
+            "p90":float(p90),
+            "p99":float(p99),
+            "max":float(np.max(times)),
+            "opsPerCall":opsPerCall,
+            "unit":unit,
+            "rate":(opsPerCall/p50 if p50 > 0 else 0.)}
+
+class RegisterBenchmark:
+    """
+    Runs the benchmarks on one link, the VFATs in mask are left alone and
+    every register written is restored to its original value
+    """
+    allBenchmarks = ["readRegister","batchRead","writeVFAT","perVFATWrite","broadcastWrite","ultraResults"]
+
+    def __init__(self, ohboard, gtx, mask=0x0, niter=100, register=None, debug=False):
+        self.ohboard  = ohboard
+        self.gtx      = gtx
+        self.mask     = mask
+        self.niter    = niter
+        self.debug    = debug
+        self.register = register
+        if self.register is None:
+            self.register = "GEM_AMC.OH.OH%d.CONTROL.TRIGGER.SOURCE"%(gtx)
+            pass
+        self.vfats   = [vfat for vfat in range(0,24) if not (mask >> vfat) & 0x1]
+        self.results = {}
+        return
+
+    def readRegister(self):
+        return summarize(timeCalls(lambda: readRegister(self.ohboard,self.register), self.niter))
+
+    def batchRead(self):
+        nodes = channelRegisterNodes(self.gtx,self.vfats)
+        return summarize(timeCalls(lambda: batchRead(self.ohboard,nodes), self.niter),
+                         opsPerCall=len(nodes), unit="word")
+
+    def writeVFAT(self):
+        vfat  = self.vfats[0]
+        value = readVFAT(self.ohboard,self.gtx,vfat,"VThreshold2") & 0xff
+        return summarize(timeCalls(lambda: writeVFAT(self.ohboard,self.gtx,vfat,"VThreshold2",value), self.niter))
+
+    def perVFATWrite(self):
+        values = [readVFAT(self.ohboard,self.gtx,vfat,"VThreshold2") & 0xff for vfat in self.vfats]
+        def writeAll():
+            for vfat, value in zip(self.vfats, values):
+                writeVFAT(self.ohboard,self.gtx,vfat,"VThreshold2",value)
+                pass
+            return
+        return summarize(timeCalls(writeAll, self.niter), opsPerCall=len(self.vfats), unit="VFAT")
+
+    def broadcastWrite(self):
+        values = [readVFAT(self.ohboard,self.gtx,vfat,"VThreshold2") & 0xff for vfat in self.vfats]
+        try:
+            times = timeCalls(lambda: writeAllVFATs(self.ohboard,self.gtx,"VThreshold2",values[0],self.mask), self.niter)
+        finally:
+            for vfat, value in zip(self.vfats, values):
+                writeVFAT(self.ohboard,self.gtx,vfat,"VThreshold2",value)
+                pass
+            pass
+        return summarize(times, opsPerCall=len(self.vfats), unit="VFAT")
+
+    def ultraResults(self, scanmin=0, scanmax=254, nevts=10):
+        """
+        Time to retrieve the results of a finished trigger threshold ULTRA
+        scan, not counting the scan itself
+        """
+        npoints  = scanmax - scanmin + 1
+        scanBase = "GEM_AMC.OH.OH%d.ScanController.ULTRA"%(self.gtx)
+        vt1 = [readVFAT(self.ohboard,self.gtx,vfat,"VThreshold1") & 0xff for vfat in self.vfats]
+        times = np.zeros(self.niter)
+        try:
+            for i in range(self.niter):
+                configureScanModule(self.ohboard, self.gtx, scanmode.THRESHTRG, self.mask,
+                                    scanmin=scanmin, scanmax=scanmax, numtrigs=nevts,
+                                    useUltra=True, debug=self.debug)
+                startScanModule(self.ohboard, self.gtx, useUltra=True, debug=self.debug)
+                while readRegister(self.ohboard,"%s.MONITOR.STATUS"%(scanBase)) > 0:
+                    time.sleep(0.01)
+                    pass
+                start = time.time()
+                getUltraScanResults(self.ohboard, self.gtx, npoints, self.debug)
+                times[i] = time.time() - start
+                pass
+        finally:
+            for vfat, value in zip(self.vfats, vt1):
+                writeVFAT(self.ohboard,self.gtx,vfat,"VThreshold1",value)
+                pass
+            pass
+        return summarize(times, opsPerCall=npoints*len(self.vfats), unit="word")
+
+    def run(self, benchmarks=None):
+        if benchmarks is None:
+            benchmarks = self.allBenchmarks
+            pass
+        for name in benchmarks:
+            print "Running %s"%(name)
+            sys.stdout.flush()
+            self.results[name] = getattr(self,name)()
+            pass
+        return self.results
+
+def report(results, reference=None):
+    """
+    Prints the timing percentiles in microseconds and the rates, with the
+    relative change of the median with respect to reference if given
+    """
+    header = "%-16s %6s %10s %10s %10s %10s %14s"%("benchmark","n","p50[us]","p90[us]","p99[us]","max[us]","rate")
+    if reference is not None:
+        header += " %10s"%("p50 change")
+        pass
+    print header
+    for name, res in sorted(results.items()):
+        line = "%-16s %6d %10.1f %10.1f %10.1f %10.1f %9.4g %s/s"%(name, res["n"],
+                                                                  1e6*res["p50"], 1e6*res["p90"],
+                                                                  1e6*res["p99"], 1e6*res["max"],
+                                                                  res["rate"], res["unit"])
+        if reference is not None and name in reference and reference[name]["p50"] > 0:
+            line += " %+9.1f%%"%(100.*(res["p50"]/reference[name]["p50"] - 1))
+            pass
+        print line
+        pass
+    return
+
+if __name__ == '__main__':
+    from qcoptions import parser
+
+    parser.add_option("--niter", type="int", dest="niter", default=100,
+                      help="Number of times each benchmark is repeated (default is 100)", metavar="niter")
+    parser.add_option("--benchmarks", type="string", dest="benchmarks", default=",".join(RegisterBenchmark.allBenchmarks),
+                      help="Comma separated list of benchmarks to run (default is all)", metavar="benchmarks")
+    parser.add_option("--register", type="string", dest="register", default=None,
+                      help="Register read by the readRegister benchmark (default is the OH trigger source)", metavar="register")
+    parser.add_option("--emulate", action="store_true", dest="emulate",
+                      help="Run against an emulated device instead of the hardware", metavar="emulate")
+    parser.add_option("--emuLatency", type="float", dest="emuLatency", default=100e-6,
+                      help="Time in seconds per dispatch of the emulated device (default is 1e-4)", metavar="emuLatency")
+    parser.add_option("--emuWordTime", type="float", dest="emuWordTime", default=1e-6,
+                      help="Time in seconds per word of the emulated device (default is 1e-6)", metavar="emuWordTime")
+    parser.add_option("-f", "--filename", type="string", dest="filename", default="RegisterBenchmark.json",
+                      help="Specify Output Filename", metavar="filename")
+    parser.add_option("--compare", type="string", dest="compare", default=None,
+                      help="JSON output of a previous run to compare with", metavar="compare")
+
+    (options, args) = parser.parse_args()
+
+    if options.emulate:
+        ohboard = EmulatedDevice(options.emuLatency, options.emuWordTime)
+    else:
+        if options.debug:
+            uhal.setLogLevelTo( uhal.LogLevel.DEBUG )
+        else:
+            uhal.setLogLevelTo( uhal.LogLevel.ERROR )
+            pass
+        ohboard = getOHObject(options.slot,options.gtx,options.shelf,options.debug)
+        pass
+
+    bench = RegisterBenchmark(ohboard, options.gtx, options.vfatmask, options.niter,
+                              options.register, options.debug)
+    results = bench.run(options.benchmarks.split(","))
+
+    reference = None
+    if options.compare is not None:
+        with open(options.compare) as refF:
+            reference = json.load(refF)["results"]
+            pass
+        pass
+    report(results, reference)
+
+    with open(options.filename, "w") as outF:
+        json.dump({"time":time.time(),
+                   "host":socket.gethostname(),
+                   "shelf":options.shelf,
+                   "slot":options.slot,
+                   "link":options.gtx,
+                   "vfatmask":options.vfatmask,
+                   "emulated":bool(options.emulate),
+                   "results":results}, outF, indent=2, sort_keys=True)
+        pass
+    print "Results written to %s"%(options.filename)
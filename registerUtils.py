@@ -0,0 +1,107 @@
+#!/bin/env python
+"""
+Utilities to access many registers with a few IPbus transactions by
+queueing reads and writes on the uhal nodes and dispatching them in batches
+"""
+
+import numpy as np
+from gempython.tools.vfat_user_functions_uhal import *
+
+NVFAT = 24
+NCHAN = 128
+
+# Number of queued transactions sent per dispatch
+BATCH_SIZE = 1024
+
+def vfatNode(gtx, vfat, reg):
+    return "GEM_AMC.OH.OH%d.GEB.VFATS.VFAT%d.%s"%(gtx,vfat,reg)
+
+def channelRegisterNodes(gtx, vfats, chMin=0, chMax=127):
+    """
+    Names of the channel registers chMin to chMax of each VFAT in vfats,
+    ordered as [vfat][ch]
+    """
+    return [vfatNode(gtx,vfat,"VFATChannels.ChanReg%d"%(ch)) for vfat in vfats for ch in range(chMin,chMax+1)]
+
+def batchRead(device, nodes, batchSize=BATCH_SIZE, debug=False):
+    """
+    Reads the registers named in nodes with one dispatch per batchSize
+    registers, returns their values as an array. A batch failing to dispatch
+    is retried register by register with readRegister.
+    """
+    values = np.zeros(len(nodes), dtype=np.uint32)
+    for first in range(0,len(nodes),batchSize):
+        batch = nodes[first:first+batchSize]
+        try:
+            queued = [device.getNode(node).read() for node in batch]
+            device.dispatch()
+            values[first:first+len(batch)] = [val.value() for val in queued]
+        except Exception as e:
+            if debug:
+                print "Batch read of %d registers failed (%s), reading one by one"%(len(batch),e)
+                pass
+            values[first:first+len(batch)] = [readRegister(device,node) for node in batch]
+            pass
+        pass
+    return values
+
+def batchWrite(device, nodes, values, batchSize=BATCH_SIZE, debug=False):
+    """
+    Writes values to the registers named in nodes with one dispatch per
+    batchSize registers. A batch failing to dispatch is retried register by
+    register with writeRegister.
+    """
+    values = np.asarray(values).ravel()
+    for first in range(0,len(nodes),batchSize):
+        batch = nodes[first:first+batchSize]
+        bvals = [int(val) for val in values[first:first+len(batch)]]
+        try:
+            for node, val in zip(batch, bvals):
+                device.getNode(node).write(val)
+                pass
+            device.dispatch()
+        except Exception as e:
+            if debug:
+                print "Batch write of %d registers failed (%s), writing one by one"%(len(batch),e)
+                pass
+            for node, val in zip(batch, bvals):
+                writeRegister(device,node,val)
+                pass
+            pass
+        pass
+    return
+
+def readChannelRegisters(device, gtx, vfats, debug=False):
+    """
+    Channel register image of the VFATs in vfats, indexed as [vfat][ch]
+    """
+    nodes = channelRegisterNodes(gtx,vfats)
+    return (batchRead(device,nodes,debug=debug) & 0xff).reshape(len(vfats),NCHAN)
+
+def writeChannelRegisters(device, gtx, vfats, values, debug=False):
+    """
+    Writes a channel register image indexed as [vfat][ch] to the VFATs in vfats
+    """
+    nodes = channelRegisterNodes(gtx,vfats)
+    batchWrite(device,nodes,np.asarray(values).reshape(len(vfats),NCHAN),debug=debug)
+    return
+
+def channelRegisterPatterns(nvfats, nRandom=1, seed=None):
+    """
+    Generator of (name, image) test patterns for the channel registers of
+    nvfats VFATs: walking ones (the set bit shifting with the channel so that
+    neighbouring channels differ), both checkerboards, then nRandom random images
+    """
+    shape = (nvfats,NCHAN)
+    chans = np.arange(NCHAN)
+    for bit in range(8):
+        yield "walking one %d"%(bit), np.tile((1 << ((chans + bit) % 8)), (nvfats,1))
+        pass
+    for first in [0x55, 0xaa]:
+        yield "checkerboard 0x%02x"%(first), np.tile(np.where(chans % 2 == 0, first, first ^ 0xff), (nvfats,1))
+        pass
+    rand = np.random.RandomState(seed)
+    for i in range(nRandom):
+        yield "random %d"%(i), rand.randint(0, 256, size=shape)
+        pass
+    return
@@ -1,12 +1,26 @@
 #!/bin/env python
 
+def makeScanDir(dirPath, startTime):
+  """
+  Creates dirPath/startTime and points the dirPath/current link at it
+  """
+  import os
+  if not os.path.isdir(dirPath+startTime):
+    os.makedirs(dirPath+startTime)
+    pass
+  if os.path.lexists(dirPath+"current"):
+    os.unlink(dirPath+"current")
+    pass
+  os.symlink(startTime,dirPath+"current")
+  return
+
 def launchTests(args):
   return launchTestsArgs(*args)
 
 def launchTestsArgs(tool, shelf, slot, link, chamber, vfatmask, scanmin, scanmax, nevts, stepSize=1,
                     vt1=None,vt2=0,mspl=None,perchannel=False,trkdata=False,ztrim=4.0,
                     config=False,amc13local=False,t3trig=False, randoms=0, throttle=0,
-                    internal=False):
+                    internal=False, retrim=False, autoMask=False):
   import datetime,os,sys
   import subprocess
   from subprocess import CalledProcessError
@@ -20,16 +34,17 @@ def launchTestsArgs(tool, shelf, slot, link, chamber, vfatmask, scanmin, scanmax
   dataType = "VT1Threshold"
 
   #Build Commands
-  setupCmds = []
+  scanDirs = []
   preCmd = None
   cmd = ["%s"%(tool),"-s%i"%(slot),"-g%i"%(link),"--shelf=%i"%(shelf), "--nevts=%i"%(nevts), "--vfatmask=0x%x"%(vfatmask)]
+  if autoMask:
+    cmd.append("--autoMask")
+    pass
   if tool == "ultraScurve.py":
     scanType = "scurve"
     dataType = "SCurve"
     dirPath = "%s/%s/%s/"%(dataPath,chamber_config[link],scanType)
-    setupCmds.append( ["mkdir","-p",dirPath+startTime] )
-    setupCmds.append( ["unlink",dirPath+"current"] )
-    setupCmds.append( ["ln","-s",startTime,dirPath+"current"] )
+    scanDirs.append(dirPath)
     dirPath = dirPath+startTime
     cmd.append( "--filename=%s/SCurveData.root"%dirPath )
     if mspl:
@@ -47,15 +62,16 @@ def launchTestsArgs(tool, shelf, slot, link, chamber, vfatmask, scanmin, scanmax
       preCmd.append("--vt1=%i"%(vt1))
       pass
     dirPath = "%s/%s/%s/z%f/"%(dataPath,chamber_config[link],scanType,ztrim)
-    setupCmds.append( ["mkdir","-p",dirPath+startTime] )
-    setupCmds.append( ["unlink",dirPath+"current"] )
-    setupCmds.append( ["ln","-s",startTime,dirPath+"current"] )
+    scanDirs.append(dirPath)
     dirPath = dirPath+startTime
     cmd.append("--ztrim=%f"%(ztrim))
     if vt1 in range(256):
       cmd.append("--vt1=%i"%(vt1))
       pass
     cmd.append( "--dirPath=%s"%dirPath )
+    if retrim:
+      cmd.append( "--retrim" )
+      pass
     pass
   elif tool == "ultraThreshold.py":
     scanType = "threshold"
@@ -77,18 +93,14 @@ def launchTestsArgs(tool, shelf, slot, link, chamber, vfatmask, scanmin, scanmax
         pass
       pass
     dirPath = "%s/%s/%s/"%(dataPath,chamber_config[link],scanType)
-    setupCmds.append( ["mkdir","-p",dirPath+startTime] )
-    setupCmds.append( ["unlink",dirPath+"current"] )
-    setupCmds.append( ["ln","-s",startTime,dirPath+"current"] )
+    scanDirs.append(dirPath)
     dirPath = dirPath+startTime
     cmd.append( "--filename=%s/ThresholdScanData.root"%dirPath )
     pass
   elif tool == "fastLatency.py":
     scanType = "latency/trig"
     dirPath = "%s/%s/%s/"%(dataPath,chamber_config[link],scanType)
-    setupCmds.append( ["mkdir","-p",dirPath+startTime] )
-    setupCmds.append( ["unlink",dirPath+"current"] )
-    setupCmds.append( ["ln","-s",startTime,dirPath+"current"] )
+    scanDirs.append(dirPath)
     dirPath = dirPath+startTime
     cmd.append( "--filename=%s/FastLatencyScanData.root"%dirPath )
     if mspl:
@@ -97,9 +109,7 @@ def launchTestsArgs(tool, shelf, slot, link, chamber, vfatmask, scanmin, scanmax
   elif tool == "ultraLatency.py":
     scanType = "latency/trk"
     dirPath = "%s/%s/%s/"%(dataPath,chamber_config[link],scanType)
-    setupCmds.append( ["mkdir","-p",dirPath+startTime] )
-    setupCmds.append( ["unlink",dirPath+"current"] )
-    setupCmds.append( ["ln","-s",startTime,dirPath+"current"] )
+    scanDirs.append(dirPath)
     dirPath = dirPath+startTime
     cmd.append( "--filename=%s/LatencyScanData.root"%dirPath )
     cmd.append( "--scanmin=%i"%(scanmin) )
@@ -127,8 +137,8 @@ def launchTestsArgs(tool, shelf, slot, link, chamber, vfatmask, scanmin, scanmax
 
   #Execute Commands
   try:
-    for setupCmd in setupCmds:
-      runCommand(setupCmd)
+    for scanDir in scanDirs:
+      makeScanDir(scanDir,startTime)
       pass
     log = file("%s/scanLog.log"%(dirPath),"w")
     if preCmd and config:
@@ -136,7 +146,7 @@ def launchTestsArgs(tool, shelf, slot, link, chamber, vfatmask, scanmin, scanmax
       pass
     #runCommand(cmd,log)
     runCommand(cmd)
-  except CalledProcessError as e:
+  except (CalledProcessError,OSError) as e:
     print "Caught exception",e
     pass
   return
@@ -150,7 +160,8 @@ if __name__ == '__main__':
   from mapping.chamberInfo import chamber_config, chamber_vfatMask
   from gempython.utils.wrappers import envCheck
 
-  from qcoptions import parser
+  from qcoptions import parser, addAutoMaskOptions
+  addAutoMaskOptions(parser, ttl=False)
 
   parser.add_option("--amc13local", action="store_true", dest="amc13local",
                     help="Set up for using AMC13 local trigger generator", metavar="amc13local")
@@ -163,6 +174,8 @@ if __name__ == '__main__':
   parser.add_option("--randoms", type="int", default=0, dest="randoms",
                     help="Set up for using AMC13 local trigger generator to generate random triggers with rate specified",
                     metavar="randoms")
+  parser.add_option("--retrim", action="store_true", dest="retrim",
+                    help="Retrim the drifted channels starting from the previous trim (trimChamber.py only)", metavar="retrim")
   parser.add_option("--series", action="store_true", dest="series",
                     help="Run tests in series (default is false)", metavar="series")
   parser.add_option("--stepSize", type="int", dest="stepSize", 
@@ -213,6 +226,8 @@ if __name__ == '__main__':
                          [options.randoms for x in range(len(chamber_config))],
                          [options.throttle for x in range(len(chamber_config))],
                          [options.internal for x in range(len(chamber_config))],
+                         [options.retrim  for x in range(len(chamber_config))],
+                         [options.autoMask for x in range(len(chamber_config))],
                          )
             )
   if options.series:
@@ -241,7 +256,9 @@ if __name__ == '__main__':
                     options.t3trig,
                     options.randoms,
                     options.throttle,
-                    options.internal
+                    options.internal,
+                    options.retrim,
+                    options.autoMask
                   ])
       pass
     pass
@@ -276,6 +293,8 @@ if __name__ == '__main__':
                                           [options.randoms for x in range(len(chamber_config))],
                                           [options.throttle for x in range(len(chamber_config))],
                                           [options.internal for x in range(len(chamber_config))],
+                                          [options.retrim  for x in range(len(chamber_config))],
+                                          [options.autoMask for x in range(len(chamber_config))],
                                           )
                            )
       # timeout must be properly set, otherwise tasks will crash
@@ -0,0 +1,362 @@
+#!/bin/env python
+"""
+Scan metadata sidecars and an SQLite catalog indexing them, so that scans
+can be looked up by chamber, tool, date and parameters instead of walking
+$DATA_PATH. Each scan writes a JSON sidecar next to its output (or in its
+output directory) holding the options it ran with, the VFAT mask, a
+snapshot of the VFAT registers and its timing, and adds it to the catalog
+in $DATA_PATH/scanCatalog.sqlite.
+"""
+
+import json, os, re, socket, sqlite3, time
+
+CATALOG_NAME = "scanCatalog.sqlite"
+METADATA_NAME = "scanMetadata.json"
+
+# Per-VFAT registers recorded in the snapshot taken when a scan starts
+SNAPSHOT_REGISTERS = ["ContReg0", "ContReg1", "ContReg2", "ContReg3",
+                      "IPreampIn", "IPreampFeed", "IPreampOut", "IShaper", "IShaperFeed", "IComp",
+                      "Latency", "VCal", "VThreshold1", "VThreshold2", "CalPhase"]
+
+TIMESTAMP = re.compile(r"^\d{4}\.\d{2}\.\d{2}\.\d{2}\.\d{2}$")
+
+def metadataPath(path):
+    """
+    Sidecar of a scan output, METADATA_NAME inside an output directory or
+    the output file name with a .json extension
+    """
+    if os.path.isdir(path):
+        return os.path.join(path, METADATA_NAME)
+    return os.path.splitext(path)[0] + ".json"
+
+def catalogPath(dataPath=None):
+    """
+    Catalog file in dataPath (default $DATA_PATH), None if there is no data path
+    """
+    if dataPath is None:
+        dataPath = os.getenv('DATA_PATH')
+        pass
+    if not dataPath:
+        return None
+    return os.path.join(dataPath, CATALOG_NAME)
+
+def splitScanPath(path, dataPath=None):
+    """
+    (chamber, scanType, timestamp) of an output in the
+    $DATA_PATH/<chamber>/<scanType>/<timestamp> layout made by run_scans.py,
+    Nones for outputs elsewhere
+    """
+    if dataPath is None:
+        dataPath = os.getenv('DATA_PATH')
+        pass
+    if not dataPath:
+        return None, None, None
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        path = os.path.dirname(path)
+        pass
+    rel = os.path.relpath(path, os.path.abspath(dataPath))
+    parts = rel.split(os.sep)
+    if rel.startswith(os.pardir) or len(parts) < 3 or not TIMESTAMP.match(parts[-1]):
+        return None, None, None
+    return parts[0], "/".join(parts[1:-1]), parts[-1]
+
+def snapshotRegisters(ohboard, gtx, mask=0x0, registers=SNAPSHOT_REGISTERS):
+    """
+    Values of registers on each VFAT as {register: [value per VFAT]}, None for masked VFATs
+    """
+    from gempython.tools.vfat_user_functions_uhal import readAllVFATs
+
+    snapshot = {}
+    for reg in registers:
+        vals = readAllVFATs(ohboard, gtx, reg, mask)
+        snapshot[reg] = [None if (mask >> vfat) & 0x1 else int(vals[vfat]) & 0xff for vfat in range(0,24)]
+        pass
+    return snapshot
+
+class ScanMetadata:
+    """
+    Metadata of one scan, created when the scan starts and written out with
+    finish() once it is over. options is the optparse result of the scan
+    script, all of which is recorded as the scan parameters.
+    """
+    def __init__(self, path, tool, options, ohboard=None, link=None, mask=0x0):
+        chamber, scanType, timestamp = splitScanPath(path)
+        if link is not None:
+            try:
+                from mapping.chamberInfo import chamber_config
+                chamber = chamber_config.get(link, chamber)
+            except ImportError:
+                pass
+            pass
+        self.path = os.path.abspath(path)
+        self.info = {"tool":tool,
+                     "path":self.path,
+                     "chamber":chamber,
+                     "scanType":scanType,
+                     "timestamp":timestamp,
+                     "host":socket.gethostname(),
+                     "link":link,
+                     "vfatmask":mask,
+                     "parameters":dict(vars(options)) if options is not None else {},
+                     "startTime":time.time(),
+                     "status":"running"}
+        if ohboard is not None:
+            try:
+                self.info["registers"] = snapshotRegisters(ohboard, link, mask)
+            except Exception as e:
+                print "Unable to take the register snapshot", e
+                pass
+            pass
+        return
+
+    def finish(self, status="ok", catalog=None):
+        """
+        Records the end of the scan, writes the sidecar and adds it to the
+        catalog (default $DATA_PATH/scanCatalog.sqlite), returns the sidecar name
+        """
+        self.info["endTime"]  = time.time()
+        self.info["duration"] = self.info["endTime"] - self.info["startTime"]
+        self.info["status"]   = status
+        sidecar = metadataPath(self.path)
+        with open(sidecar, "w") as outF:
+            json.dump(self.info, outF, indent=1, sort_keys=True)
+            pass
+        if catalog is None:
+            catalog = catalogPath()
+            pass
+        if catalog is not None:
+            try:
+                cat = ScanCatalog(catalog)
+                cat.add(self.info, sidecar)
+                cat.close()
+            except sqlite3.Error as e:
+                print "Unable to add %s to the scan catalog %s: %s"%(sidecar, catalog, e)
+                pass
+            pass
+        return sidecar
+
+def readMetadata(sidecar):
+    with open(sidecar) as inF:
+        return json.load(inF)
+
+class ScanCatalog:
+    """
+    SQLite index of scan metadata, one row per scan in scans and one row
+    per scan parameter in scanParams
+    """
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS scans (
+                id INTEGER PRIMARY KEY,
+                sidecar TEXT UNIQUE,
+                path TEXT,
+                chamber TEXT,
+                link INTEGER,
+                tool TEXT,
+                scanType TEXT,
+                startTime REAL,
+                endTime REAL,
+                vfatmask INTEGER,
+                status TEXT);
+            CREATE INDEX IF NOT EXISTS scansByChamber ON scans (chamber, tool, startTime);
+            CREATE INDEX IF NOT EXISTS scansByTime ON scans (startTime);
+            CREATE TABLE IF NOT EXISTS scanParams (
+                scan INTEGER REFERENCES scans(id) ON DELETE CASCADE,
+                name TEXT,
+                value TEXT,
+                num REAL);
+            CREATE INDEX IF NOT EXISTS paramsByName ON scanParams (name, num, value);
+            CREATE INDEX IF NOT EXISTS paramsByScan ON scanParams (scan);
+            """)
+        return
+
+    def add(self, info, sidecar):
+        """
+        Adds (or replaces) the scan described by the metadata info, read from sidecar
+        """
+        sidecar = os.path.abspath(sidecar)
+        with self.db:
+            old = self.db.execute("SELECT id FROM scans WHERE sidecar = ?", (sidecar,)).fetchone()
+            if old is not None:
+                self.db.execute("DELETE FROM scanParams WHERE scan = ?", (old["id"],))
+                self.db.execute("DELETE FROM scans WHERE id = ?", (old["id"],))
+                pass
+            cur = self.db.execute("""INSERT INTO scans (sidecar, path, chamber, link, tool, scanType,
+                                                        startTime, endTime, vfatmask, status)
+                                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                  (sidecar, info.get("path"), info.get("chamber"), info.get("link"),
+                                   info.get("tool"), info.get("scanType"), info.get("startTime"),
+                                   info.get("endTime"), info.get("vfatmask"), info.get("status")))
+            scanID = cur.lastrowid
+            params = []
+            for name, value in info.get("parameters", {}).items():
+                num = value if isinstance(value, (int, long, float)) else None
+                params.append((scanID, name, json.dumps(value), num))
+                pass
+            self.db.executemany("INSERT INTO scanParams (scan, name, value, num) VALUES (?, ?, ?, ?)", params)
+            pass
+        return scanID
+
+    def index(self, dataPath):
+        """
+        Adds every sidecar found below dataPath, returns the number added
+        """
+        nAdded = 0
+        for dirPath, dirNames, fileNames in os.walk(dataPath):
+            for name in fileNames:
+                if not name.endswith(".json"): continue
+                sidecar = os.path.join(dirPath, name)
+                try:
+                    info = readMetadata(sidecar)
+                except ValueError:
+                    continue
+                if not isinstance(info, dict) or "tool" not in info or "startTime" not in info: continue
+                self.add(info, sidecar)
+                nAdded += 1
+                pass
+            pass
+        return nAdded
+
+    def query(self, chamber=None, tool=None, scanType=None, since=None, until=None,
+              status=None, params={}, latest=False):
+        """
+        Scans matching all of the given criteria, newest first. since and
+        until are unix times, params maps parameter names to values, values
+        which are numbers match numerically.
+        """
+        where = []
+        args  = []
+        for column, value in [("chamber",chamber), ("tool",tool), ("scanType",scanType), ("status",status)]:
+            if value is None: continue
+            where.append("%s = ?"%(column))
+            args.append(value)
+            pass
+        if since is not None:
+            where.append("startTime >= ?")
+            args.append(since)
+            pass
+        if until is not None:
+            where.append("startTime < ?")
+            args.append(until)
+            pass
+        for name, value in params.items():
+            if isinstance(value, (int, long, float)):
+                where.append("id IN (SELECT scan FROM scanParams WHERE name = ? AND num = ?)")
+            else:
+                where.append("id IN (SELECT scan FROM scanParams WHERE name = ? AND value = ?)")
+                value = json.dumps(value)
+                pass
+            args += [name, value]
+            pass
+        sql = "SELECT * FROM scans"
+        if len(where) > 0:
+            sql += " WHERE " + " AND ".join(where)
+            pass
+        sql += " ORDER BY startTime DESC"
+        if latest:
+            sql += " LIMIT 1"
+            pass
+        return [dict(row) for row in self.db.execute(sql, args)]
+
+    def parameters(self, scanID):
+        return dict((row["name"], json.loads(row["value"]))
+                    for row in self.db.execute("SELECT name, value FROM scanParams WHERE scan = ?", (scanID,)))
+
+    def close(self):
+        self.db.close()
+        return
+
+def parseParam(param):
+    """
+    Splits a name=value query argument, value is a number when it parses as one
+    """
+    name, value = param.split("=", 1)
+    for conv in [int, float]:
+        try:
+            return name, conv(value)
+        except ValueError:
+            pass
+        pass
+    return name, value
+
+def parseDate(date):
+    """
+    Unix time of a date given as YYYY-MM-DD, YYYY-MM-DD.HH.MM or YYYY.MM.DD.HH.MM
+    """
+    date = date.replace("-", ".")
+    for fmt in ["%Y.%m.%d.%H.%M", "%Y.%m.%d"]:
+        try:
+            return time.mktime(time.strptime(date, fmt))
+        except ValueError:
+            pass
+        pass
+    raise ValueError("Unable to parse date %s"%(date))
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] query|index [dataPath]")
+    parser.add_option("--catalog", type="string", dest="catalog", default=None,
+                      help="Catalog file (default is $DATA_PATH/%s)"%(CATALOG_NAME), metavar="catalog")
+    parser.add_option("--chamber", type="string", dest="chamber", default=None,
+                      help="Only scans of this chamber", metavar="chamber")
+    parser.add_option("--tool", type="string", dest="tool", default=None,
+                      help="Only scans taken with this tool, e.g. trimChamber.py", metavar="tool")
+    parser.add_option("--scanType", type="string", dest="scanType", default=None,
+                      help="Only scans of this type, e.g. threshold/vfat/trig", metavar="scanType")
+    parser.add_option("--since", type="string", dest="since", default=None,
+                      help="Only scans started on or after this date (YYYY-MM-DD)", metavar="since")
+    parser.add_option("--until", type="string", dest="until", default=None,
+                      help="Only scans started before this date (YYYY-MM-DD)", metavar="until")
+    parser.add_option("--status", type="string", dest="status", default=None,
+                      help="Only scans which ended with this status (ok or failed)", metavar="status")
+    parser.add_option("--param", action="append", dest="params", default=[],
+                      help="Only scans run with parameter name=value, may be repeated", metavar="param")
+    parser.add_option("--latest", action="store_true", dest="latest",
+                      help="Only print the path of the most recent matching scan", metavar="latest")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1 or args[0] not in ["query", "index"]:
+        parser.print_usage()
+        exit(1)
+        pass
+
+    catalog = options.catalog
+    if catalog is None:
+        catalog = catalogPath()
+        pass
+    if catalog is None:
+        print "No catalog given and DATA_PATH is not set"
+        exit(1)
+        pass
+    cat = ScanCatalog(catalog)
+
+    if args[0] == "index":
+        dataPath = args[1] if len(args) > 1 else os.getenv('DATA_PATH')
+        print "Indexed %d scans from %s"%(cat.index(dataPath), dataPath)
+    else:
+        scans = cat.query(chamber=options.chamber, tool=options.tool, scanType=options.scanType,
+                          since=parseDate(options.since) if options.since else None,
+                          until=parseDate(options.until) if options.until else None,
+                          status=options.status,
+                          params=dict(parseParam(param) for param in options.params),
+                          latest=options.latest)
+        if options.latest:
+            if len(scans) == 0:
+                exit(1)
+                pass
+            print scans[0]["path"]
+        else:
+            for scan in scans:
+                print "%s  %-12s %-18s %-22s link %-2s 0x%06x  %-7s %s"%(time.strftime("%Y.%m.%d.%H.%M", time.localtime(scan["startTime"])),
+                                                                     scan["chamber"], scan["tool"], scan["scanType"],
+                                                                     scan["link"], scan["vfatmask"] or 0,
+                                                                     scan["status"], scan["path"])
+                pass
+            pass
+        pass
+    cat.close()
@@ -0,0 +1,412 @@
+#!/bin/env python
+"""
+Utilities to take scans in-process so that callers can use the decoded
+results directly instead of re-reading them from the output file
+"""
+
+import os, sys, time
+import numpy as np
+from gempython.tools.vfat_user_functions_uhal import *
+
+from arrayUtils import openScanOutput
+
+NVFAT = 24
+NCHAN = 128
+
+# Reasons for validateSCurves to flag a channel
+FLAG_MISSING      = 0x1
+FLAG_SATURATED    = 0x2
+FLAG_NONMONOTONIC = 0x4
+FLAG_DEADVFAT     = 0x8
+
+def decodeUltraData(words):
+    """
+    Splits raw ULTRA scan result words into (scan value, hits) arrays,
+    words which could not be read out (negative) decode to -99
+    """
+    words = np.asarray(words, dtype=np.int64)
+    vals  = np.where(words < 0, -99, (words & 0xff000000) >> 24)
+    hits  = np.where(words < 0, -99, words & 0xffffff)
+    return vals, hits
+
+def vt1WorkingPoints(words, nev, scanmin=0, maxOccupancy=0.001):
+    """
+    Working point VThreshold1 of each VFAT from the ULTRA words of a per-VFAT
+    threshold scan from scanmin, indexed as [vfat][point] with nev triggers
+    (per point or for all points): the lowest VT1 above every point with
+    more than maxOccupancy*nev hits. -1 for VFATs still above it at the last
+    point or with no hits at all.
+    """
+    vals, hits = decodeUltraData(words)
+    nev   = np.broadcast_to(np.asarray(nev, dtype=np.float64), hits.shape)
+    read  = hits >= 0
+    noisy = read & (hits > maxOccupancy*nev)
+    lastNoisy = np.where(noisy, np.arange(hits.shape[-1]), -1).max(axis=-1)
+    found = (lastNoisy + 1 < hits.shape[-1]) & (np.where(read, hits, 0).sum(axis=-1) > 0)
+    return np.where(found, scanmin + lastNoisy + 1, -1)
+
+def sprtDecided(hits, nev, tol=0.02, confidence=0.99):
+    """
+    Wald sequential probability ratio test of scan points with hits out of
+    nev triggers: True where the hit fraction is decided, at the given
+    confidence, to be below tol (or above 1-tol) rather than at least 4*tol
+    (at most 1-4*tol), i.e. where the point sits on a plateau of the curve
+    """
+    hits   = np.asarray(hits, dtype=np.float64)
+    nev    = np.asarray(nev, dtype=np.float64)
+    misses = nev - hits
+    p0, p1 = tol, 4*tol
+    accept = np.log((1. - confidence)/confidence)
+    llrLow  = hits*np.log(p1/p0) + misses*np.log((1. - p1)/(1. - p0))
+    llrHigh = misses*np.log(p1/p0) + hits*np.log((1. - p1)/(1. - p0))
+    return (nev > 0) & ((llrLow <= accept) | (llrHigh <= accept))
+
+def adaptiveBudgets(nevts):
+    """
+    Triggers of the passes of an adaptive scan, adding up to nevts: two
+    passes of nevts/16 then doubling, so that a point can stop after 1/16,
+    1/8, 1/4 or 1/2 of nevts
+    """
+    first   = max(nevts//16, 1)
+    budgets = [first]
+    while sum(budgets) < nevts:
+        budgets.append(first if len(budgets) == 1 else 2*budgets[-1])
+        pass
+    budgets[-1] -= sum(budgets) - nevts
+    if len(budgets) > 1 and budgets[-1] < first:
+        last = budgets.pop()
+        budgets[-1] += last
+        pass
+    return budgets
+
+def adaptiveUltraScan(ohboard, gtx, mode, mask, scanmin, scanmax, nevts, channel=0,
+                      confidence=0.99, tol=0.02, debug=False):
+    """
+    Takes an ULTRA scan of scanmin to scanmax in several short passes (see
+    adaptiveBudgets), each pass covering only the range of the points which
+    sprtDecided has not yet put on a plateau for some VFAT not in mask, up to
+    nevts triggers per point. Returns (words, nev) indexed as [vfat][point]:
+    words in the ULTRA format with the hits summed over the passes (-1 where
+    never read out) and nev the number of triggers sent at each point.
+    """
+    npoints = scanmax - scanmin + 1
+    hits    = np.zeros((NVFAT,npoints), dtype=np.int64)
+    nev     = np.zeros((NVFAT,npoints), dtype=np.int64)
+    decided = np.zeros((NVFAT,npoints), dtype=bool)
+    for vfat in range(0,NVFAT):
+        if (mask >> vfat) & 0x1: decided[vfat] = True
+        pass
+    for numtrigs in adaptiveBudgets(nevts):
+        points = np.flatnonzero(~decided.all(axis=0))
+        if len(points) == 0: break
+        lo, hi = points[0], points[-1]
+        configureScanModule(ohboard, gtx, mode, mask, channel = channel,
+                            scanmin = scanmin+lo, scanmax = scanmin+hi, numtrigs = int(numtrigs),
+                            useUltra = True, debug = debug)
+        startScanModule(ohboard, gtx, useUltra = True, debug = debug)
+        results = getUltraScanResults(ohboard, gtx, hi-lo+1, debug)
+        for vfat in range(0,NVFAT):
+            if (mask >> vfat) & 0x1: continue
+            words = np.asarray(results[vfat][:hi-lo+1], dtype=np.int64)
+            read  = np.flatnonzero(words >= 0)
+            hits[vfat,lo+read] += words[read] & 0xffffff
+            nev[vfat,lo+read]  += numtrigs
+            pass
+        # points never read out on the first pass are not retried
+        decided |= sprtDecided(hits, nev, tol, confidence) | (nev == 0) | (nev >= nevts)
+        pass
+    vals  = np.arange(scanmin, scanmax+1) & 0xff
+    words = np.where(nev > 0, (vals << 24) | np.minimum(hits, 0xffffff), -1)
+    return words, nev
+
+class SCurveScanData:
+    """
+    Raw result of an S-curve scan, words are indexed as [vfat][ch][point]
+    and are -1 for points which were not read out. For an adaptive scan nev
+    holds the number of triggers of each point, otherwise it is None and
+    every point had nevts.
+    """
+    def __init__(self, scanmin, scanmax, nevts, adaptive=False):
+        self.scanmin   = scanmin
+        self.scanmax   = scanmax
+        self.nevts     = nevts
+        self.words     = -np.ones((NVFAT,NCHAN,scanmax-scanmin+1), dtype=np.int64)
+        self.nev       = None
+        if adaptive:
+            self.nev   = np.zeros((NVFAT,NCHAN,scanmax-scanmin+1), dtype=np.int64)
+            pass
+        self.trimRange = np.zeros(NVFAT, dtype=np.int32)
+        self.vthr      = np.zeros(NVFAT, dtype=np.int32)
+        self.trimDAC   = np.zeros((NVFAT,NCHAN), dtype=np.int32)
+        self.chanReg   = np.zeros((NVFAT,NCHAN), dtype=np.int32)
+        self.scanned   = np.zeros((NVFAT,NCHAN), dtype=bool)
+        return
+
+    def fitInputs(self, scCH=None):
+        """
+        Returns the (x, hits, nev, valid) arguments expected by fitUtils.fitSCurves,
+        restricted to channel scCH (hits then indexed as [vfat][point]) if given
+        """
+        words   = self.words
+        scanned = self.scanned
+        nev     = self.nev
+        if scCH is not None:
+            words   = words[:,scCH]
+            scanned = scanned[:,scCH]
+            nev     = nev[:,scCH] if nev is not None else None
+            pass
+        vals, hits = decodeUltraData(words)
+        x     = np.arange(self.scanmin, self.scanmax+1)
+        valid = (words >= 0) & scanned[...,None]
+        if nev is None:
+            nev = np.where(scanned, self.nevts, 0)
+        else:
+            nev = np.where(scanned[...,None], nev, 0)
+            pass
+        return x, hits, nev, valid
+
+def scurveScan(ohboard, gtx, mask=0x0, chMin=0, chMax=127, nevts=1000,
+               latency=37, mspl=4, calPhase=0, l1aTime=250, pDel=40,
+               scanmin=0, scanmax=254, callback=None, debug=False, channels=None,
+               confidence=None, tol=0.02):
+    """
+    Takes an S-curve with the ULTRA scan module for channels chMin to chMax
+    (or the list channels if given) of every VFAT not in mask and returns
+    an SCurveScanData.
+
+    With confidence each channel is taken by adaptiveUltraScan, the points on
+    the plateaus (within tol of 0 or 1 at that confidence) stop early and the
+    turn-on gets the full nevts.
+
+    callback(scCH, scanData) is called after each channel has been read out.
+    """
+    npoints  = scanmax - scanmin + 1
+    scanData = SCurveScanData(scanmin, scanmax, nevts, adaptive=confidence is not None)
+    if channels is None:
+        channels = range(chMin,chMax+1)
+    else:
+        channels = sorted(set(int(ch) for ch in channels))
+        pass
+
+    setTriggerSource(ohboard,gtx,1)
+    configureLocalT1(ohboard, gtx, 1, 0, pDel, l1aTime, 0, debug)
+    startLocalT1(ohboard, gtx)
+
+    print 'Link %i T1 controller status: %i'%(gtx,getLocalT1Status(ohboard,gtx))
+
+    writeAllVFATs(ohboard, gtx, "Latency",  latency, mask)
+    writeAllVFATs(ohboard, gtx, "ContReg0", 0x37, mask)
+    writeAllVFATs(ohboard, gtx, "ContReg2", (mspl - 1) << 4, mask)
+    writeAllVFATs(ohboard, gtx, "CalPhase", 0xff >> (8 - calPhase), mask)
+
+    for vfat in range(0,NVFAT):
+        if (mask >> vfat) & 0x1: continue
+        scanData.trimRange[vfat] = (0x07 & readVFAT(ohboard,gtx,vfat,"ContReg3"))
+        scanData.vthr[vfat]      = (0xff & readVFAT(ohboard,gtx,vfat,"VThreshold1"))
+        for scCH in channels:
+            trimVal = (0x3f & readVFAT(ohboard,gtx,vfat,"VFATChannels.ChanReg%d"%(scCH)))
+            writeVFAT(ohboard,gtx,vfat,"VFATChannels.ChanReg%d"%(scCH),trimVal)
+            scanData.chanReg[vfat][scCH] = trimVal
+            scanData.trimDAC[vfat][scCH] = (0x1f & trimVal)
+            pass
+        pass
+
+    for scCH in channels:
+        print "Channel #"+str(scCH)
+        for vfat in range(0,NVFAT):
+            if (mask >> vfat) & 0x1: continue
+            writeVFAT(ohboard,gtx,vfat,"VFATChannels.ChanReg%d"%(scCH),scanData.chanReg[vfat][scCH]+64)
+            pass
+        if confidence is not None:
+            results, nev = adaptiveUltraScan(ohboard, gtx, scanmode.SCURVE, mask, scanmin, scanmax, nevts,
+                                             channel=scCH, confidence=confidence, tol=tol, debug=debug)
+            scanData.nev[:,scCH] = nev
+        else:
+            configureScanModule(ohboard, gtx, scanmode.SCURVE, mask, channel = scCH,
+                                scanmin = scanmin, scanmax = scanmax, numtrigs = int(nevts),
+                                useUltra = True, debug = debug)
+            printScanConfiguration(ohboard, gtx, useUltra = True, debug = debug)
+            startScanModule(ohboard, gtx, useUltra = True, debug = debug)
+            results = getUltraScanResults(ohboard, gtx, npoints, debug)
+            pass
+        for vfat in range(0,NVFAT):
+            if (mask >> vfat) & 0x1: continue
+            dataNow = results[vfat]
+            if len(dataNow) < npoints:
+                print 'Unable to index data for channel %i'%scCH
+                print dataNow
+                pass
+            nRead = min(len(dataNow),npoints)
+            scanData.words[vfat,scCH,:nRead] = dataNow[:nRead]
+            scanData.scanned[vfat,scCH] = True
+            writeVFAT(ohboard,gtx,vfat,"VFATChannels.ChanReg%d"%(scCH),scanData.chanReg[vfat][scCH])
+            pass
+        if callback is not None:
+            callback(scCH, scanData)
+            pass
+        sys.stdout.flush()
+        pass
+
+    stopLocalT1(ohboard, gtx)
+    writeAllVFATs(ohboard, gtx, "ContReg0", 0x36, mask)
+
+    return scanData
+
+def validateSCurves(scanData, maxDrop=0.2):
+    """
+    Checks the scanned channels of an SCurveScanData, returns the flags of
+    the channels to take again indexed as [vfat][ch], 0 for good channels:
+
+    FLAG_MISSING      - some points were not read out
+    FLAG_SATURATED    - a point has more hits than triggers
+    FLAG_NONMONOTONIC - the hit fraction falls more than maxDrop below its
+                        maximum over the lower points
+    FLAG_DEADVFAT     - every channel of a VFAT with no hit at all
+    """
+    x, hits, nev, valid = scanData.fitInputs()
+    if nev.ndim < hits.ndim:
+        nev = nev[...,None]
+        pass
+    nev     = np.broadcast_to(nev, hits.shape)
+    scanned = scanData.scanned
+    flags   = np.zeros(scanned.shape, dtype=np.int32)
+
+    flags[scanned & (scanData.words < 0).any(axis=-1)] |= FLAG_MISSING
+    flags[(valid & ((hits > nev) | (hits >= 0xffffff))).any(axis=-1)] |= FLAG_SATURATED
+
+    frac = np.where(valid & (nev > 0), hits/np.maximum(nev, 1.), np.nan)
+    drop = np.fmax.accumulate(frac, axis=-1) - frac
+    flags[np.where(np.isnan(drop), 0., drop).max(axis=-1) > maxDrop] |= FLAG_NONMONOTONIC
+
+    vfatHits = np.where(valid, hits, 0).sum(axis=(1,2))
+    dead     = scanned.any(axis=1) & (vfatHits == 0)
+    flags[dead[:,None] & scanned] |= FLAG_DEADVFAT
+    return flags
+
+def rescanSCurves(ohboard, gtx, scanData, flags, retries=1, maxDrop=0.2, **scanArgs):
+    """
+    Takes again, up to retries times, the channels of scanData with flags
+    from validateSCurves: each set of channels flagged for the same VFATs is
+    scanned by scurveScan with every other VFAT masked, and the flagged
+    channels whose new S-curve passes validateSCurves replace the old ones
+    in scanData. scanArgs are passed on to scurveScan. Returns the flags of
+    the channels still failing.
+    """
+    flags = flags.copy()
+    for attempt in range(0,retries):
+        if not flags.any(): break
+        groups = {}
+        for scCH in np.flatnonzero(flags.any(axis=0)):
+            vfatMask = 0xffffff
+            for vfat in np.flatnonzero(flags[:,scCH]):
+                vfatMask &= ~(0x1 << int(vfat))
+                pass
+            groups.setdefault(vfatMask, []).append(int(scCH))
+            pass
+        for vfatMask, channels in sorted(groups.items()):
+            print "Rescan %d of link %d: channels %s with vfatmask 0x%06x"%(attempt+1, gtx, channels, vfatMask)
+            rescan = scurveScan(ohboard, gtx, mask=vfatMask, channels=channels, nevts=scanData.nevts,
+                                scanmin=scanData.scanmin, scanmax=scanData.scanmax, **scanArgs)
+            fixed = (flags != 0) & rescan.scanned & (validateSCurves(rescan, maxDrop) == 0)
+            scanData.words[fixed] = rescan.words[fixed]
+            if scanData.nev is not None and rescan.nev is not None:
+                scanData.nev[fixed] = rescan.nev[fixed]
+                pass
+            flags[fixed] = 0
+            pass
+        pass
+    return flags
+
+class SCurveTree:
+    """
+    Output file holding the scurveTree, filled channel by channel from an
+    SCurveScanData so that it can be passed as the callback of scurveScan.
+    With compact the run, per-VFAT and per-channel constants are stored in
+    side trees (see treeUtils), with fmt hdf5 or npz the hits are stored as a
+    [vfat][ch][vcal] array instead (see arrayUtils). With cube the hits are
+    also written to the memory mapped cube of cubeUtils. With adaptive Nev is
+    stored for every point, from the nev of the scan data.
+    """
+    def __init__(self, filename, nevts=1000, l1aTime=250, mspl=4, latency=37,
+                 pDel=40, calPhase=0, link=0, mask=0x0, compact=False, fmt="root",
+                 scanmin=0, scanmax=254, cube=False, adaptive=False):
+        if cube and adaptive:
+            raise ValueError("The S-curve cube can not hold the per-point Nev of an adaptive scan")
+        self.mask = mask
+        self.cube = None
+        runBranches = ['Nev','l1aTime','mspl','latency','pDel','calPhase','link','utime']
+        if adaptive:
+            runBranches.remove('Nev')
+            pass
+        self.tree = openScanOutput(filename, fmt, 'scurveTree','Tree Holding CMS GEM SCurve Data',
+                                   ['Nev','vcal','Nhits','vfatN','vfatCH','trimRange','vthr','trimDAC',
+                                    'l1aTime','mspl','latency','pDel','calPhase','link','utime'],
+                                   runBranches=runBranches,
+                                   vfatBranches=['trimRange','vthr'],
+                                   channelBranches=['trimDAC'],
+                                   compact=compact, npoints=scanmax-scanmin+1, perChannel=True,
+                                   axis=('vcal',np.arange(scanmin,scanmax+1)))
+        self.buffer = self.tree.buffer
+        self.buffer.set(Nev=nevts, l1aTime=l1aTime, mspl=mspl, latency=latency,
+                        pDel=pDel, calPhase=calPhase, link=link, utime=int(time.time()))
+        if cube:
+            from cubeUtils import SCurveCube, cubePath
+            self.cube = SCurveCube(cubePath(filename), 'w+', npoints=scanmax-scanmin+1, mask=mask,
+                                   scanmin=scanmin, nevts=nevts, link=link, utime=self.buffer['utime'],
+                                   mspl=mspl, latency=latency, pDel=pDel, calPhase=calPhase, l1aTime=l1aTime)
+        else:
+            # A cube of an earlier scan would shadow this one for the readers
+            from cubeUtils import cubePath
+            if os.path.isfile(cubePath(filename)):
+                os.remove(cubePath(filename))
+                pass
+            pass
+        return
+
+    def __call__(self, scCH, scanData):
+        self.fillChannel(scCH, scanData)
+        return
+
+    def fillChannel(self, scCH, scanData):
+        self.buffer['vfatCH'] = scCH
+        for vfat in range(0,NVFAT):
+            if (self.mask >> vfat) & 0x1: continue
+            vals, hits = decodeUltraData(scanData.words[vfat,scCH])
+            self.buffer.set(vfatN=vfat, trimRange=scanData.trimRange[vfat],
+                            trimDAC=scanData.trimDAC[vfat][scCH], vthr=scanData.vthr[vfat])
+            self.tree.fillVFAT()
+            self.tree.fillChannel()
+            columns = {'vcal':vals, 'Nhits':hits}
+            if scanData.nev is not None:
+                columns['Nev'] = scanData.nev[vfat,scCH]
+                pass
+            self.tree.fillBlock(columns)
+            pass
+        self.tree.autoSave()
+        if self.cube is not None:
+            self.cube.fillChannel(scCH, scanData)
+            pass
+        return
+
+    def fillScan(self, scanData):
+        """
+        Fills every channel scanned in scanData, for writes deferred until
+        the scan is complete
+        """
+        for scCH in range(0,NCHAN):
+            if scanData.scanned[:,scCH].any():
+                self.fillChannel(scCH, scanData)
+                pass
+            pass
+        return
+
+    def autoSave(self):
+        self.tree.autoSave()
+        return
+
+    def close(self):
+        self.tree.close()
+        if self.cube is not None:
+            self.cube.close()
+            pass
+        return
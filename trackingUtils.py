@@ -0,0 +1,236 @@
+#!/bin/env python
+"""
+Utilities to read out the tracking data FIFO of the AMC
+"""
+
+import os, struct, time
+import numpy as np
+from gempython.tools.amc_user_functions_uhal import *
+
+WORDS_PER_PACKET = 7
+
+# Header of raw tracking data files: magic, header size, link, VFAT mask,
+# trigger interval in BX and start time, padded to HEADER_SIZE bytes
+TRACKING_FILE_MAGIC = 'GEMTRK01'
+HEADER_FORMAT = '<8sIIIId'
+HEADER_SIZE   = 64
+
+def eventCounters(packets):
+    """
+    Event counters of an array of tracking data packets (one packet per row)
+    """
+    return (np.asarray(packets)[:,0] & 0x00000ff0) >> 4
+
+def ecDiscontinuities(ecs, step=1):
+    """
+    Indices i for which ecs[i+1] does not follow ecs[i] by step (modulo 256)
+    """
+    ecs = np.asarray(ecs, dtype=np.int64)
+    return np.nonzero((np.diff(ecs) % 256) != step)[0]
+
+class TrackingFIFOReader:
+    """
+    Drains the tracking data FIFO of one link with block reads sized to its
+    current occupancy, storing the packets in a preallocated ring buffer
+    which keeps the last capacity packets
+    """
+    def __init__(self, amc, gtx, capacity=1<<16):
+        self.amc      = amc
+        self.gtx      = gtx
+        self.capacity = capacity
+        self.buffer   = np.zeros((capacity,WORDS_PER_PACKET), dtype=np.uint32)
+        self.reset()
+        return
+
+    def reset(self):
+        """
+        Forgets all stored packets and counters
+        """
+        self.nPackets = 0
+        self.nReads   = 0
+        self.readTime = 0.
+        self.nPolls   = 0
+        self.sumOccupancy = 0
+        self.maxOccupancy = 0
+        return
+
+    def occupancy(self):
+        return readFIFODepth(self.amc,self.gtx)["Occupancy"]
+
+    def waitForOccupancy(self, nWords, timeout):
+        """
+        Waits up to timeout seconds for the FIFO to hold nWords words,
+        returns the last occupancy seen
+        """
+        deadline = time.time() + timeout
+        depth = self.occupancy()
+        while depth < nWords and time.time() < deadline:
+            depth = self.occupancy()
+            pass
+        return depth
+
+    def store(self, words):
+        """
+        Appends complete packets from words to the ring buffer, returns the number stored
+        """
+        words = np.asarray(words, dtype=np.uint32)
+        nNew  = len(words) // WORDS_PER_PACKET
+        if nNew == 0:
+            return 0
+        packets = words[:nNew*WORDS_PER_PACKET].reshape(nNew,WORDS_PER_PACKET)[-self.capacity:]
+        start = (self.nPackets + nNew - len(packets)) % self.capacity
+        first = min(len(packets), self.capacity - start)
+        self.buffer[start:start+first] = packets[:first]
+        self.buffer[:len(packets)-first] = packets[first:]
+        self.nPackets += nNew
+        return nNew
+
+    def poll(self):
+        """
+        Reads out whatever complete packets are in the FIFO with a single block
+        read, returns the words read
+        """
+        start = time.time()
+        depth = self.occupancy()
+        self.sumOccupancy += depth
+        self.maxOccupancy  = max(self.maxOccupancy, depth)
+        nBlocks = depth // WORDS_PER_PACKET
+        words = []
+        if nBlocks > 0:
+            words = readTrackingInfo(self.amc,self.gtx,nBlocks)
+            self.nReads += 1
+            self.store(words)
+            pass
+        self.readTime += time.time() - start
+        self.nPolls   += 1
+        return words
+
+    def drain(self, timeout=1.):
+        """
+        Polls the FIFO until it is empty or timeout seconds have passed,
+        returns the number of packets read
+        """
+        nStart   = self.nPackets
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.poll()
+            if readFIFODepth(self.amc,self.gtx)["isEMPTY"] == 1:
+                break
+            pass
+        return self.nPackets - nStart
+
+    def packets(self):
+        """
+        The stored packets in readout order, at most the last capacity packets
+        """
+        if self.nPackets <= self.capacity:
+            return self.buffer[:self.nPackets]
+        start = self.nPackets % self.capacity
+        return np.concatenate((self.buffer[start:],self.buffer[:start]))
+
+    def eventCounters(self):
+        return eventCounters(self.packets())
+
+    def meanOccupancy(self):
+        """
+        Average FIFO occupancy seen by poll since the last reset
+        """
+        if self.nPolls == 0:
+            return 0.
+        return float(self.sumOccupancy)/self.nPolls
+
+    def readoutRate(self):
+        """
+        Packets per second spent in FIFO reads since the last reset
+        """
+        if self.readTime <= 0:
+            return 0.
+        return self.nPackets/self.readTime
+
+class TrackingDataWriter:
+    """
+    Streams raw 32 bit tracking data words to a binary file behind a small
+    header describing the link, VFAT mask and trigger interval. By default
+    the words go through a large buffered writer, if preallocate is given
+    the file is instead memory mapped with room for that many words (and
+    grown when it fills up).
+    """
+    def __init__(self, filename, link, vfatmask, interval, bufsize=1<<24, preallocate=0):
+        self.filename = filename
+        self.nWords   = 0
+        self.mmap     = None
+        header = struct.pack(HEADER_FORMAT, TRACKING_FILE_MAGIC, HEADER_SIZE,
+                             link, vfatmask & 0xffffffff, interval, time.time())
+        self.file = open(filename, 'wb', bufsize)
+        self.file.write(header.ljust(HEADER_SIZE, '\0'))
+        if preallocate > 0:
+            self.file.close()
+            self.file = None
+            self._map(preallocate)
+            pass
+        return
+
+    def _map(self, nWords):
+        with open(self.filename, 'r+b') as outF:
+            outF.truncate(HEADER_SIZE + 4*nWords)
+            pass
+        if self.mmap is not None:
+            self.mmap.flush()
+            pass
+        self.mmap = np.memmap(self.filename, dtype='<u4', mode='r+', offset=HEADER_SIZE, shape=(nWords,))
+        return
+
+    def write(self, words):
+        words = np.asarray(words, dtype='<u4')
+        if self.mmap is None:
+            words.tofile(self.file)
+        else:
+            if self.nWords + len(words) > len(self.mmap):
+                self._map(max(2*len(self.mmap), self.nWords + len(words)))
+                pass
+            self.mmap[self.nWords:self.nWords+len(words)] = words
+            pass
+        self.nWords += len(words)
+        return
+
+    def close(self):
+        if self.mmap is None:
+            self.file.close()
+        else:
+            self.mmap.flush()
+            self.mmap = None
+            with open(self.filename, 'r+b') as outF:
+                outF.truncate(HEADER_SIZE + 4*self.nWords)
+                pass
+            pass
+        return
+
+def openTrackingData(filename):
+    """
+    Memory maps a file written by TrackingDataWriter, returns the header as a
+    dict and the words as a read-only array of packets (one packet per row)
+    """
+    with open(filename, 'rb') as inF:
+        header = inF.read(HEADER_SIZE)
+        pass
+    magic, headerSize, link, vfatmask, interval, startTime = struct.unpack(HEADER_FORMAT, header[:struct.calcsize(HEADER_FORMAT)])
+    if magic != TRACKING_FILE_MAGIC:
+        raise ValueError("%s is not a raw tracking data file"%(filename))
+    info = {"link":link, "vfatmask":vfatmask, "interval":interval, "startTime":startTime}
+    nPackets = (os.path.getsize(filename) - headerSize) // (4*WORDS_PER_PACKET)
+    if nPackets == 0:
+        return info, np.zeros((0,WORDS_PER_PACKET), dtype='<u4')
+    words = np.memmap(filename, dtype='<u4', mode='r', offset=headerSize, shape=(nPackets*WORDS_PER_PACKET,))
+    return info, words.reshape(nPackets,WORDS_PER_PACKET)
+
+if __name__ == '__main__':
+    import sys
+    for filename in sys.argv[1:]:
+        info, packets = openTrackingData(filename)
+        print "%s: link %d, VFAT mask 0x%06x, trigger interval %d BX, %d packets"%(filename,
+                                                                                 info["link"], info["vfatmask"],
+                                                                                 info["interval"], len(packets))
+        if len(packets) > 1:
+            print "  %d event counter discontinuities"%(len(ecDiscontinuities(eventCounters(packets))))
+            pass
+        pass
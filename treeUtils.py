@@ -0,0 +1,305 @@
+#!/bin/env python
+"""
+Output trees of the scan scripts and a reader returning their rows as
+numpy arrays.
+
+In the compact schema a tree keeps only the branches which change from
+row to row, the run constants are stored once in the <name>Run tree, the
+per-VFAT constants in <name>VFAT (keyed by vfatN) and the per-channel
+constants in <name>Channel (keyed by vfatN and vfatCH). readScanTree
+joins them back so that both schemas read as the same flat table.
+
+ROOT keeps a single current directory per process, so the files and trees
+are created, filled and written holding ROOT_LOCK, letting several threads
+(trimAllChambers.py) each write their own file.
+"""
+
+import threading
+import numpy as np
+
+# held for every ROOT call of this module
+ROOT_LOCK = threading.RLock()
+
+NVFAT = 24
+NCHAN = 128
+
+RUN_SUFFIX     = "Run"
+VFAT_SUFFIX    = "VFAT"
+CHANNEL_SUFFIX = "Channel"
+ORDER_SUFFIX   = "Branches"
+
+class RecordBuffer:
+    """
+    One row of int fields held in a single contiguous buffer, also seen as
+    a one element structured array (self.record). field(name) is a one
+    element array viewing the field's slot, so it can be bound to a tree
+    branch by address and set with field[0] = value.
+    """
+    def __init__(self, fields, dtype='i4'):
+        self.fields = list(fields)
+        self.index  = dict((name, i) for i, name in enumerate(self.fields))
+        self.data   = np.zeros(len(self.fields), dtype=dtype)
+        self.record = self.data.view(dtype=[(name, dtype) for name in self.fields])
+        return
+
+    def field(self, name):
+        i = self.index[name]
+        return self.data[i:i+1]
+
+    def __getitem__(self, name):
+        return self.data[self.index[name]]
+
+    def __setitem__(self, name, value):
+        self.data[self.index[name]] = value
+        return
+
+    def set(self, **values):
+        for name, value in values.items():
+            self.data[self.index[name]] = value
+            pass
+        return
+
+    def bind(self, tree, fields=None):
+        """
+        Books one branch per field on tree, reading from this buffer
+        """
+        if fields is None:
+            fields = self.fields
+            pass
+        for name in fields:
+            tree.Branch( name, self.field(name), '%s/I'%(name) )
+            pass
+        return
+
+    def fillBlock(self, columns, fill):
+        """
+        Calls fill once per row of columns (a dict of equal length arrays,
+        one per field), with the row's values stored in the buffer
+        """
+        names = list(columns)
+        if len(names) == 0:
+            return
+        idx   = [self.index[name] for name in names]
+        block = np.empty((len(columns[names[0]]),len(names)), dtype=self.data.dtype)
+        for j, name in enumerate(names):
+            block[:,j] = columns[name]
+            pass
+        for row in block:
+            self.data[idx] = row
+            fill()
+            pass
+        return
+
+class ScanTree:
+    """
+    Tree with one int branch per name in branches, in that order. With
+    compact the branches in runBranches, vfatBranches and channelBranches
+    go to the side trees instead of every row.
+
+    Values are set through the RecordBuffer self.buffer (self.branches holds
+    the one element views of its fields), fill() stores a row, fillBlock()
+    one row per entry of a dict of columns, and fillVFAT()/fillChannel() the
+    current per-VFAT/per-channel values the first time they are called for
+    a VFAT/channel (they do nothing unless compact).
+
+    If filename is given the trees are booked in a new file of that name,
+    written and closed by close().
+    """
+    def __init__(self, name, title, branches, runBranches=(), vfatBranches=(), channelBranches=(),
+                 compact=False, filename=None):
+        with ROOT_LOCK:
+            self._book(name, title, branches, runBranches, vfatBranches, channelBranches, compact, filename)
+            pass
+        return
+
+    def _book(self, name, title, branches, runBranches, vfatBranches, channelBranches, compact, filename):
+        import ROOT as r
+        self.file = None
+        if filename is not None:
+            self.file = r.TFile(filename,'recreate')
+            pass
+        self.name     = name
+        self.order    = list(branches)
+        self.compact  = compact
+        self.buffer   = RecordBuffer(self.order)
+        self.branches = dict((branch, self.buffer.field(branch)) for branch in self.order)
+
+        self.tree = r.TTree(name,title)
+        self.runTree  = None
+        self.vfatTree = None
+        self.chanTree = None
+        if compact:
+            sideBranches = set(runBranches) | set(vfatBranches) | set(channelBranches)
+            self.buffer.bind(self.tree, [branch for branch in self.order if branch not in sideBranches])
+            self.runTree = r.TTree(name+RUN_SUFFIX, 'Run constants of %s'%(name))
+            self.buffer.bind(self.runTree, runBranches)
+            if len(vfatBranches) > 0:
+                self.vfatTree = r.TTree(name+VFAT_SUFFIX, 'Per-VFAT constants of %s'%(name))
+                self.buffer.bind(self.vfatTree, ['vfatN'] + list(vfatBranches))
+                pass
+            if len(channelBranches) > 0:
+                self.chanTree = r.TTree(name+CHANNEL_SUFFIX, 'Per-channel constants of %s'%(name))
+                self.buffer.bind(self.chanTree, ['vfatN','vfatCH'] + list(channelBranches))
+                pass
+            pass
+        else:
+            self.buffer.bind(self.tree)
+            pass
+        if self.file is not None:
+            # not the current directory, which another thread may have changed
+            for tree in self.trees():
+                tree.SetDirectory(self.file)
+                pass
+            pass
+        self.runFilled = False
+        self.vfatsSeen = set()
+        self.chansSeen = set()
+        return
+
+    def fill(self):
+        with ROOT_LOCK:
+            if self.runTree is not None and not self.runFilled:
+                self.runTree.Fill()
+                self.runFilled = True
+                pass
+            self.tree.Fill()
+            pass
+        return
+
+    def fillBlock(self, columns):
+        with ROOT_LOCK:
+            self.buffer.fillBlock(columns, self.fill)
+            pass
+        return
+
+    def fillVFAT(self):
+        vfat = self.buffer['vfatN']
+        if self.vfatTree is not None and vfat not in self.vfatsSeen:
+            with ROOT_LOCK:
+                self.vfatTree.Fill()
+                pass
+            self.vfatsSeen.add(vfat)
+            pass
+        return
+
+    def fillChannel(self):
+        key = (self.buffer['vfatN'], self.buffer['vfatCH'])
+        if self.chanTree is not None and key not in self.chansSeen:
+            with ROOT_LOCK:
+                self.chanTree.Fill()
+                pass
+            self.chansSeen.add(key)
+            pass
+        return
+
+    def trees(self):
+        return [tree for tree in [self.tree, self.runTree, self.vfatTree, self.chanTree] if tree is not None]
+
+    def autoSave(self):
+        with ROOT_LOCK:
+            for tree in self.trees():
+                tree.AutoSave("SaveSelf")
+                pass
+            pass
+        return
+
+    def write(self):
+        """
+        Writes the trees to the current directory
+        """
+        import ROOT as r
+        with ROOT_LOCK:
+            if self.runTree is not None and not self.runFilled:
+                self.runTree.Fill()
+                self.runFilled = True
+                pass
+            for tree in self.trees():
+                tree.Write()
+                pass
+            if self.compact:
+                r.TNamed(self.name+ORDER_SUFFIX, ",".join(self.order)).Write()
+                pass
+            pass
+        return
+
+    def close(self):
+        """
+        Writes the trees to the file given at construction and closes it
+        """
+        with ROOT_LOCK:
+            self.file.cd()
+            self.write()
+            self.file.Close()
+            pass
+        return
+
+def _treeArray(inF, name):
+    """
+    All branches of tree name as a structured array, None if there is no such tree
+    """
+    tree = inF.Get(name)
+    if not tree:
+        return None
+    try:
+        from root_numpy import tree2array
+        return tree2array(tree)
+    except ImportError:
+        names = [branch.GetName() for branch in tree.GetListOfBranches()]
+        rows  = [tuple(int(getattr(event,branch)) for branch in names) for event in tree]
+        return np.array(rows, dtype=[(branch,'i4') for branch in names])
+
+def readScanTree(filename, name, branches=None):
+    """
+    Rows of tree name in filename as a structured array with one field per
+    branch, a compact tree is joined with its side trees to give the same
+    table as the flat one. branches selects the fields returned.
+    """
+    import ROOT as r
+    with ROOT_LOCK:
+        inF  = r.TFile(filename)
+        rows = _treeArray(inF, name)
+        if rows is None:
+            inF.Close()
+            raise ValueError("%s has no tree %s"%(filename, name))
+        run   = _treeArray(inF, name+RUN_SUFFIX)
+        vfats = _treeArray(inF, name+VFAT_SUFFIX)
+        chans = _treeArray(inF, name+CHANNEL_SUFFIX)
+        order = inF.Get(name+ORDER_SUFFIX)
+        order = order.GetTitle().split(",") if order else None
+        inF.Close()
+        pass
+
+    columns = dict((field, rows[field]) for field in rows.dtype.names)
+    if run is not None and len(run) > 0:
+        for field in run.dtype.names:
+            columns[field] = np.full(len(rows), run[field][0], dtype='i4')
+            pass
+        pass
+    if vfats is not None:
+        for field in vfats.dtype.names:
+            if field in columns: continue
+            lut = np.zeros(NVFAT, dtype='i4')
+            lut[vfats['vfatN']] = vfats[field]
+            columns[field] = lut[rows['vfatN']]
+            pass
+        pass
+    if chans is not None:
+        for field in chans.dtype.names:
+            if field in columns: continue
+            lut = np.zeros((NVFAT,NCHAN), dtype='i4')
+            lut[chans['vfatN'],chans['vfatCH']] = chans[field]
+            columns[field] = lut[rows['vfatN'],rows['vfatCH']]
+            pass
+        pass
+
+    if order is None:
+        order = [field for field in rows.dtype.names] + sorted(set(columns) - set(rows.dtype.names))
+        pass
+    if branches is not None:
+        order = [field for field in order if field in branches]
+        pass
+    data = np.zeros(len(rows), dtype=[(field,'i4') for field in order])
+    for field in order:
+        data[field] = columns[field]
+        pass
+    return data
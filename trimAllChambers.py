@@ -0,0 +1,95 @@
+#!/bin/env python
+"""
+Script to trim all the chambers of an AMC in one process: every link in
+chamber_config is trimmed by trimChamber.trimChamber in its own thread, the
+chambers go through the trimming in lockstep, taking their Nth S-curves at
+the same time, and share one pool of fitting processes.
+"""
+
+import sys, threading
+from gempython.tools.vfat_user_functions_uhal import *
+from gempython.utils.wrappers import envCheck
+from mapping.chamberInfo import chamber_config, chamber_vfatMask
+
+from trimChamber import parser, trimChamber
+
+if __name__ == '__main__':
+    uhal.setLogLevelTo( uhal.LogLevel.WARNING )
+    (options, args) = parser.parse_args()
+
+    if options.adaptive and options.cube:
+        print "--cube can not be used with --adaptive"
+        exit(1)
+        pass
+
+    print 'trimming at z = %f'%options.ztrim
+
+    envCheck('DATA_PATH')
+    envCheck('BUILD_HOME')
+
+    dataPath = os.getenv('DATA_PATH')
+
+    from fitUtils import SCurveFitPool
+    from maskUtils import scanMask
+    from run_scans import makeScanDir
+    from trimUtils import PhaseBarrier, trimDirPath
+    import datetime
+    startTime = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")
+    print startTime
+
+    # the trees of the chambers are written from their own threads, see treeUtils.ROOT_LOCK
+    import ROOT as r
+    if hasattr(r, 'EnableThreadSafety'):
+        r.EnableThreadSafety()
+        pass
+
+    links  = sorted(chamber_config.keys())
+    fitter = SCurveFitPool(options.fitProcs)
+    sync   = PhaseBarrier(len(links))
+    status = {}
+
+    def trimLink(link, ohboard, dirPath, vfatmask):
+        try:
+            status[link] = trimChamber(ohboard, link, dirPath, options, fitter, vfatmask=vfatmask, sync=sync)
+        except Exception as e:
+            status[link] = "failed, %s"%(e)
+            print "Trimming %s on link %d failed"%(chamber_config[link], link), e
+        finally:
+            sync.leave()
+            pass
+        return
+
+    threads = []
+    for link in links:
+        trimPath = trimDirPath(dataPath, chamber_config[link], options.ztrim)
+        makeScanDir(trimPath, startTime)
+        ohboard  = getOHObject(options.slot,link,options.shelf,options.debug)
+        vfatmask = scanMask(ohboard, options, link=link, mask=options.vfatmask | chamber_vfatMask.get(link, 0x0))
+        thread   = threading.Thread(target=trimLink, args=(link, ohboard, trimPath+startTime, vfatmask),
+                                    name=chamber_config[link])
+        thread.daemon = True
+        threads.append(thread)
+        pass
+
+    try:
+        for thread in threads:
+            thread.start()
+            pass
+        # join with a timeout so that the main thread still sees Ctrl-C
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+                pass
+            pass
+    except KeyboardInterrupt:
+        print "Caught KeyboardInterrupt, terminating fits"
+        fitter.terminate()
+        exit(1)
+    fitter.close()
+
+    for link in links:
+        result = status.get(link, "not run")
+        print "%s (link %d): %s"%(chamber_config[link], link,
+                                  "trimmed" if result == 0 else "returned %s"%(result) if isinstance(result, int) else result)
+        pass
+    exit(0 if all(status.get(link) == 0 for link in links) else 1)
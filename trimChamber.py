@@ -5,243 +5,630 @@ By: Christine McLean (ch.mclean@cern.ch), Cameron Bravo (c.bravo@cern.ch), Eliza
 """
 
 import sys
-from array import array
 from gempython.tools.vfat_user_functions_uhal import *
 from gempython.utils.nesteddict import nesteddict as ndict
-from gempython.utils.wrappers import runCommand, envCheck
+from gempython.utils.wrappers import envCheck
 from mapping.chamberInfo import chamber_config
 
-from qcoptions import parser
+import numpy as np
+from calibrationStore import CalibrationStore, storePath
+from cubeUtils import openSCurveCube
+from fitUtils import PipelinedSCurveFit, SCurveEstimates, SCurveFitPool, storeEstimates, storeFitCache
+from maskUtils import detectChipIDs, scanMask
+from scanCatalog import ScanMetadata
+from scanUtils import SCurveTree, scurveScan
+from treeUtils import readScanTree
+from trimUtils import TrimConfig, loadTrimConfig, previousTrimDir, trimDirPath, writeTrimConfig
+
+from qcoptions import parser, addAdaptiveOptions, addAutoMaskOptions, addCompactOption, addCubeOption
+addAdaptiveOptions(parser)
+addAutoMaskOptions(parser)
+addCompactOption(parser)
+addCubeOption(parser)
 
 parser.add_option("--trimRange", type="string", dest="rangeFile", default=None,
                   help="Specify the file to take trim ranges from", metavar="rangeFile")
+parser.add_option("--fastEstimate", action="store_true", dest="fastEstimate",
+                  help="Trim on the S-curve estimates taken as each channel is read out, fitting only the final scans", metavar="fastEstimate")
+parser.add_option("--fitProcs", type="int", dest="fitProcs", default=None,
+                  help="Number of processes used to fit S-curves (default is one per core, 1 fits serially)", metavar="fitProcs")
+parser.add_option("--noCalStore", action="store_true", dest="noCalStore",
+                  help="Do not add the trims to the calibration store keyed by chip ID", metavar="noCalStore")
+parser.add_option("--pipeline", action="store_true", dest="pipeline",
+                  help="Fit each channel while the scan is running and act on each VFAT as soon as its fits are done", metavar="pipeline")
 parser.add_option("--dirPath", type="string", dest="dirPath", default=None,
-                  help="Specify the path where the scan data should be stored", metavar="dirPath")
+                  help="Specify the path where the scan data should be stored (default is $DATA_PATH/<chamber>/trim/z<ztrim>/<time>)", metavar="dirPath")
+parser.add_option("--retrim", action="store_true", dest="retrim",
+                  help="Start from the previous trim of the chamber and retrim only the channels which drifted", metavar="retrim")
+parser.add_option("--retrimFrom", type="string", dest="retrimFrom", default=None,
+                  help="Trim directory to start --retrim from (default is the latest under $DATA_PATH/<chamber>/trim/z<ztrim>)", metavar="retrimFrom")
+parser.add_option("--retrimTol", type="float", dest="retrimTol", default=2.0,
+                  help="Deviation from its target threshold, in VCal DAC units, above which --retrim retrims a channel (default is 2)", metavar="retrimTol")
+parser.add_option("--retrimWindow", type="int", dest="retrimWindow", default=4,
+                  help="Maximum change of a channel's trimDAC searched by --retrim (default is 4)", metavar="retrimWindow")
+parser.add_option("--trimModel", action="store_true", dest="trimModel",
+                  help="Compute the trimDACs from the trimDAC 0 and 31 scans instead of a binary search, refining only channels out of tolerance", metavar="trimModel")
+parser.add_option("--trimTol", type="float", dest="trimTol", default=1.0,
+                  help="Tolerance on the trimmed threshold of --trimModel in units of one trimDAC step (default is 1)", metavar="trimTol")
 parser.add_option("--vt1", type="int", dest="vt1",
                   help="VThreshold1 DAC value for all VFATs", metavar="vt1", default=100)
 
+# Last trimRange searched for a VFAT, the trimRange search scans 0 to MAX_TRIMRANGE
+MAX_TRIMRANGE = 4
 
-uhal.setLogLevelTo( uhal.LogLevel.WARNING )
-(options, args) = parser.parse_args()
-
-rangeFile = options.rangeFile
-ztrim = options.ztrim
-print 'trimming at z = %f'%ztrim
-
-envCheck('DATA_PATH')
-envCheck('BUILD_HOME')
-
-dataPath = os.getenv('DATA_PATH')
-
-from fitting.fitScanData import fitScanData
-import subprocess,datetime
-startTime = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")
-print startTime
-
-ohboard = getOHObject(options.slot,options.gtx,options.shelf,options.debug)
-
-if options.dirPath == None: dirPath = '%s/%s/trimming/z%f/%s'%(dataPath,chamber_config[options.gtx],ztrim,startTime)
-else: dirPath = options.dirPath
-
-# bias vfats
-biasAllVFATs(ohboard,options.gtx,0x0,enable=False)
-writeAllVFATs(ohboard, options.gtx, "VThreshold1", options.vt1, 0)
-
-CHAN_MIN = 0
-CHAN_MAX = 128
-
-masks = ndict()
-for vfat in range(0,24):
-    for ch in range(CHAN_MIN,CHAN_MAX):
-        masks[vfat][ch] = False
-
-#Find trimRange for each VFAT
-tRanges    = ndict()
-tRangeGood = ndict()
-trimVcal = ndict()
-trimCH   = ndict()
-goodSup  = ndict()
-goodInf  = ndict()
-for vfat in range(0,24):
-    tRanges[vfat] = 0
-    tRangeGood[vfat] = False
-    trimVcal[vfat] = 0
-    trimCH[vfat] = 0
-    goodSup[vfat] = -99
-    goodInf[vfat] = -99
-
-###############
-# TRIMDAC = 0
-###############
-# Configure for initial scan
-for vfat in range(0,24):
-    writeVFAT(ohboard, options.gtx, vfat, "ContReg3", tRanges[vfat],0)
-
-zeroAllVFATChannels(ohboard,options.gtx,mask=0x0)
-
-# Scurve scan with trimdac set to 0
-filename0 = "%s/SCurveData_trimdac0_range0.root"%dirPath
-runCommand(["ultraScurve.py",
-            "--shelf=%i"%(options.shelf),
-            "-s%d"%(options.slot),
-            "-g%d"%(options.gtx),
-            "--filename=%s"%(filename0),
-            "--vfatmask=0x%x"%(options.vfatmask),
-            "--nevts=%i"%(options.nevts)]
-          )
-
-muFits_0  = fitScanData(filename0)
-for vfat in range(0,24):
-    for ch in range(CHAN_MIN,CHAN_MAX):
-        if muFits_0[4][vfat][ch] < 0.1: masks[vfat][ch] = True
-
-#calculate the sup and set trimVcal
-sup = ndict()
-supCH = ndict()
-for vfat in range(0,24):
-    if(tRangeGood[vfat]): continue
-    sup[vfat] = 999.0
-    supCH[vfat] = -1
-    for ch in range(CHAN_MIN,CHAN_MAX):
-        if(masks[vfat][ch]): continue
-        if(muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch] < sup[vfat] and muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch] > 0.1): 
-            sup[vfat] = muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch]
-            supCH[vfat] = ch
-    goodSup[vfat] = sup[vfat]
-    trimVcal[vfat] = sup[vfat]
-    trimCH[vfat] = supCH[vfat]
-    
+def trimChamber(ohboard, link, dirPath, options, fitter, vfatmask=None, sync=None):
+    """
+    Trims the chamber on link of ohboard with the trimChamber.py options,
+    writing the scans and the trim configuration to dirPath and fitting with
+    the SCurveFitPool fitter, which is left open. vfatmask defaults to
+    options.vfatmask. sync is an optional trimUtils.PhaseBarrier waited on
+    before each S-curve, to take the scans of several chambers together.
+    Returns 0 once trimmed, 404 if the trim ranges or previous trim could not
+    be loaded.
+    """
+    if vfatmask is None:
+        vfatmask = options.vfatmask
+        pass
+    metadata = ScanMetadata(dirPath, "trimChamber.py", options, ohboard=ohboard, link=link, mask=vfatmask)
+    status   = "failed"
+    try:
+        result = _trimChamber(ohboard, link, dirPath, options, fitter, vfatmask, sync)
+        if result == 0:
+            status = "ok"
+            pass
+        return result
+    finally:
+        # failed trims are catalogued too
+        metadata.finish(status)
+        pass
+
+def _trimChamber(ohboard, link, dirPath, options, fitter, vfatmask, sync):
+    """
+    Body of trimChamber, which records its outcome
+    """
+    rangeFile = options.rangeFile
+    ztrim     = options.ztrim
+    dataPath  = os.getenv('DATA_PATH')
 
-if rangeFile == None:
-    #This loop determines the trimRangeDAC for each VFAT
-    for trimRange in range(0,5):
-        #Set Trim Ranges
+    def takeSCurve(filename, seed=None, mask=None, onVFAT=None, channels=None, final=False):
+        """
+        Takes an S-curve in-process, writing it to filename, and fits it in memory.
+        seed is the (mean, sigma) of a previous fit used to start the fit from.
+        onVFAT(vfat, fitSummary) is called for each scanned VFAT once its fits are
+        done, with --pipeline this happens as soon as the VFAT's last channel is fit,
+        before the scan returns if its fits are done by then.
+        channels restricts the scan to a list of channels. With --fastEstimate
+        the scans which are not final return the estimates of SCurveEstimates
+        instead of fits.
+        """
+        if mask is None:
+            mask = vfatmask
+            pass
+        if sync is not None:
+            sync.wait()
+            pass
+        pipeline  = None
+        estimates = None
+        if options.fastEstimate and not final:
+            estimates = SCurveEstimates(mask=mask)
+        elif options.pipeline:
+            pipeline = PipelinedSCurveFit(fitter, mask=mask, seed=seed, channels=channels, onVFAT=onVFAT)
+            pass
+        outTree = SCurveTree(filename, nevts=options.nevts, mspl=options.MSPL,
+                             link=link, mask=mask, compact=options.compact, cube=options.cube,
+                             adaptive=options.adaptive)
+        def callback(scCH, scanData):
+            outTree(scCH, scanData)
+            if pipeline is not None:
+                pipeline(scCH, scanData)
+                pass
+            if estimates is not None:
+                estimates(scCH, scanData)
+                pass
+            return
+        try:
+            scanData = scurveScan(ohboard, link, mask=mask, nevts=options.nevts,
+                                  mspl=options.MSPL, callback=callback, debug=options.debug,
+                                  channels=channels, tol=options.plateauTol,
+                                  confidence=options.confidence if options.adaptive else None)
+        finally:
+            outTree.close()
+            pass
+        if estimates is not None:
+            for vfat in range(0,24):
+                if (mask >> vfat) & 0x1: continue
+                if onVFAT is not None:
+                    onVFAT(vfat, estimates.summary)
+                    pass
+                pass
+            storeEstimates(filename, estimates.summary)
+            return estimates.summary
+        if pipeline is not None:
+            fitSummary = pipeline.finish()
+        else:
+            x, hits, nev, valid = scanData.fitInputs()
+            fitSummary = fitter.fit(x, hits, nev, seed=seed, valid=valid)
+            for vfat in range(0,24):
+                if (mask >> vfat) & 0x1: continue
+                if onVFAT is not None:
+                    onVFAT(vfat, fitSummary)
+                    pass
+                pass
+            pass
+        storeFitCache(filename, fitSummary, seed)
+        return fitSummary
+
+    def writeTrimDACs(trims, vfats=range(0,24)):
+        for vfat in vfats:
+            for ch in range(CHAN_MIN,CHAN_MAX):
+                writeVFAT(ohboard,link,vfat,"VFATChannels.ChanReg%d"%(ch),int(trims[vfat][ch]))
+        return
+
+    def copyScan(src, dst):
+        """
+        Copies the S-curve file src, and its cube if there is one, to dst
+        """
+        import shutil
+        from cubeUtils import cubePath
+        shutil.copyfile(src, dst)
+        if os.path.isfile(cubePath(src)):
+            shutil.copyfile(cubePath(src), cubePath(dst))
+        elif os.path.isfile(cubePath(dst)):
+            os.remove(cubePath(dst))
+        return
+
+    def refineTrims(trims, thr, target, tol, usable, lo, hi, seed, name):
+        """
+        Bisects the trimDACs of the usable channels whose threshold thr, measured
+        with trimDACs trims, is further than tol from target, between lo and hi
+        (both included), scanning only those channels. Once the bracket is down
+        to one step its endpoint not yet measured is scanned. seed(trims) gives
+        the fit seed of a scan. Returns the trimDACs closest to target and their
+        distance from it.
+        """
+        best     = trims.copy()
+        bestErr  = np.where(usable, np.abs(thr - target), 0.)
+        outOfTol = usable & (bestErr > tol)
+        loSeen   = (lo == trims)
+        hiSeen   = (hi == trims)
+        print "%d channels out of tolerance"%(outOfTol.sum())
+        for i in range(0,6):
+            narrow    = (hi - lo <= 1)
+            outOfTol &= ~(narrow & loSeen & hiSeen)
+            if not outOfTol.any(): break
+            mid   = np.where(outOfTol, np.where(narrow, np.where(loSeen, hi, lo), (lo + hi)//2), best)
+            vfats = [vfat for vfat in range(0,24) if outOfTol[vfat].any()]
+            writeTrimDACs(mid, vfats)
+            refineMask = vfatmask
+            for vfat in range(0,24):
+                if vfat not in vfats: refineMask |= (0x1 << vfat)
+            filenameRefine = "%s/SCurveData_%s%i.root"%(dirPath,name,i)
+            fitData = takeSCurve(filenameRefine, seed=seed(mid), mask=refineMask,
+                                 channels=np.flatnonzero(outOfTol.any(axis=0)))
+            thr     = fitData[0] - ztrim*fitData[1]
+            err     = np.abs(thr - target)
+            better  = outOfTol & (err < bestErr)
+            best    = np.where(better, mid, best)
+            bestErr = np.where(better, err, bestErr)
+            lo      = np.where(outOfTol & (thr > target), mid, lo)
+            hi      = np.where(outOfTol & (thr <= target), mid, hi)
+            loSeen |= outOfTol & (lo == mid)
+            hiSeen |= outOfTol & (hi == mid)
+            outOfTol &= (bestErr > tol)
+            writeTrimDACs(best, vfats)
+            pass
+        print "%d channels changed by the bisection, %d still out of tolerance"%((best != trims).sum(), (usable & (bestErr > tol)).sum())
+        return best, bestErr
+
+    def trimConfig():
+        """
+        TrimConfig of the current state of the trim
+        """
+        config = TrimConfig()
         for vfat in range(0,24):
-            writeVFAT(ohboard, options.gtx, vfat, "ContReg3", tRanges[vfat],0)
-        ###############
-        # TRIMDAC = 31
-        ###############
-        #Setting trimdac value
+            config.tRange[vfat]   = tRanges[vfat]
+            config.sup[vfat]      = goodSup[vfat]
+            config.inf[vfat]      = goodInf[vfat]
+            config.trimVcal[vfat] = trimVcal[vfat]
+            config.trimCH[vfat]   = trimCH[vfat]
+            config.vt1[vfat]      = options.vt1
+            for ch in range(CHAN_MIN,CHAN_MAX):
+                config.trimDAC[vfat][ch] = trimDACs[vfat][ch]
+                pass
+            pass
+        return config
+
+    def storeCalibration(chanMask):
+        """
+        Adds the trim to the calibration store, keyed by the chip IDs of the
+        VFATs, with the channel mask bits chanMask
+        """
+        if options.noCalStore or storePath() is None:
+            return
+        try:
+            chipIDs  = detectChipIDs(ohboard, options.shelf, options.slot, link,
+                                     ttl=options.autoMaskTTL, debug=options.debug)
+            calStore = CalibrationStore(storePath())
+            nAdded   = calStore.addTrimConfig(chipIDs, trimConfig(), chanMask, ztrim, vfatmask=vfatmask,
+                                              chamber=chamber_config.get(link), link=link,
+                                              source=os.path.abspath(dirPath))
+            calStore.close()
+            print "Added the trims of %d VFATs to %s"%(nAdded, storePath())
+        except Exception as e:
+            print "Unable to add the trims to the calibration store", e
+            pass
+        return
+
+    # bias vfats
+    biasAllVFATs(ohboard,link,0x0,enable=False)
+    writeAllVFATs(ohboard, link, "VThreshold1", options.vt1, 0)
+
+    CHAN_MIN = 0
+    CHAN_MAX = 128
+
+    masks = ndict()
+    for vfat in range(0,24):
+        for ch in range(CHAN_MIN,CHAN_MAX):
+            masks[vfat][ch] = False
+
+    #Find trimRange for each VFAT
+    tRanges    = ndict()
+    tRangeGood = ndict()
+    trimVcal = ndict()
+    trimCH   = ndict()
+    goodSup  = ndict()
+    goodInf  = ndict()
+    for vfat in range(0,24):
+        tRanges[vfat] = 0
+        tRangeGood[vfat] = False
+        trimVcal[vfat] = 0
+        trimCH[vfat] = 0
+        goodSup[vfat] = -99
+        goodInf[vfat] = -99
+
+    #Init trimDACs to all zeros
+    trimDACs = ndict()
+    for vfat in range(0,24):
+        for ch in range(CHAN_MIN,CHAN_MAX):
+            trimDACs[vfat][ch] = 0
+
+    filenameFinal = "%s/SCurveData_Trimmed.root"%dirPath
+
+    if options.retrim:
+        # Start from the previous trim and take one S-curve to find the channels
+        # which drifted from their target, then search only those, within
+        # retrimWindow of their previous trimDAC
+        prevDir = options.retrimFrom
+        if prevDir is None:
+            prevDir = previousTrimDir(trimDirPath(dataPath,chamber_config[link],ztrim), exclude=dirPath)
+            pass
+        if prevDir is None:
+            print "No previous trim found to retrim from"
+            return 404
+            pass
+        print "Retrimming from %s"%(prevDir)
+        prevConfig = loadTrimConfig(prevDir)
+        prevVT1    = set(prevConfig.vt1[vfat] for vfat in range(0,24)
+                         if not (vfatmask >> vfat) & 0x1 and prevConfig.vt1[vfat] >= 0)
+        if len(prevVT1 - set([options.vt1])) > 0:
+            # the thresholds would be compared to the targets of another VThreshold1
+            print "%s was trimmed at VThreshold1 %s, retrim it with the same --vt1"%(prevDir, ", ".join(str(vt1) for vt1 in sorted(prevVT1)))
+            return 404
+        elif len(prevVT1) == 0:
+            print "%s does not record its VThreshold1, assuming --vt1 %d"%(prevDir, options.vt1)
+            pass
         for vfat in range(0,24):
-            for scCH in range(CHAN_MIN,CHAN_MAX):
-                writeVFAT(ohboard,options.gtx,vfat,"VFATChannels.ChanReg%d"%(scCH),31)
-        
-        #Scurve scan with trimdac set to 31 (maximum trimming)
-        filename31 = "%s/SCurveData_trimdac31_range%i.root"%(dirPath,trimRange)
-        runCommand(["ultraScurve.py",
-                    "--shelf=%i"%(options.shelf),
-                    "-s%d"%(options.slot),
-                    "-g%d"%(options.gtx),
-                    "--filename=%s"%(filename31),
-                    "--vfatmask=0x%x"%(options.vfatmask),
-                    "--nevts=%i"%(options.nevts)]
-                  )
-        
-        #For each channel, check that the infimum of the scan with trimDAC = 31 is less than the subprimum of the scan with trimDAC = 0. The difference should be greater than the trimdac range.
-        muFits_31 = fitScanData(filename31)
-        
-        inf = ndict()
-        infCH = ndict()
-        #Check to see if the new trimRange is good
+            tRanges[vfat]    = int(prevConfig.tRange[vfat])
+            tRangeGood[vfat] = True
+            goodSup[vfat]    = prevConfig.sup[vfat]
+            goodInf[vfat]    = prevConfig.inf[vfat]
+            trimVcal[vfat]   = prevConfig.trimVcal[vfat]
+            trimCH[vfat]     = prevConfig.trimCH[vfat]
+            writeVFAT(ohboard, link, vfat, "ContReg3", tRanges[vfat],0)
+            pass
+        trims = prevConfig.trimDAC.copy()
+        writeTrimDACs(trims)
+
+        filenameCheck = "%s/SCurveData_retrimCheck.root"%dirPath
+        fitData = takeSCurve(filenameCheck)
+        thr     = fitData[0] - ztrim*fitData[1]
+        target  = prevConfig.trimVcal[:,None]
+        usable  = (fitData[4] > 0)
+        lo      = np.where(thr > target, trims, np.maximum(trims - options.retrimWindow, 0))
+        hi      = np.where(thr > target, np.minimum(trims + options.retrimWindow, 31), trims)
+        best, bestErr = refineTrims(trims, thr, target, options.retrimTol, usable, lo, hi,
+                                    lambda trims: (fitData[0], fitData[1]), "retrim")
         for vfat in range(0,24):
-            if(tRangeGood[vfat]): continue
-            sup[vfat] = 999.0
-            inf[vfat] = 0.0
-            supCH[vfat] = -1
-            infCH[vfat] = -1
             for ch in range(CHAN_MIN,CHAN_MAX):
-                if(masks[vfat][ch]): continue
-                if(muFits_31[0][vfat][ch] - ztrim*muFits_31[1][vfat][ch] > inf[vfat]): 
-                    inf[vfat] = muFits_31[0][vfat][ch] - ztrim*muFits_31[1][vfat][ch]
-                    infCH[vfat] = ch
-                if(muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch] < sup[vfat] and muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch] > 0.1): 
-                    sup[vfat] = muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch]
-                    supCH[vfat] = ch
-            print "vfat: %i"%vfat
-            print muFits_0[0][vfat]
-            print muFits_31[0][vfat]
-            print "sup: %f  inf: %f"%(sup[vfat],inf[vfat])
-            print "supCH: %f  infCH: %f"%(supCH[vfat],infCH[vfat])
-            print " "
-            if(inf[vfat] <= sup[vfat]):
-                tRangeGood[vfat] = True
-                goodSup[vfat] = sup[vfat]
-                goodInf[vfat] = inf[vfat]
-                trimVcal[vfat] = sup[vfat]
-                trimCH[vfat] = supCH[vfat]
-            else:
-                tRanges[vfat] += 1
-                trimVcal[vfat] = sup[vfat]
-                trimCH[vfat] = supCH[vfat]
-    print "trimRanges found"
-else:
-    try:
-        rF = TFile(rangeFile)
-        for event in rF.scurveTree:
-            if event.vcal == 10:
-                if event.vfatCH == 10:
-                    writeVFAT(ohboard, options.gtx, int(event.vfatN), "ContReg3", int(event.trimRange),0)
-                    tRanges[event.vfatN] = event.trimRange
-                pass
+                trimDACs[vfat][ch] = best[vfat][ch]
+        if (best != trims).any():
+            takeSCurve(filenameFinal, seed=(fitData[0],fitData[1]), final=True)
+        else:
+            copyScan(filenameCheck, filenameFinal)
             pass
-        pass
-    except Exception as e:
-        print "%s could not be loaded\n"%rangeFile
-        print e
-        exit(404)
-
-#Init trimDACs to all zeros
-trimDACs = ndict()
-for vfat in range(0,24):
-    for ch in range(CHAN_MIN,CHAN_MAX):
-        trimDACs[vfat][ch] = 0
-
-# This is a binary search to set each channel's trimDAC
-for i in range(0,5):
-    # First write this steps values to the VFATs
+        writeTrimConfig(dirPath, trimConfig())
+        storeCalibration(~usable)
+        return 0
+
+    ###############
+    # TRIMDAC = 0
+    ###############
+    # Configure for initial scan
+    for vfat in range(0,24):
+        writeVFAT(ohboard, link, vfat, "ContReg3", tRanges[vfat],0)
+
+    zeroAllVFATChannels(ohboard,link,mask=0x0)
+
+    # Scurve scan with trimdac set to 0
+    filename0 = "%s/SCurveData_trimdac0_range0.root"%dirPath
+    muFits_0  = takeSCurve(filename0)
+    lastFits  = muFits_0
     for vfat in range(0,24):
         for ch in range(CHAN_MIN,CHAN_MAX):
-            trimDACs[vfat][ch] += pow(2,4-i)
-            writeVFAT(ohboard,options.gtx,vfat,"VFATChannels.ChanReg%d"%(ch),trimDACs[vfat][ch])
-    # Run an SCurve
-    filenameBS = "%s/SCurveData_binarySearch%i.root"%(dirPath,i)
-    runCommand(["ultraScurve.py",
-                "--shelf=%i"%(options.shelf),
-                "-s%d"%(options.slot),
-                "-g%d"%(options.gtx),
-                "--filename=%s"%(filenameBS),
-                "--vfatmask=0x%x"%(options.vfatmask),
-                "--nevts=%i"%(options.nevts)]
-              )
-
-    # Fit Scurve data
-    fitData = fitScanData(filenameBS)
-    # Now use data to determine the new trimDAC value
+            if muFits_0[4][vfat][ch] < 0.1: masks[vfat][ch] = True
+
+    #calculate the sup and set trimVcal
+    sup = ndict()
+    supCH = ndict()
     for vfat in range(0,24):
+        if(tRangeGood[vfat]): continue
+        sup[vfat] = 999.0
+        supCH[vfat] = -1
         for ch in range(CHAN_MIN,CHAN_MAX):
-            if(fitData[0][vfat][ch] - ztrim*fitData[1][vfat][ch] < trimVcal[vfat]): trimDACs[vfat][ch] -= pow(2,4-i)
-
-# Now take a scan with trimDACs found by binary search
-for vfat in range(0,24):
-    for ch in range(CHAN_MIN,CHAN_MAX):
-        writeVFAT(ohboard,options.gtx,vfat,"VFATChannels.ChanReg%d"%(ch),trimDACs[vfat][ch])
-
-filenameFinal = "%s/SCurveData_Trimmed.root"%dirPath
-runCommand(["ultraScurve.py",
-            "--shelf=%i"%(options.shelf),
-            "-s%d"%(options.slot),
-            "-g%d"%(options.gtx),
-            "--filename=%s"%(filenameFinal),
-            "--vfatmask=0x%x"%(options.vfatmask),
-            "--nevts=%i"%(options.nevts)]
-          )
-
-scanFilename = '%s/scanInfo.txt'%dirPath
-outF = open(scanFilename,'w')
-outF.write('vfat/I:tRange/I:sup/D:inf/D:trimVcal/D:trimCH/D\n')
-for vfat in range(0,24):
-    outF.write('%i  %i  %f  %f  %f  %i\n'%(vfat,tRanges[vfat],goodSup[vfat],goodInf[vfat],trimVcal[vfat],trimCH[vfat]))
-    pass
-outF.close()
-
-exit(0)
+            if(masks[vfat][ch]): continue
+            if(muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch] < sup[vfat] and muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch] > 0.1): 
+                sup[vfat] = muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch]
+                supCH[vfat] = ch
+        goodSup[vfat] = sup[vfat]
+        trimVcal[vfat] = sup[vfat]
+        trimCH[vfat] = supCH[vfat]
+    
+
+    inf = ndict()
+    infCH = ndict()
+    # Fit of the trimDAC = 31 scan at each VFAT's latest trimRange
+    mean31  = np.zeros((24,CHAN_MAX))
+    sigma31 = np.zeros((24,CHAN_MAX))
+    def storeFits31(vfat, muFits_31):
+        mean31[vfat]  = muFits_31[0][vfat]
+        sigma31[vfat] = muFits_31[1][vfat]
+        return
+
+    def checkTrimRange(vfat, muFits_31):
+        """
+        For each channel, check that the infimum of the scan with trimDAC = 31 is less than the
+        subprimum of the scan with trimDAC = 0, otherwise move the VFAT to the next trimRange
+        """
+        if(tRangeGood[vfat]): return
+        storeFits31(vfat, muFits_31)
+        sup[vfat] = 999.0
+        inf[vfat] = 0.0
+        supCH[vfat] = -1
+        infCH[vfat] = -1
+        for ch in range(CHAN_MIN,CHAN_MAX):
+            if(masks[vfat][ch]): continue
+            if(muFits_31[0][vfat][ch] - ztrim*muFits_31[1][vfat][ch] > inf[vfat]): 
+                inf[vfat] = muFits_31[0][vfat][ch] - ztrim*muFits_31[1][vfat][ch]
+                infCH[vfat] = ch
+            if(muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch] < sup[vfat] and muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch] > 0.1): 
+                sup[vfat] = muFits_0[0][vfat][ch] - ztrim*muFits_0[1][vfat][ch]
+                supCH[vfat] = ch
+        print "vfat: %i"%vfat
+        print muFits_0[0][vfat]
+        print muFits_31[0][vfat]
+        print "sup: %f  inf: %f"%(sup[vfat],inf[vfat])
+        print "supCH: %f  infCH: %f"%(supCH[vfat],infCH[vfat])
+        print " "
+        if(inf[vfat] <= sup[vfat]):
+            tRangeGood[vfat] = True
+            goodSup[vfat] = sup[vfat]
+            goodInf[vfat] = inf[vfat]
+            trimVcal[vfat] = sup[vfat]
+            trimCH[vfat] = supCH[vfat]
+        else:
+            tRanges[vfat] += 1
+            trimVcal[vfat] = sup[vfat]
+            trimCH[vfat] = supCH[vfat]
+            if options.pipeline and tRanges[vfat] <= MAX_TRIMRANGE:
+                # Configure the next trimRange without waiting for the other VFATs,
+                # as without --pipeline no range past the last one scanned is written
+                writeVFAT(ohboard, link, vfat, "ContReg3", tRanges[vfat],0)
+                pass
+        return
+
+    if rangeFile == None:
+        #This loop determines the trimRangeDAC for each VFAT
+        for trimRange in range(0,MAX_TRIMRANGE+1):
+            rangeMask = vfatmask
+            if options.pipeline:
+                # VFATs whose trimRange has converged need no further scans
+                for vfat in range(0,24):
+                    if(tRangeGood[vfat]): rangeMask |= (0x1 << vfat)
+                if (rangeMask & 0xffffff) == 0xffffff:
+                    break
+                pass
+            if trimRange == 0 or not options.pipeline:
+                #Set Trim Ranges
+                for vfat in range(0,24):
+                    writeVFAT(ohboard, link, vfat, "ContReg3", tRanges[vfat],0)
+                ###############
+                # TRIMDAC = 31
+                ###############
+                #Setting trimdac value
+                for vfat in range(0,24):
+                    for scCH in range(CHAN_MIN,CHAN_MAX):
+                        writeVFAT(ohboard,link,vfat,"VFATChannels.ChanReg%d"%(scCH),31)
+                pass
+        
+            #Scurve scan with trimdac set to 31 (maximum trimming)
+            filename31 = "%s/SCurveData_trimdac31_range%i.root"%(dirPath,trimRange)
+            muFits_31 = takeSCurve(filename31, seed=(lastFits[0],lastFits[1]), mask=rangeMask, onVFAT=checkTrimRange)
+            lastFits  = muFits_31
+        print "trimRanges found"
+        if options.trimModel:
+            # The VFATs which never validated end past the last trimRange scanned,
+            # the model needs their response to trimDAC = 31 at that trimRange
+            unscanned = [vfat for vfat in range(0,24)
+                         if not (vfatmask >> vfat) & 0x1 and not tRangeGood[vfat]]
+            if len(unscanned) > 0:
+                rangeMask = vfatmask
+                for vfat in range(0,24):
+                    if vfat not in unscanned: rangeMask |= (0x1 << vfat)
+                for vfat in unscanned:
+                    writeVFAT(ohboard, link, vfat, "ContReg3", tRanges[vfat],0)
+                    for scCH in range(CHAN_MIN,CHAN_MAX):
+                        writeVFAT(ohboard,link,vfat,"VFATChannels.ChanReg%d"%(scCH),31)
+                filename31 = "%s/SCurveData_trimdac31_range%i.root"%(dirPath,MAX_TRIMRANGE+1)
+                takeSCurve(filename31, seed=(lastFits[0],lastFits[1]), mask=rangeMask, onVFAT=storeFits31)
+                pass
+            pass
+    else:
+        try:
+            cube = openSCurveCube(rangeFile)
+            if cube is not None:
+                try:
+                    vfats      = np.flatnonzero(cube.scanned().any(axis=1))
+                    trimRanges = np.array(cube.trimRange[vfats])
+                finally:
+                    cube.close()
+                    pass
+            else:
+                rangeData  = readScanTree(rangeFile, 'scurveTree', ['vfatN','vfatCH','vcal','trimRange'])
+                rangeData  = rangeData[(rangeData['vcal'] == 10) & (rangeData['vfatCH'] == 10)]
+                vfats      = rangeData['vfatN']
+                trimRanges = rangeData['trimRange']
+                pass
+            for vfat, trimRange in zip(vfats, trimRanges):
+                writeVFAT(ohboard, link, int(vfat), "ContReg3", int(trimRange),0)
+                tRanges[int(vfat)] = int(trimRange)
+                pass
+            pass
+        except Exception as e:
+            print "%s could not be loaded\n"%rangeFile
+            print e
+            return 404
+        if options.trimModel:
+            # The model needs the response to trimDAC = 31 at the loaded trimRanges
+            for vfat in range(0,24):
+                for scCH in range(CHAN_MIN,CHAN_MAX):
+                    writeVFAT(ohboard,link,vfat,"VFATChannels.ChanReg%d"%(scCH),31)
+            filename31 = "%s/SCurveData_trimdac31.root"%(dirPath)
+            lastFits   = takeSCurve(filename31, seed=(lastFits[0],lastFits[1]), onVFAT=storeFits31)
+            pass
+
+    if options.trimModel:
+        # The threshold mean - ztrim*sigma falls linearly with trimDAC between the
+        # trimDAC = 0 and 31 scans, so each channel's trimDAC follows from the
+        # target trimVcal directly
+        thr0    = muFits_0[0] - ztrim*muFits_0[1]
+        thr31   = mean31 - ztrim*sigma31
+        target  = np.array([trimVcal[vfat] for vfat in range(0,24)], dtype=float)[:,None]
+        slope   = (thr31 - thr0)/31.
+        usable  = (slope < 0) & (muFits_0[4] > 0) & (sigma31 > 0)
+        usable &= ~np.array([[masks[vfat][ch] for ch in range(CHAN_MIN,CHAN_MAX)] for vfat in range(0,24)])
+        slope   = np.where(usable, slope, -1.)
+        tol     = options.trimTol*np.abs(slope)
+        trims   = np.where(usable, np.clip(np.rint((target - thr0)/slope), 0, 31), 0).astype(int)
+        print "Model trimDACs computed for %d channels"%(usable.sum())
+
+        def predictedFits(trims):
+            return (muFits_0[0] + (mean31 - muFits_0[0])*trims/31., muFits_0[1] + (sigma31 - muFits_0[1])*trims/31.)
+
+        # Verification scan with the model trimDACs
+        writeTrimDACs(trims)
+        filenameModel = "%s/SCurveData_trimModel.root"%dirPath
+        fitData = takeSCurve(filenameModel, seed=predictedFits(trims))
+        thr     = fitData[0] - ztrim*fitData[1]
+
+        # Bisect the channels out of tolerance, in a bracket twice the size of
+        # their remaining offset in trimDAC steps as given by the slope
+        offset  = 2*np.ceil(np.abs(thr - target)/np.abs(slope)).astype(int) + 1
+        lo      = np.where(thr > target, trims, np.maximum(trims - offset, 0))
+        hi      = np.where(thr > target, np.minimum(trims + offset, 31), trims)
+        best, bestErr = refineTrims(trims, thr, target, tol, usable, lo, hi, predictedFits, "trimRefine")
+
+        for vfat in range(0,24):
+            for ch in range(CHAN_MIN,CHAN_MAX):
+                trimDACs[vfat][ch] = best[vfat][ch]
+        if (best != trims).any():
+            # Take the final scan with the refined trimDACs
+            takeSCurve(filenameFinal, seed=predictedFits(best), final=True)
+        else:
+            copyScan(filenameModel, filenameFinal)
+            pass
+    else:
+        def binarySearchStep(step):
+            """
+            Returns the function which uses the fit of a binary search step to determine
+            the new trimDAC values of a VFAT, and writes the values for the following
+            step (or the final values after the last step) to it
+            """
+            def updateTrimDACs(vfat, fitData):
+                for ch in range(CHAN_MIN,CHAN_MAX):
+                    if(fitData[0][vfat][ch] - ztrim*fitData[1][vfat][ch] < trimVcal[vfat]): trimDACs[vfat][ch] -= pow(2,4-step)
+                    if step < 4: trimDACs[vfat][ch] += pow(2,3-step)
+                    writeVFAT(ohboard,link,vfat,"VFATChannels.ChanReg%d"%(ch),trimDACs[vfat][ch])
+                    pass
+                return
+            return updateTrimDACs
+
+        # This is a binary search to set each channel's trimDAC
+        # First write the first step's values to the VFATs
+        for vfat in range(0,24):
+            for ch in range(CHAN_MIN,CHAN_MAX):
+                trimDACs[vfat][ch] += pow(2,4)
+                writeVFAT(ohboard,link,vfat,"VFATChannels.ChanReg%d"%(ch),trimDACs[vfat][ch])
+        for i in range(0,5):
+            # Run an SCurve
+            filenameBS = "%s/SCurveData_binarySearch%i.root"%(dirPath,i)
+
+            # Fit Scurve data, starting from the previous step's fit, and use it to determine the new trimDAC values
+            fitData  = takeSCurve(filenameBS, seed=(lastFits[0],lastFits[1]), onVFAT=binarySearchStep(i))
+            lastFits = fitData
+
+        # Now take a scan with trimDACs found by binary search
+
+        takeSCurve(filenameFinal, seed=(lastFits[0],lastFits[1]), final=True)
+        pass
+    writeTrimConfig(dirPath, trimConfig())
+    storeCalibration(np.array([[masks[vfat][ch] for ch in range(CHAN_MIN,CHAN_MAX)] for vfat in range(0,24)]))
+    return 0
+
+if __name__ == '__main__':
+    uhal.setLogLevelTo( uhal.LogLevel.WARNING )
+    (options, args) = parser.parse_args()
+
+    if options.adaptive and options.cube:
+        print "--cube can not be used with --adaptive"
+        exit(1)
+        pass
+
+    print 'trimming at z = %f'%options.ztrim
+
+    envCheck('DATA_PATH')
+    envCheck('BUILD_HOME')
+
+    dataPath = os.getenv('DATA_PATH')
+
+    import datetime
+    startTime = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")
+    print startTime
+
+    ohboard = getOHObject(options.slot,options.gtx,options.shelf,options.debug)
+    fitter  = SCurveFitPool(options.fitProcs)
+
+    if options.dirPath == None:
+        # the trim directory searched by --retrim, as for trimAllChambers.py
+        from run_scans import makeScanDir
+        trimPath = trimDirPath(dataPath,chamber_config[options.gtx],options.ztrim)
+        makeScanDir(trimPath, startTime)
+        dirPath  = trimPath+startTime
+    else: dirPath = options.dirPath
+
+    try:
+        status = trimChamber(ohboard, options.gtx, dirPath, options, fitter, vfatmask=scanMask(ohboard, options))
+    finally:
+        fitter.close()
+        pass
+
+    exit(status)
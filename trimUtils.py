@@ -0,0 +1,164 @@
+#!/bin/env python
+"""
+Reading and writing the configuration found by trimChamber.py: the
+per-VFAT scanInfo.txt and the per-channel chConfig.txt of a trim directory,
+and the barrier keeping the chambers trimmed by trimAllChambers.py in step
+"""
+
+import os, threading
+import numpy as np
+
+from treeUtils import NCHAN, NVFAT
+
+SCANINFO_NAME = "scanInfo.txt"
+CHCONFIG_NAME = "chConfig.txt"
+TRIMMED_NAME  = "SCurveData_Trimmed.root"
+
+class TrimConfig:
+    """
+    Per-VFAT trimRange, sup, inf, trimVcal, trimCH and VThreshold1 and
+    per-channel trimDAC of a trim, vt1 is -1 for trims which predate it
+    """
+    def __init__(self):
+        self.tRange   = np.zeros(NVFAT, dtype=int)
+        self.sup      = -99*np.ones(NVFAT)
+        self.inf      = -99*np.ones(NVFAT)
+        self.trimVcal = np.zeros(NVFAT)
+        self.trimCH   = np.zeros(NVFAT, dtype=int)
+        self.vt1      = -np.ones(NVFAT, dtype=int)
+        self.trimDAC  = np.zeros((NVFAT,NCHAN), dtype=int)
+        return
+
+def trimDirPath(dataPath, chamber, ztrim):
+    """
+    Directory holding the trims of chamber at ztrim, as created by run_scans.py
+    """
+    return "%s/%s/trim/z%f/"%(dataPath, chamber, ztrim)
+
+def previousTrimDir(trimPath, exclude=None):
+    """
+    The trim directory under trimPath which current points to, or the most
+    recent one holding a scanInfo.txt if current does not or is exclude
+    (the directory of the trim being taken), None if there is none
+    """
+    exclude = os.path.realpath(exclude) if exclude is not None else None
+    current = os.path.join(trimPath, "current")
+    if (os.path.isfile(os.path.join(current, SCANINFO_NAME)) and
+        os.path.realpath(current) != exclude):
+        return os.path.realpath(current)
+    if not os.path.isdir(trimPath):
+        return None
+    for name in sorted(os.listdir(trimPath), reverse=True):
+        path = os.path.realpath(os.path.join(trimPath, name))
+        if name == "current" or path == exclude: continue
+        if os.path.isfile(os.path.join(path, SCANINFO_NAME)):
+            return path
+        pass
+    return None
+
+def loadTrimConfig(dirPath):
+    """
+    TrimConfig of the trim in dirPath, the trimDACs are taken from its
+    chConfig.txt, or from the trimmed S-curve file if it predates them
+    """
+    config = TrimConfig()
+    with open(os.path.join(dirPath, SCANINFO_NAME)) as inF:
+        inF.readline()
+        for line in inF:
+            fields = line.split()
+            if len(fields) < 6: continue
+            vfat = int(fields[0])
+            config.tRange[vfat]   = int(fields[1])
+            config.sup[vfat]      = float(fields[2])
+            config.inf[vfat]      = float(fields[3])
+            config.trimVcal[vfat] = float(fields[4])
+            config.trimCH[vfat]   = int(float(fields[5]))
+            if len(fields) > 6:
+                config.vt1[vfat]  = int(fields[6])
+                pass
+            pass
+        pass
+
+    chConfig = os.path.join(dirPath, CHCONFIG_NAME)
+    if os.path.isfile(chConfig):
+        data = np.loadtxt(chConfig, skiprows=1, dtype=int, ndmin=2)
+        config.trimDAC[data[:,0],data[:,1]] = data[:,2]
+        return config
+
+    from cubeUtils import openSCurveCube
+    trimmed = os.path.join(dirPath, TRIMMED_NAME)
+    cube = openSCurveCube(trimmed)
+    if cube is not None:
+        config.trimDAC[...] = cube.trimDAC
+        cube.close()
+    else:
+        from treeUtils import readScanTree
+        data = readScanTree(trimmed, 'scurveTree', ['vfatN','vfatCH','vcal','trimDAC'])
+        data = data[data['vcal'] == 10]
+        config.trimDAC[data['vfatN'],data['vfatCH']] = data['trimDAC']
+        pass
+    return config
+
+def writeTrimConfig(dirPath, config):
+    """
+    Writes the scanInfo.txt and chConfig.txt of config to dirPath
+    """
+    outF = open(os.path.join(dirPath, SCANINFO_NAME),'w')
+    outF.write('vfat/I:tRange/I:sup/D:inf/D:trimVcal/D:trimCH/D:vt1/I\n')
+    for vfat in range(0,NVFAT):
+        outF.write('%i  %i  %f  %f  %f  %i  %i\n'%(vfat,config.tRange[vfat],config.sup[vfat],config.inf[vfat],
+                                                    config.trimVcal[vfat],config.trimCH[vfat],config.vt1[vfat]))
+        pass
+    outF.close()
+
+    outF = open(os.path.join(dirPath, CHCONFIG_NAME),'w')
+    outF.write('vfatN/I:vfatCH/I:trimDAC/I\n')
+    for vfat in range(0,NVFAT):
+        for ch in range(0,NCHAN):
+            outF.write('%i\t%i\t%i\n'%(vfat,ch,config.trimDAC[vfat][ch]))
+            pass
+        pass
+    outF.close()
+    return
+
+class PhaseBarrier:
+    """
+    Barrier of the chambers trimmed together: wait() returns once every
+    chamber still trimming has called it, so that their Nth scans start
+    together. A chamber which is done, or failed, calls leave() so that the
+    others do not wait for it.
+    """
+    def __init__(self, parties):
+        self.parties    = parties
+        self.waiting    = 0
+        self.generation = 0
+        self.cond       = threading.Condition()
+        return
+
+    def _release(self):
+        self.waiting     = 0
+        self.generation += 1
+        self.cond.notify_all()
+        return
+
+    def wait(self):
+        with self.cond:
+            generation    = self.generation
+            self.waiting += 1
+            if self.waiting >= self.parties:
+                self._release()
+                return
+            while generation == self.generation:
+                self.cond.wait()
+                pass
+            pass
+        return
+
+    def leave(self):
+        with self.cond:
+            self.parties -= 1
+            if self.waiting > 0 and self.waiting >= self.parties:
+                self._release()
+                pass
+            pass
+        return
@@ -8,13 +8,16 @@ Modified By:
 """
 
 import sys, os, random, time
-from array import array
 
 import gempython.tools.optohybrid_user_functions_uhal as oh
 from gempython.tools.vfat_user_functions_uhal import *
 import gempython.tools.amc_user_functions_uhal as amc
 
-from qcoptions import parser
+from qcoptions import parser, addAutoMaskOptions, addCompactOption, addFormatOption
+addAutoMaskOptions(parser)
+addCompactOption(parser)
+addFormatOption(parser)
+from scanCatalog import ScanMetadata
 
 parser.add_option("--amc13local", action="store_true", dest="amc13local",
                   help="Set up for using AMC13 local trigger generator", metavar="amc13local")
@@ -68,38 +71,26 @@ if options.debug:
 else:
     uhal.setLogLevelTo(uhal.LogLevel.ERROR)
 
-from ROOT import TFile,TTree
-filename = options.filename
-myF = TFile(filename,'recreate')
-myT = TTree('latTree','Tree Holding CMS GEM Latency Data')
-
-Nev = array( 'i', [ 0 ] )
-Nev[0] = options.nevts
-myT.Branch( 'Nev', Nev, 'Nev/I' )
-vth = array( 'i', [ 0 ] )
-myT.Branch( 'vth', vth, 'vth/I' )
-vth1 = array( 'i', [ 0 ] )
-myT.Branch( 'vth1', vth1, 'vth1/I' )
-vth2 = array( 'i', [ 0 ] )
-myT.Branch( 'vth2', vth2, 'vth2/I' )
-lat = array( 'i', [ 0 ] )
-myT.Branch( 'lat', lat, 'lat/I' )
-Nhits = array( 'i', [ 0 ] )
-myT.Branch( 'Nhits', Nhits, 'Nhits/I' )
-vfatN = array( 'i', [ 0 ] )
-myT.Branch( 'vfatN', vfatN, 'vfatN/I' )
-mspl = array( 'i', [ -1 ] )
-myT.Branch( 'mspl', mspl, 'mspl/I' )
-vfatCH = array( 'i', [ 0 ] )
-myT.Branch( 'vfatCH', vfatCH, 'vfatCH/I' )
-link = array( 'i', [ 0 ] )
-myT.Branch( 'link', link, 'link/I' )
-link[0] = options.gtx
-utime = array( 'i', [ 0 ] )
-myT.Branch( 'utime', utime, 'utime/I' )
+from arrayUtils import checkFormat, openScanOutput, outputName
+from maskUtils import scanMask
+from scanUtils import decodeUltraData
+
+if checkFormat(options.format):
+    print(checkFormat(options.format))
+    exit(1)
+
+filename = outputName(options.filename,options.format)
+outTree = openScanOutput(filename, options.format, 'latTree','Tree Holding CMS GEM Latency Data',
+                         ['Nev','vth','vth1','vth2','lat','Nhits','vfatN','mspl','vfatCH','link','utime'],
+                         runBranches=['Nev','vfatCH','link','utime'],
+                         vfatBranches=['vth','vth1','vth2','mspl'],
+                         compact=options.compact, npoints=options.scanmax-options.scanmin+1)
+
+outData = outTree.buffer
+outData.set(Nev=options.nevts, mspl=-1, link=options.gtx)
 
 import subprocess,datetime,time
-utime[0] = int(time.time())
+outData['utime'] = int(time.time())
 startTime = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")
 print(startTime)
 Date = startTime
@@ -115,9 +106,12 @@ ohboard  = oh.getOHObject(options.slot,options.gtx,options.shelf,options.debug)
 LATENCY_MIN = options.scanmin
 LATENCY_MAX = options.scanmax
 
-N_EVENTS = Nev[0]
+N_EVENTS = options.nevts
+
+mask = scanMask(ohboard, options)
 
-mask = options.vfatmask
+metadata = ScanMetadata(filename, "ultraLatency.py", options, ohboard=ohboard, link=options.gtx, mask=mask)
+status   = "ok"
 
 try:
     writeAllVFATs(ohboard, options.gtx, "ContReg0",    0x37, mask)
@@ -233,26 +227,22 @@ try:
     amc13board.enableLocalL1A(True)
     sys.stdout.flush()
     for i in range(0,24):
-        vfatN[0] = i
-        dataNow = scanData[i]
-        mspl[0]  = msplvals[vfatN[0]]
-        vth1[0]  = vt1vals[vfatN[0]]
-        vth2[0]  = vt2vals[vfatN[0]]
-        vth[0]   = vthvals[vfatN[0]]
+        dataNow = scanData[i][:LATENCY_MAX-LATENCY_MIN+1]
+        outData.set(vfatN=i, mspl=msplvals[i], vth1=vt1vals[i], vth2=vt2vals[i], vth=vthvals[i])
+        outTree.fillVFAT()
         if options.debug:
-            print("{0} {1} {2} {3} {4}".format(vfatN[0], mspl[0], vth1[0], vth2[0], vth[0]))
+            print("{0} {1} {2} {3} {4}".format(i, msplvals[i], vt1vals[i], vt2vals[i], vthvals[i]))
             sys.stdout.flush()
             pass
-        for VC in range(LATENCY_MAX-LATENCY_MIN+1):
-            lat[0]   = int((dataNow[VC] & 0xff000000) >> 24)
-            Nhits[0] = int(dataNow[VC] & 0xffffff)
-            if options.debug:
-                print("{0} {1} 0x{2:x} {3} {4}".format(i,VC,dataNow[VC],lat[0],Nhits[0]))
+        vals, hits = decodeUltraData(dataNow)
+        if options.debug:
+            for VC in range(len(dataNow)):
+                print("{0} {1} 0x{2:x} {3} {4}".format(i,VC,dataNow[VC],vals[VC],hits[VC]))
                 pass
-            myT.Fill()
             pass
+        outTree.fillBlock({'lat':vals, 'Nhits':hits})
         pass
-    myT.AutoSave("SaveSelf")
+    outTree.autoSave()
     writeAllVFATs(ohboard, options.gtx, "ContReg0",    0x36, mask)
     if options.internal:
         oh.stopLocalT1(ohboard, options.gtx)
@@ -263,9 +253,9 @@ try:
         # amc13board.write(amc13board.Board.T1, 'CONF.DIAG.DISABLE_EVB', 0x0)
         pass
 except Exception as e:
-    myT.AutoSave("SaveSelf")
+    outTree.autoSave()
+    status = "failed"
     print("An exception occurred", e)
 finally:
-    myF.cd()
-    myT.Write()
-    myF.Close()
+    outTree.close()
+    metadata.finish(status)
@@ -5,10 +5,16 @@ By: Cameron Bravo (c.bravo@cern.ch)
 """
 
 import sys
-from array import array
+import numpy as np
 from gempython.tools.vfat_user_functions_uhal import *
 
-from qcoptions import parser
+from qcoptions import parser, addAdaptiveOptions, addAutoMaskOptions, addCompactOption, addCubeOption, addFormatOption, addMonitorOption
+addAdaptiveOptions(parser)
+addAutoMaskOptions(parser)
+addCompactOption(parser)
+addCubeOption(parser)
+addFormatOption(parser)
+addMonitorOption(parser)
 
 parser.add_option("-f", "--filename", type="string", dest="filename", default="SCurveData.root",
                   help="Specify Output Filename", metavar="filename")
@@ -20,6 +26,18 @@ parser.add_option("--L1Atime", type="int", dest = "L1Atime", default = 250,
                   help="Specify time between L1As in bx", metavar="L1Atime")
 parser.add_option("--pulseDelay", type="int", dest = "pDel", default = 40,
                   help="Specify time of pulse before L1A in bx", metavar="pDel")
+parser.add_option("--channels", type="string", dest="channels", default=None,
+                  help="Comma separated list of channels to scan instead of chMin to chMax", metavar="channels")
+parser.add_option("--chStride", type="int", dest="chStride", default=None,
+                  help="Scan every chStride-th channel from chMin to chMax", metavar="chStride")
+parser.add_option("--estimates", action="store_true", dest="estimates",
+                  help="Estimate the S-curve mean and sigma of each channel as it is read out and write them to <filename>_estimates.npz", metavar="estimates")
+parser.add_option("--health", action="store_true", dest="health",
+                  help="Write per-VFAT threshold and noise estimates of the scanned channels, compared to the last trim (default is every 16th channel)", metavar="health")
+parser.add_option("--reference", type="string", dest="reference", default=None,
+                  help="S-curve file --health compares to (default is the trimmed S-curve of the latest trim at ztrim)", metavar="reference")
+parser.add_option("--rescan", type="int", dest="rescan", default=0,
+                  help="Check the S-curves once the scan is done and take the failing channels again up to RESCAN times before writing the output", metavar="rescan")
 parser.add_option("--chMin", type="int", dest = "chMin", default = 0,
                   help="Specify minimum channel number to scan", metavar="chMin")
 parser.add_option("--chMax", type="int", dest = "chMax", default = 127,
@@ -35,75 +53,54 @@ if options.CalPhase < 0 or options.CalPhase > 8:
     print 'CalPhase must be in the range 0-8'
     exit(1)
     pass
+if options.adaptive and options.cube:
+    print "--cube can not be used with --adaptive"
+    exit(1)
+    pass
 if not (0 <= options.chMin <= options.chMax < 128):
     print "chMin %d not in [0,%d] or chMax %d not in [%d,127] or chMax < chMin"%(options.chMin,options.chMax,options.chMax,options.chMin)
     exit(1)
     pass
 
+channels = None
+if options.channels is not None:
+    try:
+        channels = sorted(set(int(ch) for ch in options.channels.split(",")))
+    except ValueError:
+        print "Unable to parse the channel list %s"%(options.channels)
+        exit(1)
+        pass
+    if len(channels) == 0 or channels[0] < 0 or channels[-1] > 127:
+        print "Channels %s not in [0,127]"%(options.channels)
+        exit(1)
+        pass
+elif options.chStride is not None or options.health:
+    stride = options.chStride if options.chStride is not None else 16
+    if stride < 1:
+        print "chStride must be at least 1"
+        exit(1)
+        pass
+    channels = range(options.chMin,options.chMax+1,stride)
+    pass
+
 if options.debug:
     uhal.setLogLevelTo( uhal.LogLevel.DEBUG )
 else:
     uhal.setLogLevelTo( uhal.LogLevel.ERROR )
 
-import ROOT as r
-filename = options.filename
-myF = r.TFile(filename,'recreate')
-myT = r.TTree('scurveTree','Tree Holding CMS GEM SCurve Data')
-
-Nev = array( 'i', [ 0 ] )
-Nev[0] = options.nevts
-myT.Branch( 'Nev', Nev, 'Nev/I' )
-
-vcal = array( 'i', [ 0 ] )
-myT.Branch( 'vcal', vcal, 'vcal/I' )
-
-Nhits = array( 'i', [ 0 ] )
-myT.Branch( 'Nhits', Nhits, 'Nhits/I' )
-
-vfatN = array( 'i', [ 0 ] )
-myT.Branch( 'vfatN', vfatN, 'vfatN/I' )
+from arrayUtils import checkFormat, outputName
+from monitorUtils import ScanPublisher, monitorPath
+from scanCatalog import ScanMetadata
+from maskUtils import scanMask
+from scanUtils import (FLAG_DEADVFAT, FLAG_MISSING, FLAG_NONMONOTONIC, FLAG_SATURATED,
+                       SCurveTree, rescanSCurves, scurveScan, validateSCurves)
 
-vfatCH = array( 'i', [ 0 ] )
-myT.Branch( 'vfatCH', vfatCH, 'vfatCH/I' )
-
-trimRange = array( 'i', [ 0 ] )
-myT.Branch( 'trimRange', trimRange, 'trimRange/I' )
-
-vthr = array( 'i', [ 0 ] )
-myT.Branch( 'vthr', vthr, 'vthr/I' )
-
-trimDAC = array( 'i', [ 0 ] )
-myT.Branch( 'trimDAC', trimDAC, 'trimDAC/I' )
-
-l1aTime = array( 'i', [ 0 ] )
-myT.Branch( 'l1aTime', l1aTime, 'l1aTime/I' )
-l1aTime[0] = options.L1Atime
-
-mspl = array( 'i', [ 0 ] )
-myT.Branch( 'mspl', mspl, 'mspl/I' )
-mspl[0] = options.MSPL
-
-latency = array( 'i', [ 0 ] )
-myT.Branch( 'latency', latency, 'latency/I' )
-latency[0] = options.latency
-
-pDel = array( 'i', [ 0 ] )
-myT.Branch( 'pDel', pDel, 'pDel/I' )
-pDel[0] = options.pDel
-
-calPhase = array( 'i', [ 0 ] )
-myT.Branch( 'calPhase', calPhase, 'calPhase/I' )
-calPhase[0] = options.CalPhase
-
-link = array( 'i', [ 0 ] )
-myT.Branch( 'link', link, 'link/I' )
-link[0] = options.gtx
-
-utime = array( 'i', [ 0 ] )
-myT.Branch( 'utime', utime, 'utime/I' )
+if checkFormat(options.format):
+    print checkFormat(options.format)
+    exit(1)
+    pass
 
-import subprocess,datetime,time
-utime[0] = int(time.time())
+import datetime
 startTime = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")
 print startTime
 Date = startTime
@@ -113,85 +110,172 @@ ohboard = getOHObject(options.slot,options.gtx,options.shelf,options.debug)
 SCURVE_MIN = 0
 SCURVE_MAX = 254
 
-N_EVENTS = Nev[0]
 CHAN_MIN = options.chMin
-CHAN_MAX = options.chMax + 1
+CHAN_MAX = options.chMax
 if options.debug:
-    CHAN_MAX = 5
+    CHAN_MAX = 4
+    if channels is not None:
+        channels = [ch for ch in channels if ch <= CHAN_MAX]
+        if len(channels) == 0:
+            print "No channel to scan up to channel %d with --debug"%(CHAN_MAX)
+            exit(1)
+            pass
+        pass
     pass
 
-mask = options.vfatmask
-
-try:
-    setTriggerSource(ohboard,options.gtx,1)
-    configureLocalT1(ohboard, options.gtx, 1, 0, options.pDel, options.L1Atime, 0, options.debug)
-    startLocalT1(ohboard, options.gtx)
-
-    print 'Link %i T1 controller status: %i'%(options.gtx,getLocalT1Status(ohboard,options.gtx))
-
-    #biasAllVFATs(ohboard,options.gtx,0x0,enable=False)
-    #writeAllVFATs(ohboard, options.gtx, "VThreshold1", 100, 0)
+mask = scanMask(ohboard, options)
+
+outTree = SCurveTree(options.filename, nevts=options.nevts, l1aTime=options.L1Atime,
+                     mspl=options.MSPL, latency=options.latency, pDel=options.pDel,
+                     calPhase=options.CalPhase, link=options.gtx, mask=mask,
+                     compact=options.compact, fmt=options.format, cube=options.cube,
+                     scanmin=SCURVE_MIN, scanmax=SCURVE_MAX, adaptive=options.adaptive)
+metadata = ScanMetadata(outputName(options.filename,options.format), "ultraScurve.py", options, ohboard=ohboard, link=options.gtx, mask=mask)
+status   = "ok"
+
+publisher = None
+if options.monitor:
+    publisher = ScanPublisher(monitorPath(options.shelf,options.slot,options.gtx), mask=mask,
+                              tool="ultraScurve.py", link=options.gtx, nevts=options.nevts,
+                              scanmin=SCURVE_MIN, scanmax=SCURVE_MAX)
+    pass
 
-    writeAllVFATs(ohboard, options.gtx, "Latency",    options.latency, mask)
-    writeAllVFATs(ohboard, options.gtx, "ContReg0", 0x37, mask)
-    writeAllVFATs(ohboard, options.gtx, "ContReg2",   (options.MSPL - 1) << 4, mask)
-    writeAllVFATs(ohboard, options.gtx, "CalPhase",  0xff >> (8 - options.CalPhase), mask)
+estimates = None
+if options.estimates:
+    from fitUtils import SCurveEstimates
+    estimates = SCurveEstimates(mask=mask)
+    pass
 
+# with --rescan the output is written once the failing channels were taken again
+partial = {}
+def callback(scCH, scanData):
+    if options.rescan > 0:
+        partial['scanData'] = scanData
+    else:
+        outTree(scCH, scanData)
+        if estimates is not None:
+            estimates(scCH, scanData)
+            pass
+        pass
+    if publisher is not None:
+        publisher(scCH, scanData)
+        pass
+    return
+
+def reportFlags(flags, what):
+    for flag, reason in [(FLAG_MISSING,"missing points"), (FLAG_SATURATED,"saturated points"),
+                         (FLAG_NONMONOTONIC,"non-monotonic S-curves"), (FLAG_DEADVFAT,"VFATs with no hits")]:
+        nFlagged = np.count_nonzero(flags & flag)
+        if nFlagged > 0:
+            print "%s: %d channels with %s"%(what, nFlagged, reason)
+            pass
+        pass
+    return
+
+def referenceFile():
+    """
+    S-curve file the --health estimates are compared to, None if there is none
+    """
+    if options.reference is not None:
+        return options.reference
+    if not os.getenv('DATA_PATH'):
+        return None
+    from mapping.chamberInfo import chamber_config
+    from trimUtils import TRIMMED_NAME, previousTrimDir, trimDirPath
+    if options.gtx not in chamber_config:
+        return None
+    trimDir = previousTrimDir(trimDirPath(os.getenv('DATA_PATH'), chamber_config[options.gtx], options.ztrim))
+    if trimDir is None or not os.path.isfile(os.path.join(trimDir, TRIMMED_NAME)):
+        return None
+    return os.path.join(trimDir, TRIMMED_NAME)
+
+def writeHealth(scanData):
+    """
+    Fits the scanned channels and writes the per-VFAT threshold (S-curve
+    mean) and noise (sigma) estimates with their errors, and their change
+    from the reference, to <filename>_health.txt. The changes are averaged
+    over the channels fit in both, so that their errors do not include the
+    channel to channel spread.
+    """
+    from fitUtils import fitSCurveFile, fitSCurves, summarizeVFATs
+    x, hits, nev, valid = scanData.fitInputs()
+    fitSummary = fitSCurves(x, hits, nev, valid=valid)
+    nFit, thr, thrErr, noise, noiseErr = summarizeVFATs(fitSummary, channels)
+    refFile = referenceFile()
+    ref = None
+    if refFile is not None:
+        try:
+            refSummary = fitSCurveFile(refFile)
+            both = (fitSummary[4] > 0) & (np.asarray(refSummary[4]) > 0)
+            diff = summarizeVFATs([fitSummary[0] - refSummary[0], fitSummary[1] - refSummary[1], None, None, both], channels)
+            # set last, so that the comparison is either complete or left out
+            ref  = summarizeVFATs(refSummary, channels)
+        except Exception as e:
+            print "Unable to fit the reference %s"%(refFile), e
+            ref = None
+            pass
+        pass
+    healthFile = "%s_health.txt"%(os.path.splitext(outputName(options.filename,options.format))[0])
+    outF = open(healthFile,'w')
+    outF.write('vfatN/I:nCh/I:thr/D:thrErr/D:noise/D:noiseErr/D:refThr/D:refNoise/D:dThr/D:dThrErr/D:dNoise/D:dNoiseErr/D\n')
+    print "Health of link %d from %d channels per VFAT%s"%(options.gtx, len(channels) if channels is not None else CHAN_MAX-CHAN_MIN+1,
+                                                          ", compared to %s"%(refFile) if ref is not None else "")
+    print "VFAT nCh   thr +/- err     noise +/- err      dThr (pull)   dNoise (pull)"
     for vfat in range(0,24):
         if (mask >> vfat) & 0x1: continue
-        for scCH in range(CHAN_MIN,CHAN_MAX):
-            trimVal = (0x3f & readVFAT(ohboard,options.gtx,vfat,"VFATChannels.ChanReg%d"%(scCH)))
-            writeVFAT(ohboard,options.gtx,vfat,"VFATChannels.ChanReg%d"%(scCH),trimVal)
-
-    for scCH in range(CHAN_MIN,CHAN_MAX):
-        vfatCH[0] = scCH
-        print "Channel #"+str(scCH)
-        for vfat in range(0,24):
-            if (mask >> vfat) & 0x1: continue
-            trimVal = (0x3f & readVFAT(ohboard,options.gtx,vfat,"VFATChannels.ChanReg%d"%(scCH)))
-            writeVFAT(ohboard,options.gtx,vfat,"VFATChannels.ChanReg%d"%(scCH),trimVal+64)
-        configureScanModule(ohboard, options.gtx, scanmode.SCURVE, mask, channel = scCH,
-                            scanmin = SCURVE_MIN, scanmax = SCURVE_MAX, numtrigs = int(N_EVENTS),
-                            useUltra = True, debug = options.debug)
-        printScanConfiguration(ohboard, options.gtx, useUltra = True, debug = options.debug)
-        startScanModule(ohboard, options.gtx, useUltra = True, debug = options.debug)
-        scanData = getUltraScanResults(ohboard, options.gtx, SCURVE_MAX - SCURVE_MIN + 1, options.debug)
-        for i in range(0,24):
-            if (mask >> i) & 0x1: continue
-            vfatN[0] = i
-            dataNow = scanData[i]
-            trimRange[0] = (0x07 & readVFAT(ohboard,options.gtx, i,"ContReg3"))
-            trimDAC[0]   = (0x1f & readVFAT(ohboard,options.gtx, i,"VFATChannels.ChanReg%d"%(scCH)))
-            vthr[0]      = (0xff & readVFAT(ohboard,options.gtx, i,"VThreshold1"))
-            for VC in range(SCURVE_MAX-SCURVE_MIN+1):
-                try:
-                    vcal[0]  = int((dataNow[VC] & 0xff000000) >> 24)
-                    Nhits[0] = int(dataNow[VC] & 0xffffff)
-                except IndexError:
-                    print 'Unable to index data for channel %i'%scCH
-                    print dataNow
-                    vcal[0]  = -99
-                    Nhits[0] = -99
-                finally:
-                    myT.Fill()
-        for vfat in range(0,24):
-            if (mask >> vfat) & 0x1: continue
-            trimVal = (0x3f & readVFAT(ohboard,options.gtx,vfat,"VFATChannels.ChanReg%d"%(scCH)))
-            writeVFAT(ohboard,options.gtx,vfat,"VFATChannels.ChanReg%d"%(scCH),trimVal)
-        myT.AutoSave("SaveSelf")
-        sys.stdout.flush()
+        refThr, refNoise, dThr, dThrErr, dNoise, dNoiseErr = [np.nan]*6
+        if ref is not None:
+            refThr, refNoise = ref[1][vfat], ref[3][vfat]
+            dThr, dThrErr, dNoise, dNoiseErr = diff[1][vfat], diff[2][vfat], diff[3][vfat], diff[4][vfat]
+            pass
+        outF.write('%i\t%i\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\n'%(vfat,nFit[vfat],thr[vfat],thrErr[vfat],noise[vfat],noiseErr[vfat],
+                                                                         refThr,refNoise,dThr,dThrErr,dNoise,dNoiseErr))
+        print "%4d %3d %6.2f +/- %4.2f  %5.2f +/- %4.2f  %6.2f (%5.1f)  %6.2f (%5.1f)"%(vfat,nFit[vfat],thr[vfat],thrErr[vfat],
+                                                                                 noise[vfat],noiseErr[vfat],dThr,dThr/dThrErr,
+                                                                                 dNoise,dNoise/dNoiseErr)
         pass
-    stopLocalT1(ohboard, options.gtx)
-    writeAllVFATs(ohboard, options.gtx, "ContReg0",    0x36, mask)
+    outF.close()
+    return
 
+try:
+    scanData = scurveScan(ohboard, options.gtx, mask=mask, chMin=CHAN_MIN, chMax=CHAN_MAX, channels=channels,
+               nevts=options.nevts, latency=options.latency, mspl=options.MSPL,
+               calPhase=options.CalPhase, l1aTime=options.L1Atime, pDel=options.pDel,
+               scanmin=SCURVE_MIN, scanmax=SCURVE_MAX, callback=callback, debug=options.debug,
+               confidence=options.confidence if options.adaptive else None, tol=options.plateauTol)
+    if options.rescan > 0:
+        flags = validateSCurves(scanData)
+        reportFlags(flags, "Validation")
+        if flags.any():
+            flags = rescanSCurves(ohboard, options.gtx, scanData, flags, retries=options.rescan,
+                                  latency=options.latency, mspl=options.MSPL, calPhase=options.CalPhase,
+                                  l1aTime=options.L1Atime, pDel=options.pDel, debug=options.debug,
+                                  confidence=options.confidence if options.adaptive else None, tol=options.plateauTol)
+            reportFlags(flags, "After %d rescans"%(options.rescan))
+            pass
+        partial.clear()
+        outTree.fillScan(scanData)
+        if estimates is not None:
+            estimates.fillScan(scanData)
+            pass
+        pass
+    if estimates is not None:
+        from fitUtils import storeEstimates
+        storeEstimates(outputName(options.filename,options.format), estimates.summary)
+        pass
+    if options.health:
+        writeHealth(scanData)
+        pass
 except Exception as e:
-    myT.AutoSave("SaveSelf")
+    if 'scanData' in partial:
+        outTree.fillScan(partial['scanData'])
+        pass
+    outTree.autoSave()
+    status = "failed"
     print "An exception occurred", e
 finally:
-    myF.cd()
-    myT.Write()
-    myF.Close()
-
-
-
-
+    outTree.close()
+    if publisher is not None:
+        publisher.close(status)
+        pass
+    metadata.finish(status)
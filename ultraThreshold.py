@@ -9,12 +9,17 @@ Modified By:
 """
 
 import sys, os, random, time
-from array import array
 
 from gempython.tools.optohybrid_user_functions_uhal import *
 from gempython.tools.vfat_user_functions_uhal import *
 
-from qcoptions import parser
+from qcoptions import parser, addAdaptiveOptions, addAutoMaskOptions, addCompactOption, addFormatOption, addMonitorOption
+addAdaptiveOptions(parser)
+addAutoMaskOptions(parser)
+addCompactOption(parser)
+addFormatOption(parser)
+addMonitorOption(parser)
+from scanCatalog import ScanMetadata
 
 parser.add_option("--vt2", type="int", dest="vt2", default=0,
                   help="Specify VT2 to use", metavar="vt2")
@@ -22,8 +27,14 @@ parser.add_option("-f", "--filename", type="string", dest="filename", default="V
                   help="Specify Output Filename", metavar="filename")
 parser.add_option("--perchannel", action="store_true", dest="perchannel",
                   help="Run a per-channel VT1 scan", metavar="perchannel")
+parser.add_option("--maxOccupancy", type="float", dest="maxOccupancy", default=0.001,
+                  help="Fraction of events with hits below which --writeVFATConfig puts the working point VT1 of a VFAT (default is 0.001)", metavar="maxOccupancy")
+parser.add_option("--noCalStore", action="store_true", dest="noCalStore",
+                  help="Do not add the VT1 found by --writeVFATConfig to the calibration store keyed by chip ID", metavar="noCalStore")
 parser.add_option("--trkdata", action="store_true", dest="trkdata",
                   help="Run a per-VFAT VT1 scan using tracking data (default is to use trigger data)", metavar="trkdata")
+parser.add_option("--writeVFATConfig", type="string", dest="writeVFATConfig", default=None,
+                  help="Write the working point VT1 and trimRange of each VFAT found by the scan to this file, as read by confChamber.py --vfatConfig", metavar="writeVFATConfig")
 
 (options, args) = parser.parse_args()
 
@@ -31,61 +42,160 @@ if options.vt2 not in range(256):
     print "Invalid VT2 specified: %d, must be in range [0,255]"%(options.vt2)
     exit(1)
 
+if options.writeVFATConfig and options.perchannel:
+    print "--writeVFATConfig needs a per-VFAT scan, it can not be used with --perchannel"
+    exit(1)
+    pass
+if options.writeVFATConfig and options.adaptive:
+    # --adaptive stops the points known to be below plateauTol, far above maxOccupancy
+    print "--writeVFATConfig needs every point taken with nevts, it can not be used with --adaptive"
+    exit(1)
+    pass
+
 if options.debug:
     uhal.setLogLevelTo( uhal.LogLevel.DEBUG )
 else:
     uhal.setLogLevelTo( uhal.LogLevel.ERROR )
 
-import ROOT as r
-filename = options.filename
-myF = r.TFile(filename,'recreate')
-myT = r.TTree('thrTree','Tree Holding CMS GEM VT1 Data')
-
-Nev = array( 'i', [ 0 ] )
-Nev[0] = options.nevts
-myT.Branch( 'Nev', Nev, 'Nev/I' )
-vth = array( 'i', [ 0 ] )
-myT.Branch( 'vth', vth, 'vth/I' )
-vth1 = array( 'i', [ 0 ] )
-myT.Branch( 'vth1', vth1, 'vth1/I' )
-vth2 = array( 'i', [ 0 ] )
-myT.Branch( 'vth2', vth2, 'vth2/I' )
-vth2[0] = options.vt2
-Nhits = array( 'i', [ 0 ] )
-myT.Branch( 'Nhits', Nhits, 'Nhits/I' )
-vfatN = array( 'i', [ 0 ] )
-myT.Branch( 'vfatN', vfatN, 'vfatN/I' )
-vfatCH = array( 'i', [ 0 ] )
-myT.Branch( 'vfatCH', vfatCH, 'vfatCH/I' )
-trimRange = array( 'i', [ 0 ] )
-myT.Branch( 'trimRange', trimRange, 'trimRange/I' )
-link = array( 'i', [ 0 ] )
-myT.Branch( 'link', link, 'link/I' )
-link[0] = options.gtx
-mode = array( 'i', [ 0 ] )
-myT.Branch( 'mode', mode, 'mode/I' )
-utime = array( 'i', [ 0 ] )
-myT.Branch( 'utime', utime, 'utime/I' )
+import numpy as np
+from arrayUtils import checkFormat, openScanOutput, outputName
+from monitorUtils import ScanPublisher, monitorPath
+from maskUtils import scanMask
+from scanUtils import adaptiveUltraScan, decodeUltraData, vt1WorkingPoints
+
+if checkFormat(options.format):
+    print checkFormat(options.format)
+    exit(1)
+    pass
+
+THRESH_MIN = 0
+THRESH_MAX = 254
+
+filename = outputName(options.filename,options.format)
+runBranches = ['Nev','vth2','link','mode','utime']
+if options.adaptive:
+    # Nev is stored for every point
+    runBranches.remove('Nev')
+    pass
+outTree = openScanOutput(filename, options.format, 'thrTree','Tree Holding CMS GEM VT1 Data',
+                         ['Nev','vth','vth1','vth2','Nhits','vfatN','vfatCH','trimRange','link','mode','utime'],
+                         runBranches=runBranches,
+                         vfatBranches=['trimRange'],
+                         compact=options.compact, npoints=THRESH_MAX-THRESH_MIN+1,
+                         perChannel=options.perchannel, axis=('vth1',np.arange(THRESH_MIN,THRESH_MAX+1)))
+
+outData = outTree.buffer
+outData.set(Nev=options.nevts, vth2=options.vt2, link=options.gtx)
 
 import subprocess,datetime,time
-utime[0] = int(time.time())
+outData['utime'] = int(time.time())
 startTime = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")
 print startTime
 Date = startTime
 
 ohboard = getOHObject(options.slot,options.gtx,options.shelf,options.debug)
 
-THRESH_MIN = 0
-THRESH_MAX = 254
-
-N_EVENTS = Nev[0]
+N_EVENTS = options.nevts
 CHAN_MIN = 0
 CHAN_MAX = 128
 if options.debug:
     CHAN_MAX = 5
     pass
 
-mask = options.vfatmask
+mask = scanMask(ohboard, options)
+
+metadata = ScanMetadata(filename, "ultraThreshold.py", options, ohboard=ohboard, link=options.gtx, mask=mask)
+status   = "ok"
+
+publisher = None
+if options.monitor:
+    publisher = ScanPublisher(monitorPath(options.shelf,options.slot,options.gtx), mask=mask,
+                              tool="ultraThreshold.py", link=options.gtx, nevts=N_EVENTS,
+                              scanmin=THRESH_MIN, scanmax=THRESH_MAX)
+    pass
+
+def takeUltraScan(mode, channel=0):
+    """
+    Returns the ULTRA scan results of each VFAT and, with --adaptive, the
+    number of triggers of each point (None otherwise)
+    """
+    if options.adaptive:
+        return adaptiveUltraScan(ohboard, options.gtx, mode, mask, THRESH_MIN, THRESH_MAX, N_EVENTS,
+                                 channel=channel, confidence=options.confidence, tol=options.plateauTol,
+                                 debug=options.debug)
+    configureScanModule(ohboard, options.gtx, mode, mask, channel=channel,
+                        scanmin=THRESH_MIN, scanmax=THRESH_MAX,
+                        numtrigs=int(N_EVENTS),
+                        useUltra=True, debug=options.debug)
+    printScanConfiguration(ohboard, options.gtx, useUltra=True, debug=options.debug)
+
+    startScanModule(ohboard, options.gtx, useUltra=True, debug=options.debug)
+    return getUltraScanResults(ohboard, options.gtx, THRESH_MAX - THRESH_MIN + 1, options.debug), None
+
+trimRanges = {}
+
+def fillVFAT(vfat, scCH, scanData, nev):
+    outData['vfatN']     = vfat
+    outData['trimRange'] = (0x07 & readVFAT(ohboard,options.gtx, vfat,"ContReg3"))
+    trimRanges[vfat]     = outData['trimRange']
+    outTree.fillVFAT()
+    vals, hits = decodeUltraData(scanData[vfat][:THRESH_MAX-THRESH_MIN+1])
+    columns = {'vth1':vals, 'vth':options.vt2 - vals, 'Nhits':hits}
+    if nev is not None:
+        columns['Nev'] = nev[vfat]
+        hits = np.where((hits >= 0) & (nev[vfat] > 0), np.rint(hits*float(N_EVENTS)/np.maximum(nev[vfat],1)), hits)
+        pass
+    outTree.fillBlock(columns)
+    if publisher is not None:
+        publisher.publishBlock(vfat, scCH, THRESH_MIN, hits)
+        pass
+    return
+
+def writeVFATConfig(scanData):
+    """
+    Writes the working point VT1 of each VFAT, from vt1WorkingPoints, with
+    its trimRange to the --writeVFATConfig file and the calibration store
+    """
+    npoints = THRESH_MAX - THRESH_MIN + 1
+    words   = -np.ones((24,npoints), dtype=np.int64)
+    for vfat in range(0,24):
+        if (mask >> vfat) & 0x1: continue
+        nRead = min(len(scanData[vfat]),npoints)
+        words[vfat,:nRead] = scanData[vfat][:nRead]
+        pass
+    vt1 = vt1WorkingPoints(words, N_EVENTS, scanmin=THRESH_MIN, maxOccupancy=options.maxOccupancy)
+
+    outF = open(options.writeVFATConfig,'w')
+    outF.write('vfatN/I:vt1/I:trimRange/I\n')
+    for vfat in range(0,24):
+        if (mask >> vfat) & 0x1: continue
+        if vt1[vfat] < 0:
+            print "No working point found for VFAT%d, it is left out of %s"%(vfat, options.writeVFATConfig)
+            continue
+        print "VFAT%d: VT1 %d"%(vfat, vt1[vfat])
+        outF.write('%i\t%i\t%i\n'%(vfat, vt1[vfat], trimRanges[vfat]))
+        pass
+    outF.close()
+
+    from calibrationStore import CalibrationStore, storePath
+    if options.noCalStore or storePath() is None:
+        return
+    try:
+        from maskUtils import MISSING_CHIPIDS, detectChipIDs
+        chipIDs  = detectChipIDs(ohboard, options.shelf, options.slot, options.gtx,
+                                 ttl=options.autoMaskTTL, debug=options.debug)
+        calStore = CalibrationStore(storePath())
+        when     = time.time()
+        for vfat in range(0,24):
+            if (mask >> vfat) & 0x1 or vt1[vfat] < 0 or chipIDs[vfat] in MISSING_CHIPIDS: continue
+            calStore.addDAC(chipIDs[vfat], "VThreshold1", vt1[vfat], link=options.gtx, vfat=vfat,
+                            source=os.path.abspath(filename), when=when)
+            pass
+        calStore.close()
+    except Exception as e:
+        print "Unable to add the VT1 to the calibration store", e
+        pass
+    return
 
 try:
     writeAllVFATs(ohboard, options.gtx, "Latency",     0, mask)
@@ -93,76 +203,52 @@ try:
     writeAllVFATs(ohboard, options.gtx, "VThreshold2", options.vt2, mask)
 
     if options.perchannel:
-        mode[0] = scanmode.THRESHCH
+        outData['mode'] = scanmode.THRESHCH
         sendL1A(ohboard, options.gtx, interval=250, number=0)
 
         for scCH in range(CHAN_MIN,CHAN_MAX):
-            vfatCH[0] = scCH
+            outData['vfatCH'] = scCH
             print "Channel #"+str(scCH)
-            configureScanModule(ohboard, options.gtx, mode[0], mask, channel=scCH,
-                                scanmin=THRESH_MIN, scanmax=THRESH_MAX,
-                                numtrigs=int(N_EVENTS),
-                                useUltra=True, debug=options.debug)
-            printScanConfiguration(ohboard, options.gtx, useUltra=True, debug=options.debug)
-
-            startScanModule(ohboard, options.gtx, useUltra=True, debug=options.debug)
-            scanData = getUltraScanResults(ohboard, options.gtx, THRESH_MAX - THRESH_MIN + 1, options.debug)
+            scanData, nev = takeUltraScan(outData['mode'], channel=scCH)
             sys.stdout.flush()
             for i in range(0,24):
-            	if (mask >> i) & 0x1: continue
-                vfatN[0] = i
-                dataNow      = scanData[i]
-                trimRange[0] = (0x07 & readVFAT(ohboard,options.gtx, i,"ContReg3"))
-                for VC in range(THRESH_MAX-THRESH_MIN+1):
-                    vth1[0]  = int((dataNow[VC] & 0xff000000) >> 24)
-                    vth[0]   = vth2[0] - vth1[0]
-                    Nhits[0] = int(dataNow[VC] & 0xffffff)
-                    myT.Fill()
-                    pass
+                if (mask >> i) & 0x1: continue
+                fillVFAT(i, scCH, scanData, nev)
                 pass
-            myT.AutoSave("SaveSelf")
+            outTree.autoSave()
             pass
 
         stopLocalT1(ohboard, options.gtx)
         pass
     else:
         if options.trkdata:
-            mode[0] = scanmode.THRESHTRK
+            outData['mode'] = scanmode.THRESHTRK
             sendL1A(ohboard, options.gtx, interval=250, number=0)
         else:
-            mode[0] = scanmode.THRESHTRG
+            outData['mode'] = scanmode.THRESHTRG
             pass
-        configureScanModule(ohboard, options.gtx, mode[0], mask,
-                            scanmin=THRESH_MIN, scanmax=THRESH_MAX,
-                            numtrigs=int(N_EVENTS),
-                            useUltra=True, debug=options.debug)
-        printScanConfiguration(ohboard, options.gtx, useUltra=True, debug=options.debug)
-
-        startScanModule(ohboard, options.gtx, useUltra=True, debug=options.debug)
-        scanData = getUltraScanResults(ohboard, options.gtx, THRESH_MAX - THRESH_MIN + 1, options.debug)
+        scanData, nev = takeUltraScan(outData['mode'])
         sys.stdout.flush()
         for i in range(0,24):
             if (mask >> i) & 0x1: continue
-            vfatN[0] = i
-            dataNow      = scanData[i]
-            trimRange[0] = (0x07 & readVFAT(ohboard,options.gtx, i,"ContReg3"))
-            for VC in range(THRESH_MAX-THRESH_MIN+1):
-                vth1[0]  = int((dataNow[VC] & 0xff000000) >> 24)
-                vth[0]   = vth2[0] - vth1[0]
-                Nhits[0] = int(dataNow[VC] & 0xffffff)
-                myT.Fill()
-                pass
+            fillVFAT(i, -1, scanData, nev)
+            pass
+        outTree.autoSave()
+        if options.writeVFATConfig:
+            writeVFATConfig(scanData)
             pass
-        myT.AutoSave("SaveSelf")
 
         if options.trkdata:
             stopLocalT1(ohboard, options.gtx)
             pass
         pass
 except Exception as e:
-    myT.AutoSave("SaveSelf")
+    outTree.autoSave()
+    status = "failed"
     print "An exception occurred", e
 finally:
-    myF.cd()
-    myT.Write()
-    myF.Close()
+    outTree.close()
+    if publisher is not None:
+        publisher.close(status)
+        pass
+    metadata.finish(status)